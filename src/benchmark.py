@@ -0,0 +1,502 @@
+import click
+import contextlib
+import functools
+import inspect
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import boto3
+import botocore.awsrequest
+import jsonschema
+
+import consumer
+import fake_aws
+
+
+# the consumer functions timed by the consumer benchmark, sync and asyncio backend, by stage name
+CONSUMER_STAGES = {
+    "fetch": ("get_next_request", "get_next_request_async"),
+    "validate": ("is_valid_request",),
+    "process": ("process_request", "process_request_async"),
+    "save": ("save_widget", "save_widget_async"),
+    "delete-widget": ("delete_widget", "delete_widget_async"),
+    "delete-request": ("delete_request", "delete_request_async")
+}
+
+
+# raw http body that botocore can read from, used for stubbed responses
+class StubbedBody:
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def stream(self, **kwargs):
+        yield self.content
+
+    def read(self, *args, **kwargs):
+        content, self.content = self.content, b""
+        return content
+
+
+# answers every aws api call with an empty successful response, so that benchmarks measure the client side
+# of a request (client setup, serialization, signing and parsing) without needing a live aws account
+def stub_http_response(request, event_name: str, **kwargs) -> botocore.awsrequest.AWSResponse:
+    # s3 speaks xml and treats unexpected bodies as errors, the json protocol services expect an object
+    content = b"" if ".s3." in event_name else b"{}"
+    return botocore.awsrequest.AWSResponse(request.url, 200, {}, StubbedBody(content))
+
+
+# sets up the default boto3 session so that every client created from it uses stubbed http responses
+def setup_stubbed_session() -> boto3.session.Session:
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_EC2_METADATA_DISABLED", "true")
+
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register("before-send", stub_http_response)
+    return boto3.DEFAULT_SESSION
+
+
+# loads the requests in the given directory sorted by key. If valid_only is set, requests that don't match the
+# request schema are skipped
+def load_sample_requests(request_dir: str = "sample-requests", valid_only: bool = True) -> list[dict[str: str]]:
+    with open("./schemas/request-schema.json") as schema_file:
+        schema = json.load(schema_file)
+
+    requests = []
+    for file in sorted(os.listdir(request_dir)):
+        with open(os.path.join(request_dir, file)) as request_file:
+            try:
+                request = json.load(request_file)
+                if valid_only:
+                    jsonschema.validate(request, schema)
+            except (json.decoder.JSONDecodeError, jsonschema.exceptions.ValidationError):
+                continue
+            requests.append(request)
+    return requests
+
+
+# creates a logger that discards everything, so that logging doesn't skew the results
+def create_quiet_logger() -> logging.Logger:
+    logger = logging.getLogger("benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.CRITICAL)
+    logger.propagate = False
+    return logger
+
+
+# runs process_request over the sample requests until the given count is reached and returns requests/sec
+def run_process_requests(logger, requests: list[dict[str: str]], user_info: dict, count: int,
+                         client_pool: dict = None) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        request = dict(requests[i % len(requests)])
+        request["receipt_handle"] = f"benchmark-{i}"
+        request["key"] = request["requestId"]
+        consumer.process_request(logger, request, user_info, user_info["REGION"], client_pool)
+    return count / (time.perf_counter() - start)
+
+
+@click.group()
+def cli():
+    pass
+
+
+# compares request throughput with a fresh client per call against clients reused from a client pool
+@cli.command("client-pool")
+@click.option("--count", "-n", default=500, help="The number of requests to process per run.")
+@click.option("--region", default="us-east-1", help="The region the stubbed clients are created for.")
+def bench_client_pool(count, region):
+    session = setup_stubbed_session()
+    logger = create_quiet_logger()
+    requests = load_sample_requests()
+
+    for widget_loc in ({"WIDGET_BUCKET": "widgets", "DYNAMODB_TABLE": None},
+                       {"WIDGET_BUCKET": None, "DYNAMODB_TABLE": "widgets"}):
+        user_info = {
+            "REQUEST_LOC": {"REQUEST_BUCKET": None, "REQUEST_QUEUE": "https://sqs.us-east-1.amazonaws.com/0/requests"},
+            "WIDGET_LOC": widget_loc,
+            "REGION": region
+        }
+        backend = "s3" if widget_loc["WIDGET_BUCKET"] else "dynamodb"
+
+        without_pool = run_process_requests(logger, requests, user_info, count)
+        client_pool = consumer.create_client_pool(session=session)
+        with_pool = run_process_requests(logger, requests, user_info, count, client_pool)
+
+        click.echo(f"[{backend}] without pool: {without_pool:10.1f} requests/sec")
+        click.echo(f"[{backend}] with pool:    {with_pool:10.1f} requests/sec ({with_pool / without_pool:.1f}x)")
+
+
+# validates a request the way the consumer used to, reading and compiling the schema for every request
+def validate_uncached(request: dict[str: str]) -> bool:
+    with open("./schemas/request-schema.json") as schema_file:
+        schema = json.load(schema_file)
+        try:
+            jsonschema.validate(request, schema)
+            return True
+        except jsonschema.exceptions.ValidationError:
+            return False
+
+
+# compares validations/sec of the per-request schema loading against the cached validator and fast path
+@cli.command("validation")
+@click.option("--count", "-n", default=2000, help="The number of requests to validate per run.")
+def bench_validation(count):
+    logger = create_quiet_logger()
+    requests = [request for request in load_sample_requests(valid_only=False) if isinstance(request, dict)]
+    corpus = [requests[i % len(requests)] for i in range(count)]
+
+    start = time.perf_counter()
+    for request in corpus:
+        validate_uncached(request)
+    before = count / (time.perf_counter() - start)
+
+    validator = consumer.load_request_validator()
+    start = time.perf_counter()
+    for request in corpus:
+        consumer.is_valid_request(logger, request, validator)
+    after = count / (time.perf_counter() - start)
+
+    click.echo(f"before: {before:12.1f} validations/sec")
+    click.echo(f"after:  {after:12.1f} validations/sec ({after / before:.1f}x)")
+
+
+# compares the widget codecs over the widgets of the sample create requests, reporting the bytes stored and the
+# encode/decode throughput of each codec against plain json
+@cli.command("widget-codec")
+@click.option("--rounds", "-r", default=20, help="The number of times every widget is encoded and decoded.")
+def bench_widget_codec(rounds):
+    logger = create_quiet_logger()
+    widgets = [consumer.create_widget(logger, request, log=False)
+               for request in load_sample_requests() if request["type"] == "create"]
+    json_bytes = sum(len(consumer.encode_widget(widget)[0]) for widget in widgets)
+    click.echo(f"{len(widgets)} widgets, {rounds} rounds")
+    click.echo(f"{'codec':<10}{'bytes':>12}{'vs json':>10}{'encode MB/s':>14}{'decode MB/s':>14}")
+
+    for codec in consumer.get_available_codecs():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            encoded = [consumer.encode_widget(widget, codec) for widget in widgets]
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for body, metadata in encoded:
+                consumer.decode_widget(body, metadata)
+        decode_time = time.perf_counter() - start
+
+        # throughput is measured in widgets as plain json, so codecs are compared on the same amount of data
+        stored_bytes = sum(len(body) for body, _ in encoded)
+        click.echo(f"{codec:<10}{stored_bytes:>12}{stored_bytes / json_bytes:>10.2f}"
+                   f"{json_bytes * rounds / encode_time / 2 ** 20:>14.1f}"
+                   f"{json_bytes * rounds / decode_time / 2 ** 20:>14.1f}")
+
+
+# yields count requests built from the corpus. Every pass over the corpus gets its own request and widget ids,
+# so the create/update/delete sequences of the corpus are replayed for fresh widgets
+def generate_requests(corpus: list[dict[str: str]], count: int):
+    def replay():
+        for replica in itertools.count():
+            for request in corpus:
+                request = dict(request)
+                for attr in ("requestId", "widgetId"):
+                    if attr in request:
+                        request[attr] = f"{request[attr]}-{replica}"
+                yield request
+
+    return itertools.islice(replay(), count)
+
+
+# temporarily replaces an attribute of an object
+@contextlib.contextmanager
+def patched(obj, name: str, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield value
+    finally:
+        setattr(obj, name, original)
+
+
+# wraps the consumer's stage functions so that the duration of every call is recorded, by stage
+@contextlib.contextmanager
+def timed_stages():
+    def timed(function, latencies):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    latencies.append(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+        return wrapper
+
+    latencies = {stage: [] for stage in CONSUMER_STAGES}
+    with contextlib.ExitStack() as stack:
+        for stage, names in CONSUMER_STAGES.items():
+            for name in names:
+                stack.enter_context(patched(consumer, name, timed(getattr(consumer, name), latencies[stage])))
+        yield latencies
+
+
+# returns the value at the given percentile (0-100) of the given values
+def percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+# runs the consumer cli against in-process stand-ins for s3, sqs and dynamodb, replaying count requests from the
+# sample corpus. Each stand-in throttles calls beyond capacity calls per second, if set. The asyncio backend gets
+# asyncio stand-ins sharing the state of the others. Returns the elapsed time, the latencies by stage, the peak number
+# of threads and the stand-ins
+def run_consumer(count: int, request_source: str, widget_backend: str, latency: float, throttle_rate: float,
+                 consumer_args: list[str], capacity: float = 0.0) -> tuple[float, dict[str: list[float]], int, tuple]:
+    region = "us-east-1"
+
+    bodies = (json.dumps(request) for request in generate_requests(load_sample_requests(valid_only=False), count))
+    s3 = fake_aws.FakeS3(latency / 1000, throttle_rate, capacity)
+    sqs = fake_aws.FakeSQS(bodies if request_source == "sqs" else (), latency / 1000, throttle_rate, capacity)
+    dynamodb = fake_aws.FakeDynamoDB(latency / 1000, throttle_rate, capacity)
+    if request_source == "s3":
+        for i, body in enumerate(bodies):
+            s3.objects[("requests", f"{i:012}")] = (body.encode("utf-8"), {})
+    request_dir = tempfile.TemporaryDirectory()
+    if request_source == "files":
+        with open(os.path.join(request_dir.name, "requests.jsonl"), "w") as jsonl_file:
+            jsonl_file.writelines(body + "\n" for body in bodies)
+
+    args = ["--region", region, "--max-request-limit", "0"]
+    args += {"sqs": ["-rq", "fake-queue"], "s3": ["-rb", "requests"],
+             "files": ["-rf", os.path.join(request_dir.name, "requests.jsonl")]}[request_source]
+    args += {"dynamodb": ["-dbt", "widgets"], "s3": ["-wb", "widgets"],
+             "both": ["-dbt", "widgets", "-wb", "widgets"]}[widget_backend]
+    args += list(consumer_args)
+
+    create_client_pool = consumer.create_client_pool
+    create_async_client_pool = consumer.create_async_client_pool
+
+    def create_fake_client_pool(*pool_args, **pool_kwargs):
+        return fake_aws.install_fake_clients(create_client_pool(*pool_args, **pool_kwargs), region, s3, sqs, dynamodb)
+
+    def create_fake_async_client_pool(*pool_args, **pool_kwargs):
+        return fake_aws.install_fake_clients(create_async_client_pool(*pool_args, **pool_kwargs), region,
+                                             *(fake_aws.AsyncFakeClient(fake) for fake in (s3, sqs, dynamodb)))
+
+    # threads are sampled in the background, so worker threads are counted while they are alive
+    peak_threads = [threading.active_count()]
+    sampling = threading.Event()
+
+    def sample_threads():
+        while not sampling.wait(0.01):
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+    sampler = threading.Thread(target=sample_threads, daemon=True)
+    sampler.start()
+    with patched(consumer, "create_client_pool", create_fake_client_pool), \
+            patched(consumer, "create_async_client_pool", create_fake_async_client_pool), timed_stages() as latencies:
+        start = time.perf_counter()
+        consumer.cli.main(args, standalone_mode=False)
+        elapsed = time.perf_counter() - start
+    sampling.set()
+    sampler.join()
+    request_dir.cleanup()
+
+    # the sampler itself isn't counted
+    return elapsed, latencies, peak_threads[0] - 1, (sqs, s3, dynamodb)
+
+
+# runs the consumer cli against in-process stand-ins for s3, sqs and dynamodb. Any extra arguments are passed to
+# the consumer, so modes can be compared, e.g. "benchmark.py consumer -n 100000 -- --workers 8 -sbs 10"
+@cli.command("consumer", context_settings={"ignore_unknown_options": True})
+@click.option("--count", "-n", default=10000, help="The number of requests replayed from the sample corpus.")
+@click.option("--request-source", type=click.Choice(["sqs", "s3", "files"]), default="sqs",
+              help="Where the consumer reads requests from.")
+@click.option("--widget-backend", type=click.Choice(["dynamodb", "s3", "both"]), default="dynamodb",
+              help="Where the consumer stores widgets.")
+@click.option("--latency", default=0.0, help="Milliseconds added to every stand-in api call.")
+@click.option("--throttle-rate", default=0.0, help="The fraction of stand-in api calls that are throttled.")
+@click.option("--capacity", default=0.0, help="If set, stand-ins throttle calls beyond this many per second.")
+@click.argument("consumer_args", nargs=-1, type=click.UNPROCESSED)
+def bench_consumer(count, request_source, widget_backend, latency, throttle_rate, capacity, consumer_args):
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger(consumer.__name__).setLevel(logging.ERROR)
+
+    elapsed, latencies, _, fake_clients = run_consumer(count, request_source, widget_backend, latency, throttle_rate,
+                                                       consumer_args, capacity)
+
+    click.echo(f"requests:  {count} in {elapsed:.2f}s ({count / elapsed:.1f} requests/sec)")
+    click.echo(f"{'stage':<16}{'calls':>10}{'p50 ms':>12}{'p99 ms':>12}")
+    for stage, stage_latencies in latencies.items():
+        click.echo(f"{stage:<16}{len(stage_latencies):>10}{percentile(stage_latencies, 50) * 1000:>12.3f}"
+                   f"{percentile(stage_latencies, 99) * 1000:>12.3f}")
+
+    click.echo(f"{'api call':<24}{'calls':>10}{'per request':>14}")
+    for fake_client in fake_clients:
+        for operation, calls in sorted(fake_client.calls.items()):
+            click.echo(f"{fake_client.service + ' ' + operation:<24}{calls:>10}{calls / count:>14.3f}")
+
+
+# compares the sync backend, processing requests on worker threads, against the asyncio backend processing the same
+# number of requests at once in tasks. Reports throughput, peak python memory and peak thread count of both
+@cli.command("async-backend", context_settings={"ignore_unknown_options": True})
+@click.option("--count", "-n", default=5000, help="The number of requests replayed from the sample corpus.")
+@click.option("--request-source", type=click.Choice(["sqs", "s3", "files"]), default="sqs",
+              help="Where the consumer reads requests from.")
+@click.option("--widget-backend", type=click.Choice(["dynamodb", "s3"]), default="dynamodb",
+              help="Where the consumer stores widgets.")
+@click.option("--latency", default=20.0, help="Milliseconds added to every stand-in api call.")
+@click.option("--concurrency", "-c", default=256,
+              help="The number of worker threads of the sync backend, and of tasks of the asyncio backend.")
+@click.argument("consumer_args", nargs=-1, type=click.UNPROCESSED)
+def bench_async_backend(count, request_source, widget_backend, latency, concurrency, consumer_args):
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger(consumer.__name__).setLevel(logging.ERROR)
+
+    modes = {
+        "sync": ["--workers", str(concurrency), "--max-in-flight", str(concurrency),
+                 "--max-pool-connections", str(concurrency)],
+        "async": ["--async-io", "--max-in-flight", str(concurrency), "--max-pool-connections", str(concurrency)]
+    }
+    results = {}
+    for mode, mode_args in modes.items():
+        tracemalloc.start()
+        elapsed, _, peak_threads, _ = run_consumer(count, request_source, widget_backend, latency, 0.0,
+                                                   mode_args + ["-sbs", "10", "-sp", "32"] + list(consumer_args))
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[mode] = count / elapsed
+        click.echo(f"[{mode:<5}] {results[mode]:10.1f} requests/sec, peak memory {peak_memory / 2 ** 20:7.1f} MB, "
+                   f"peak threads {peak_threads:5}")
+    click.echo(f"async/sync: {results['async'] / results['sync']:.1f}x")
+
+
+# compares writing consumer log lines on the consumer thread against handing them to the buffered logging thread,
+# both with --debug on. Reports throughput and request processing latencies of both
+@cli.command("logging", context_settings={"ignore_unknown_options": True})
+@click.option("--count", "-n", default=10000, help="The number of requests replayed from the sample corpus.")
+@click.option("--request-source", type=click.Choice(["sqs", "s3", "files"]), default="sqs",
+              help="Where the consumer reads requests from.")
+@click.option("--widget-backend", type=click.Choice(["dynamodb", "s3"]), default="dynamodb",
+              help="Where the consumer stores widgets.")
+@click.option("--latency", default=1.0, help="Milliseconds added to every stand-in api call.")
+@click.argument("consumer_args", nargs=-1, type=click.UNPROCESSED)
+def bench_logging(count, request_source, widget_backend, latency, consumer_args):
+    consumer_logger = logging.getLogger(consumer.__name__)
+    modes = {"unbuffered": ["--no-buffered-logging"], "buffered": ["--buffered-logging"]}
+    for mode, mode_args in modes.items():
+        # every run configures logging from scratch
+        for logger in (consumer_logger, logging.getLogger()):
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+        consumer_logger.setLevel(logging.NOTSET)
+        consumer_logger.propagate = True
+
+        # console lines go to the null device, so they still cost a write
+        with open(os.devnull, "w") as null_device, contextlib.redirect_stderr(null_device):
+            elapsed, latencies, _, _ = run_consumer(count, request_source, widget_backend, latency, 0.0,
+                                                    mode_args + ["--debug", "-sbs", "10"] + list(consumer_args))
+        click.echo(f"[{mode:<10}] {count / elapsed:10.1f} requests/sec, process p50 "
+                   f"{percentile(latencies['process'], 50) * 1000:.3f} ms, p99 "
+                   f"{percentile(latencies['process'], 99) * 1000:.3f} ms")
+
+
+# compares the consumer with and without the adaptive rate controller against stand-ins that throttle calls beyond
+# their capacity. Reports how many requests got processed, how many calls were throttled and where the controller
+# settled for dynamodb
+@cli.command("rate-control", context_settings={"ignore_unknown_options": True})
+@click.option("--count", "-n", default=5000, help="The number of requests replayed from the sample corpus.")
+@click.option("--latency", default=2.0, help="Milliseconds added to every stand-in api call.")
+@click.option("--capacity", default=1000.0, help="The number of calls per second each stand-in allows.")
+@click.option("--workers", "-w", default=32, help="The number of consumer worker threads.")
+@click.argument("consumer_args", nargs=-1, type=click.UNPROCESSED)
+def bench_rate_control(count, latency, capacity, workers, consumer_args):
+    logging.basicConfig(level=logging.CRITICAL)
+    logging.getLogger(consumer.__name__).setLevel(logging.CRITICAL)
+
+    modes = {"uncontrolled": ["--no-rate-control"], "controlled": ["--rate-control"]}
+    for mode, mode_args in modes.items():
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            metrics_file = os.path.join(metrics_dir, "metrics.json")
+            args = mode_args + ["-sbs", "10", "--workers", str(workers), "--max-pool-connections", str(workers),
+                                "--metrics-file", metrics_file] + list(consumer_args)
+            elapsed, _, _, (_, _, dynamodb) = run_consumer(count, "sqs", "dynamodb", latency, 0.0, args, capacity)
+            with open(metrics_file) as metrics_json:
+                metrics = json.load(metrics_json)
+
+        processed = sum(counter["value"] for counter in metrics["counters"]
+                        if counter["name"] == "consumer_requests_total" and counter["labels"]["outcome"] == "processed")
+        gauges = {gauge["name"]: gauge["value"] for gauge in metrics["gauges"]
+                  if gauge["labels"].get("service") == "dynamodb"}
+        click.echo(f"[{mode:<12}] {processed:6} requests processed in {elapsed:.2f}s "
+                   f"({processed / elapsed:.1f} requests/sec), {dynamodb.calls['Throttled']} throttled dynamodb calls")
+        if gauges:
+            click.echo(f"{'':15}dynamodb: {gauges.get('consumer_backend_call_rate')} calls/sec, rate limit "
+                       f"{gauges.get('consumer_backend_rate_limit')}, concurrency limit "
+                       f"{gauges.get('consumer_backend_concurrency_limit')}")
+
+
+# copies widgets from a stand-in s3 bucket to a stand-in dynamodb table with the migrate command, reading the bucket
+# with one worker and then with --segments workers, and copies them back with a parallel scan. Reports the number of
+# widgets copied per second and the api calls made
+@cli.command("migrate", context_settings={"ignore_unknown_options": True})
+@click.option("--count", "-n", default=5000, help="The number of widgets copied.")
+@click.option("--owners", default=50, help="The number of owners the widgets are spread over.")
+@click.option("--latency", default=2.0, help="Milliseconds added to every stand-in api call.")
+@click.option("--segments", "-s", default=8, help="The number of parts of the source read at once.")
+@click.argument("migrate_args", nargs=-1, type=click.UNPROCESSED)
+def bench_migrate(count, owners, latency, segments, migrate_args):
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger(consumer.__name__).setLevel(logging.ERROR)
+    region = "us-east-1"
+
+    runs = [("s3", 1), ("s3", segments), ("dynamodb", segments)]
+    for source, run_segments in runs:
+        s3 = fake_aws.FakeS3(latency / 1000)
+        dynamodb = fake_aws.FakeDynamoDB(latency / 1000)
+        for i in range(count):
+            widget = {"widgetId": f"widget-{i}", "owner": f"Owner {chr(65 + i % owners % 26) * (1 + i % owners // 26)}",
+                      "label": "benchmark", "otherAttributes": [{"name": "color", "value": "blue"}]}
+            if source == "s3":
+                s3.objects[("widgets", consumer.get_widget_path(widget))] = consumer.encode_widget(widget, "json")
+            else:
+                dynamodb.tables["widgets"][widget["widgetId"]] = consumer.create_dynamodb_item(widget)
+        create_client_pool = consumer.create_client_pool
+
+        def create_fake_client_pool(*pool_args, **pool_kwargs):
+            return fake_aws.install_fake_clients(create_client_pool(*pool_args, **pool_kwargs), region, s3, dynamodb)
+
+        args = ["migrate", "--source", source, "--region", region, "-wb", "widgets", "-dbt", "widgets",
+                "--segments", str(run_segments), "-mpc", str(max(10, run_segments * 4))] + list(migrate_args)
+        with patched(consumer, "create_client_pool", create_fake_client_pool):
+            start = time.perf_counter()
+            consumer.cli.main(args, standalone_mode=False)
+            elapsed = time.perf_counter() - start
+
+        copied = len(dynamodb.tables["widgets"]) if source == "s3" else len(s3.objects)
+        calls = ", ".join(f"{fake.service} {operation} {calls}" for fake in (s3, dynamodb)
+                          for operation, calls in sorted(fake.calls.items()))
+        click.echo(f"[{source:>8}, {run_segments:2} segments] {copied} widgets copied in {elapsed:.2f}s "
+                   f"({copied / elapsed:.1f} widgets/sec): {calls}")
+
+
+if __name__ == "__main__":
+    cli()
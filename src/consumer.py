@@ -1,15 +1,614 @@
+import asyncio
+import atexit
 import boto3
+import botocore.config
+import botocore.exceptions
 import click
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import gzip
+import http.server
+import inspect
+import itertools
 import json
 import logging
+import logging.handlers
 import jsonschema
+import multiprocessing
+import os
+import queue
+import random
+import re
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import aiobotocore.config
+    import aiobotocore.session
+except ImportError:  # without aiobotocore, the asyncio backend runs boto3 calls in threads
+    aiobotocore = None
+try:
+    import msgpack
+except ImportError:  # the msgpack widget codec needs msgpack
+    msgpack = None
+try:
+    import zstandard
+except ImportError:  # the zstd widget codec needs zstandard
+    zstandard = None
+
+
+# limits enforced by sqs on batched calls and message visibility
+SQS_MAX_BATCH_SIZE = 10
+SQS_MAX_VISIBILITY_TIMEOUT = 43200
+
+# the number of seconds an sqs receive waits for requests when long polling by default
+SQS_LONG_POLL_WAIT_TIME = 20
+
+# formats widgets can be stored in s3 with. The format of a widget is recorded in its object metadata under
+# WIDGET_CODEC_METADATA, objects without it are plain json
+WIDGET_CODECS = ("json", "gzip", "zstd", "msgpack")
+WIDGET_CODEC_METADATA = "codec"
+
+# max number of widgets of one owner written to one segment of the aggregated s3 layout
+S3_SEGMENT_MAX_WIDGETS = 1000
+
+# segments of the aggregated s3 layout are compacted once less than this fraction of their bytes hold live widgets,
+# or once their owner has more than S3_MAX_SEGMENTS segments smaller than S3_SEGMENT_TARGET_SIZE
+S3_COMPACTION_THRESHOLD = 0.5
+S3_MAX_SEGMENTS = 16
+S3_SEGMENT_TARGET_SIZE = 8 * 1024 * 1024
+
+# max number of receive calls the asyncio backend makes at once to refill the sqs buffer
+SQS_MAX_CONCURRENT_RECEIVES = 10
+
+# number of times entries of a batched delete that failed on the sqs side are retried
+SQS_DELETE_RETRIES = 3
+
+# attributes of a request that describe the request rather than the widget, including the ones added by the consumer
+REQUEST_ATTRIBUTES = ("requestId", "type", "key", "receipt_handle", "sent_timestamp")
+
+# attributes of a widget that are stored as they are, the rest are kept in its otherAttributes
+WIDGET_ATTRIBUTES = ("owner", "label", "description")
+
+# the order requests for one widget sent at the same time are applied in
+REQUEST_TYPE_ORDER = {"create": 0, "update": 1, "delete": 2}
+
+# the max number of ids of processed requests remembered in memory, and for how many seconds they are remembered
+DEDUPE_CACHE_SIZE = 10000
+DEDUPE_TTL = 3600.0
+
+# the number of seconds an s3 request that failed to process is skipped for before it is fetched again, doubling with
+# every failure of the request up to the max
+REQUEST_RETRY_BASE = 1.0
+REQUEST_RETRY_MAX = 300.0
+
+# the max number of keys returned by one s3 list call
+S3_MAX_LIST_KEYS = 1000
+
+# the max number of writes sent in one dynamodb batch_write_item call
+DYNAMODB_MAX_BATCH_SIZE = 25
+
+# retry policy for writes that dynamodb leaves unprocessed in a batch, in seconds
+DYNAMODB_BATCH_RETRIES = 8
+DYNAMODB_BACKOFF_BASE = 0.05
+DYNAMODB_BACKOFF_MAX = 5.0
+
+# the location of the json schema that requests are validated against
+REQUEST_SCHEMA_PATH = "./schemas/request-schema.json"
+
+# patterns used by the request schema, matched the same way jsonschema does (anywhere in the string)
+REQUEST_TYPE_PATTERN = re.compile("create|delete|update")
+REQUEST_OWNER_PATTERN = re.compile("[A-Za-z ]+")
+
+# upper bounds in seconds of the buckets latencies are counted in
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# number of seconds the supervisor waits before restarting a crashed consumer process, and how often it checks them
+SUPERVISOR_RESTART_DELAY = 1.0
+SUPERVISOR_CHECK_INTERVAL = 0.5
+SUPERVISOR_STATS_INTERVAL = 10.0
+
+# error codes aws services answer with when they throttle a call
+THROTTLE_ERROR_CODES = {"Throttling", "ThrottlingException", "ThrottledException", "RequestThrottled",
+                        "RequestThrottledException", "ProvisionedThroughputExceededException", "RequestLimitExceeded",
+                        "TooManyRequestsException", "SlowDown"}
+
+# services whose calls the rate controller can be given limits for
+RATE_CONTROL_SERVICES = ("s3", "sqs", "dynamodb")
+
+# the adaptive rate controller cuts the call rate and concurrency of a throttled backend to RATE_CONTROL_DECREASE of
+# their value, at most once per RATE_CONTROL_COOLDOWN seconds. Between throttles, the rate grows back by
+# RATE_CONTROL_INCREASE of the rate before the last cut per second, and the concurrency by one per limit calls
+RATE_CONTROL_DECREASE = 0.7
+RATE_CONTROL_COOLDOWN = 1.0
+RATE_CONTROL_INCREASE = 0.1
+RATE_CONTROL_MIN_RATE = 1.0
+# number of seconds of calls the token bucket of a backend can save up for a burst
+RATE_CONTROL_BURST = 0.1
+# number of seconds asyncio tasks wait between checks for a free call slot
+RATE_CONTROL_POLL_INTERVAL = 0.005
+
+# retry policy for throttled calls, on top of the retries of botocore, in seconds. Waits are drawn uniformly up to
+# the exponential backoff, so throttled callers don't retry in lockstep
+RATE_CONTROL_MAX_ATTEMPTS = 20
+RATE_CONTROL_BACKOFF_BASE = 0.05
+RATE_CONTROL_BACKOFF_MAX = 5.0
+
+
+# creates a registry of boto3 clients that is shared across the whole consumer run. Clients are created lazily,
+# once per service and region, so endpoint resolution, credential lookup and connection setup are only paid once.
+# If metrics are given, every api call made by the pool's clients is recorded in them. If a rate controller is given,
+# every attempt of every api call goes through it
+def create_client_pool(max_pool_connections: int = 10, tcp_keepalive: bool = True, session=None,
+                       metrics: dict = None, rate_controller: dict = None) -> dict:
+    session = session if session is not None else boto3.session.Session()
+    if metrics is not None:
+        register_api_metrics(session, metrics)
+    if rate_controller is not None:
+        register_rate_controller(session, rate_controller)
+
+    return {
+        "SESSION": session,
+        "CONFIG": botocore.config.Config(max_pool_connections=max_pool_connections, tcp_keepalive=tcp_keepalive),
+        "CLIENTS": {},
+        "METRICS": metrics,
+        "RATE_CONTROLLER": rate_controller,
+        "LOCK": threading.Lock()
+    }
+
+
+# returns the metrics of the given client pool, or None if nothing is recorded
+def get_metrics(client_pool: dict) -> dict:
+    return client_pool.get("METRICS") if client_pool is not None else None
+
+
+# retrieves the client for the given service and region from the pool, creating it on first use.
+# If no pool is given, a fresh client is created every time.
+def get_client(client_pool: dict, service: str, region: str):
+    if client_pool is None:
+        return boto3.client(service, region_name=region)
+
+    client_key = (service, region)
+    client = client_pool["CLIENTS"].get(client_key)
+    if client is not None:
+        return client
+
+    # boto3 sessions are not thread safe, so creating clients from the shared session is serialized
+    with client_pool["LOCK"]:
+        if client_key not in client_pool["CLIENTS"]:
+            client_pool["CLIENTS"][client_key] = client_pool["SESSION"].client(
+                service, region_name=region, config=client_pool["CONFIG"])
+        return client_pool["CLIENTS"][client_key]
+
+
+# runs a widget or request operation written as a generator of client calls, so the threaded and asyncio backends
+# share one implementation of it. The generator yields each call as (service, operation, kwargs) and is sent back its
+# response, or has its error raised inside. It may also yield a list of such generators, which run at once, the first
+# in the calling thread and the others on the executor, and is sent back their results once all are done. Operations
+# only the threaded backend has, like buffered deletes, are yielded as functions of region and client pool.
+# Returns the result of the generator
+def run_client_calls(calls, region: str, client_pool: dict = None, executor=None):
+    response, error = None, None
+    while True:
+        try:
+            step = calls.send(response) if error is None else calls.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        response, error = None, None
+        try:
+            if isinstance(step, list):
+                response = run_concurrent_client_calls(step, region, client_pool, executor)
+            elif callable(step):
+                response = step(region, client_pool)
+            else:
+                service, operation, kwargs = step
+                response = getattr(get_client(client_pool, service, region), operation)(**kwargs)
+        except Exception as e:
+            error = e
+
+
+# runs generators of client calls at once, the first in the calling thread and the others on the executor. Waits for
+# all of them before raising the error of the first that failed
+def run_concurrent_client_calls(calls_list: list, region: str, client_pool: dict, executor) -> list:
+    futures = [executor.submit(run_client_calls, calls, region, client_pool, executor) for calls in calls_list[1:]]
+    try:
+        first_result = run_client_calls(calls_list[0], region, client_pool, executor)
+    finally:
+        concurrent.futures.wait(futures)
+    return [first_result] + [future.result() for future in futures]
+
+
+# returns whether a client call failed with one of the given error codes. The modeled exceptions of every client,
+# sync or async, are client errors carrying their code
+def is_client_error(error: Exception, *codes: str) -> bool:
+    return isinstance(error, botocore.exceptions.ClientError) and error.response.get("Error", {}).get("Code") in codes
+
+
+# creates an in-memory registry of counters, gauges and latency histograms, labeled by things like stage, request
+# type and backend. The registry can be exported in the prometheus text format or as json
+def create_metrics() -> dict:
+    return {
+        "COUNTERS": collections.Counter(),
+        "GAUGES": {},
+        "HISTOGRAMS": {},
+        "LOCK": threading.Lock()
+    }
+
+
+# adds the given amount to a counter. Does nothing if metrics is None
+def increment_counter(metrics: dict, name: str, amount: int = 1, **labels) -> None:
+    if metrics is None:
+        return
+    with metrics["LOCK"]:
+        metrics["COUNTERS"][(name, tuple(sorted(labels.items())))] += amount
+
+
+# sets a gauge to the given value. Does nothing if metrics is None
+def set_gauge(metrics: dict, name: str, value: float, **labels) -> None:
+    if metrics is None:
+        return
+    with metrics["LOCK"]:
+        metrics["GAUGES"][(name, tuple(sorted(labels.items())))] = value
+
+
+# counts a latency in the matching bucket of a histogram. Does nothing if metrics is None
+def observe_latency(metrics: dict, name: str, seconds: float, **labels) -> None:
+    if metrics is None:
+        return
+    metric_key = (name, tuple(sorted(labels.items())))
+    with metrics["LOCK"]:
+        histogram = metrics["HISTOGRAMS"].get(metric_key)
+        if histogram is None:
+            histogram = metrics["HISTOGRAMS"][metric_key] = {"BUCKETS": [0] * (len(LATENCY_BUCKETS) + 1),
+                                                             "SUM": 0.0, "COUNT": 0}
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        histogram["BUCKETS"][bucket] += 1
+        histogram["SUM"] += seconds
+        histogram["COUNT"] += 1
+
+
+# records how long the body of the with statement takes as a stage of the consumer
+@contextlib.contextmanager
+def timed_stage(metrics: dict, stage: str, request_type: str = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        labels = {"stage": stage} if request_type is None else {"stage": stage, "type": request_type}
+        observe_latency(metrics, "consumer_stage_seconds", time.perf_counter() - start, **labels)
+
+
+# returns the type of a request as a metric label, so invalid types can't create unbounded label values
+def request_type_label(request: dict[str: str]) -> str:
+    request_type = request.get('type') if isinstance(request, dict) else None
+    return request_type if request_type in ("create", "update", "delete") else "other"
+
+
+# records the latency, retries, throttles and errors of every api call made by clients of the given session
+def register_api_metrics(session, metrics: dict) -> None:
+    def api_labels(event_name):
+        _, service, operation = event_name.split(".")[:3]
+        return {"service": service, "operation": operation}
+
+    def before_call(context, **kwargs):
+        context["metrics_start"] = time.perf_counter()
+
+    def after_call(parsed, context, event_name, **kwargs):
+        labels = api_labels(event_name)
+        increment_counter(metrics, "consumer_api_calls_total", **labels)
+        if "metrics_start" in context:
+            observe_latency(metrics, "consumer_api_call_seconds", time.perf_counter() - context["metrics_start"],
+                            **labels)
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            increment_counter(metrics, "consumer_api_retries_total", retries, **labels)
+        error_code = parsed.get("Error", {}).get("Code")
+        if error_code:
+            increment_counter(metrics, "consumer_api_errors_total", code=error_code, **labels)
+
+    def after_call_error(event_name, **kwargs):
+        increment_counter(metrics, "consumer_api_errors_total", code="connection", **api_labels(event_name))
+
+    # every attempt, including ones retried by botocore, is checked for throttling
+    def needs_retry(response, event_name, **kwargs):
+        if response is not None and response[1].get("Error", {}).get("Code") in THROTTLE_ERROR_CODES:
+            increment_counter(metrics, "consumer_api_throttles_total", **api_labels(event_name))
+
+    # boto3 sessions expose their event emitter, botocore and aiobotocore sessions keep it as a component
+    events = session.events if hasattr(session, "events") else session.get_component("event_emitter")
+    events.register("before-call", before_call)
+    events.register("after-call", after_call)
+    events.register("after-call-error", after_call_error)
+    events.register_last("needs-retry", needs_retry)
+
+
+# creates a controller that paces the api calls of each backend (aws service) with a token bucket and a limit on
+# concurrent calls. Both start at the given limits, a backend without a rate limit isn't paced until it is throttled.
+# Throttled calls cut both limits (multiplicative decrease), calls that get through raise them again (additive
+# increase), so the consumer settles near the highest rate a backend allows. The current limits and call rate of
+# every backend are kept as gauges in the given metrics
+def create_rate_controller(max_concurrency: int, rate_limits: dict[str: float] = None, metrics: dict = None) -> dict:
+    return {
+        "MAX_CONCURRENCY": max_concurrency,
+        "RATE_LIMITS": dict(rate_limits or {}),
+        "METRICS": metrics,
+        # service -> pacing state of the backend
+        "BACKENDS": {},
+        "LOCK": threading.Lock()
+    }
+
+
+# returns the pacing state of a backend, creating it on first use
+def get_backend_state(rate_controller: dict, service: str) -> dict:
+    backend = rate_controller["BACKENDS"].get(service)
+    if backend is not None:
+        return backend
+
+    with rate_controller["LOCK"]:
+        if service not in rate_controller["BACKENDS"]:
+            now = time.monotonic()
+            rate = rate_controller["RATE_LIMITS"].get(service)
+            rate_controller["BACKENDS"][service] = {
+                "SERVICE": service,
+                # calls per second, None while the backend isn't paced
+                "RATE": rate,
+                "MAX_RATE": rate,
+                # the rate before the last cut, which sets how fast the rate grows back
+                "CUT_RATE": rate,
+                "TOKENS": 1.0,
+                "REFILLED": now,
+                "CONCURRENCY": float(rate_controller["MAX_CONCURRENCY"]),
+                "IN_FLIGHT": 0,
+                "LAST_CUT": None,
+                # calls let through since WINDOW_START, which give the observed call rate once a second
+                "WINDOW_START": now,
+                "WINDOW_CALLS": 0,
+                "CALL_RATE": 0.0,
+                "CONDITION": threading.Condition()
+            }
+        return rate_controller["BACKENDS"][service]
+
+
+# lets a call of a backend through if a call slot and a token are free. Returns 0 if the call may be made, otherwise
+# the number of seconds until a token is free, or None if it has to wait for a running call to finish. The caller
+# must hold the condition of the backend
+def reserve_backend_call(rate_controller: dict, backend: dict) -> float:
+    now = time.monotonic()
+    if backend["RATE"] is not None:
+        elapsed = now - backend["REFILLED"]
+        backend["REFILLED"] = now
+        backend["RATE"] += RATE_CONTROL_INCREASE * backend["CUT_RATE"] * elapsed
+        if backend["MAX_RATE"] is not None:
+            backend["RATE"] = min(backend["RATE"], backend["MAX_RATE"])
+        backend["TOKENS"] = min(max(1.0, backend["RATE"] * RATE_CONTROL_BURST),
+                                backend["TOKENS"] + backend["RATE"] * elapsed)
+
+    if backend["IN_FLIGHT"] >= int(backend["CONCURRENCY"]):
+        return None
+    if backend["RATE"] is not None:
+        if backend["TOKENS"] < 1:
+            return (1 - backend["TOKENS"]) / backend["RATE"]
+        backend["TOKENS"] -= 1
+    backend["IN_FLIGHT"] += 1
+
+    backend["WINDOW_CALLS"] += 1
+    if now - backend["WINDOW_START"] >= 1:
+        backend["CALL_RATE"] = backend["WINDOW_CALLS"] / (now - backend["WINDOW_START"])
+        backend["WINDOW_START"], backend["WINDOW_CALLS"] = now, 0
+        report_backend_limits(rate_controller, backend)
+    return 0.0
+
+
+# waits until a call of the given backend may be made
+def acquire_backend_call(rate_controller: dict, service: str) -> None:
+    backend = get_backend_state(rate_controller, service)
+    with backend["CONDITION"]:
+        while True:
+            wait = reserve_backend_call(rate_controller, backend)
+            if wait == 0:
+                return
+            backend["CONDITION"].wait(wait)
+
+
+# async counterpart of acquire_backend_call, which waits without blocking the event loop
+async def acquire_backend_call_async(rate_controller: dict, service: str) -> None:
+    backend = get_backend_state(rate_controller, service)
+    while True:
+        with backend["CONDITION"]:
+            wait = reserve_backend_call(rate_controller, backend)
+        if wait == 0:
+            return
+        await asyncio.sleep(wait if wait is not None else RATE_CONTROL_POLL_INTERVAL)
+
+
+# frees the call slot of a finished call of a backend, and adjusts the limits of the backend by its outcome
+def release_backend_call(rate_controller: dict, service: str, throttled: bool) -> None:
+    backend = get_backend_state(rate_controller, service)
+    with backend["CONDITION"]:
+        backend["IN_FLIGHT"] = max(0, backend["IN_FLIGHT"] - 1)
+        if throttled:
+            cut_backend_limits(rate_controller, backend)
+        else:
+            backend["CONCURRENCY"] = min(rate_controller["MAX_CONCURRENCY"],
+                                         backend["CONCURRENCY"] + 1 / backend["CONCURRENCY"])
+        backend["CONDITION"].notify()
+
+
+# cuts the limits of a backend that throttled, e.g. because a batch call left items unprocessed
+def record_backend_throttle(rate_controller: dict, service: str) -> None:
+    if rate_controller is None:
+        return
+    backend = get_backend_state(rate_controller, service)
+    with backend["CONDITION"]:
+        cut_backend_limits(rate_controller, backend)
+
+
+# cuts the rate and concurrency limits of a backend, unless they were cut less than a cooldown ago: calls made before
+# the last cut are still answered with throttles for a while. The caller must hold the condition of the backend
+def cut_backend_limits(rate_controller: dict, backend: dict) -> None:
+    now = time.monotonic()
+    if backend["LAST_CUT"] is not None and now - backend["LAST_CUT"] < RATE_CONTROL_COOLDOWN:
+        return
+
+    backend["CONCURRENCY"] = max(1.0, backend["CONCURRENCY"] * RATE_CONTROL_DECREASE)
+    # the rate is cut from the rate the backend was actually called at. If that is well below the rate limit, e.g.
+    # because callers are backing off, the limit isn't what overloads the backend, so it is kept
+    rate = max(backend["CALL_RATE"], backend["WINDOW_CALLS"] / max(now - backend["WINDOW_START"], 0.1))
+    if backend["RATE"] is None or rate >= backend["RATE"] * RATE_CONTROL_DECREASE:
+        backend["CUT_RATE"] = rate if backend["RATE"] is None else min(rate, backend["RATE"])
+        backend["RATE"] = max(RATE_CONTROL_MIN_RATE, backend["CUT_RATE"] * RATE_CONTROL_DECREASE)
+        backend["TOKENS"] = min(backend["TOKENS"], 1.0)
+        backend["REFILLED"] = now
+    backend["LAST_CUT"] = now
+    increment_counter(rate_controller["METRICS"], "consumer_rate_cuts_total", service=backend["SERVICE"])
+    report_backend_limits(rate_controller, backend)
+
+
+# sets the gauges of the current limits and call rate of a backend
+def report_backend_limits(rate_controller: dict, backend: dict) -> None:
+    metrics, service = rate_controller["METRICS"], backend["SERVICE"]
+    set_gauge(metrics, "consumer_backend_call_rate", round(backend["CALL_RATE"], 1), service=service)
+    set_gauge(metrics, "consumer_backend_concurrency_limit", int(backend["CONCURRENCY"]), service=service)
+    if backend["RATE"] is not None:
+        set_gauge(metrics, "consumer_backend_rate_limit", round(backend["RATE"], 1), service=service)
+
+
+# returns how long to wait before retrying a call that was throttled for the given number of attempts
+def get_throttle_backoff(attempts: int) -> float:
+    return random.uniform(0, min(RATE_CONTROL_BACKOFF_BASE * 2 ** attempts, RATE_CONTROL_BACKOFF_MAX))
+
+
+# makes every attempt of every api call made by clients of the given session wait for the rate controller, and
+# retries throttled calls with jittered backoff once botocore stops retrying them. The retry handler is registered
+# last, so botocore's own retry handler decides first, and the first delay returned is the one used. Handlers of
+# aiobotocore sessions wait asynchronously
+def register_rate_controller(session, rate_controller: dict, asynchronous: bool = False) -> None:
+    def before_send(event_name, **kwargs):
+        acquire_backend_call(rate_controller, event_name.split(".")[1])
+
+    async def before_send_async(event_name, **kwargs):
+        await acquire_backend_call_async(rate_controller, event_name.split(".")[1])
+
+    def needs_retry(response, attempts, event_name, **kwargs):
+        throttled = response is not None and response[1].get("Error", {}).get("Code") in THROTTLE_ERROR_CODES
+        release_backend_call(rate_controller, event_name.split(".")[1], throttled)
+        if throttled and attempts < RATE_CONTROL_MAX_ATTEMPTS:
+            return get_throttle_backoff(attempts)
+        return None
+
+    events = session.events if hasattr(session, "events") else session.get_component("event_emitter")
+    events.register("before-send", before_send_async if asynchronous else before_send)
+    events.register_last("needs-retry", needs_retry)
+
+
+# formats the metrics in the prometheus text exposition format
+def format_metrics_prometheus(metrics: dict) -> str:
+    def format_labels(labels, **extra_labels):
+        labels = list(labels) + list(extra_labels.items())
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+    with metrics["LOCK"]:
+        counters = sorted(metrics["COUNTERS"].items())
+        gauges = sorted(metrics["GAUGES"].items())
+        histograms = sorted((key, dict(histogram, BUCKETS=list(histogram["BUCKETS"])))
+                            for key, histogram in metrics["HISTOGRAMS"].items())
+
+    lines = []
+    for (name, labels), value in counters:
+        if f"# TYPE {name} counter" not in lines:
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+    for (name, labels), value in gauges:
+        if f"# TYPE {name} gauge" not in lines:
+            lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+    for (name, labels), histogram in histograms:
+        if f"# TYPE {name} histogram" not in lines:
+            lines.append(f"# TYPE {name} histogram")
+        cumulative_count = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram["BUCKETS"]):
+            cumulative_count += count
+            lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {cumulative_count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {histogram['SUM']}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram['COUNT']}")
+
+    return "\n".join(lines) + "\n"
+
+
+# formats the metrics as a json serializable object
+def format_metrics_json(metrics: dict) -> dict:
+    with metrics["LOCK"]:
+        return {
+            "timestamp": time.time(),
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in sorted(metrics["COUNTERS"].items())],
+            "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                       for (name, labels), value in sorted(metrics["GAUGES"].items())],
+            "histograms": [{"name": name, "labels": dict(labels), "sum": histogram["SUM"],
+                            "count": histogram["COUNT"],
+                            "buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"],
+                                                histogram["BUCKETS"]))}
+                           for (name, labels), histogram in sorted(metrics["HISTOGRAMS"].items())]
+        }
+
+
+# writes the metrics as json to the given file, replacing it in one step so readers never see a partial file
+def write_metrics_json(metrics: dict, save_file: str) -> None:
+    with open(save_file + ".tmp", "w") as metrics_file:
+        json.dump(format_metrics_json(metrics), metrics_file, indent=2)
+    os.replace(save_file + ".tmp", save_file)
+
+
+# serves the metrics in the prometheus text format at /metrics on the given port and host, from a background thread.
+# By default only local connections are accepted
+def start_metrics_server(metrics: dict, port: int, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = format_metrics_prometheus(metrics).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+# writes the metrics as json to the given file every interval seconds from a background thread, until the
+# returned event is set
+def start_metrics_dump(metrics: dict, save_file: str, interval: float) -> threading.Event:
+    stop_event = threading.Event()
+
+    def dump_metrics():
+        while not stop_event.wait(interval):
+            write_metrics_json(metrics, save_file)
+
+    threading.Thread(target=dump_metrics, name="metrics-dump", daemon=True).start()
+    return stop_event
 
 
 # creates a widget object from a request object. The request is assumed to be verified
 def create_widget(logger, request_data: dict[str: str], log=True) -> dict[str: str]:
     widget_obj = {}
     for attr in request_data.keys():
-        if attr == "requestId" or attr == "type":  # ignore request specific attributes
+        if attr in REQUEST_ATTRIBUTES:  # ignore request specific attributes
             continue
         widget_obj[attr] = request_data[attr]
 
@@ -19,52 +618,204 @@ def create_widget(logger, request_data: dict[str: str], log=True) -> dict[str: s
     return widget_obj
 
 
-# wrapper method for deleting a widget from a specified location
-def delete_widget(logger, request_data: dict[str: str], widget_loc: dict[str: str], region: str) -> None:
-    if widget_loc["WIDGET_BUCKET"]:
-        delete_widget_s3(logger, request_data, widget_loc["WIDGET_BUCKET"], region)
+# creates a cache of the last stored state of widgets, so writes that wouldn't change a widget and existence checks
+# can be answered without calling the widget location. The least recently used widgets are evicted once the cached
+# widgets take up more than max_bytes (measured as json). With a ttl, the consistency mode for consumers sharing a
+# widget location, cached states are only trusted for ttl seconds after they were stored. Without one, the consumer
+# is assumed to be the only writer and cached states are trusted until they are evicted
+def create_widget_cache(max_bytes: int, ttl: float = None) -> dict:
+    return {
+        "MAX_BYTES": max_bytes,
+        "TTL": ttl,
+        # widgetId -> (stored widget, or None if it doesn't exist, size in bytes, time it was stored)
+        "WIDGETS": collections.OrderedDict(),
+        "BYTES": 0,
+        "LOCK": threading.Lock()
+    }
+
+
+# looks up the last stored state of a widget. Returns (True, widget) if it is known, where widget is None if the
+# widget doesn't exist, or (False, None) if it isn't known. Does nothing if widget_cache is None
+def get_cached_widget(widget_cache: dict, widget_id: str) -> tuple[bool, dict[str: str]]:
+    if widget_cache is None:
+        return False, None
+
+    with widget_cache["LOCK"]:
+        entry = widget_cache["WIDGETS"].get(widget_id)
+        if entry is None:
+            return False, None
+        widget_obj, size, stored_at = entry
+        if widget_cache["TTL"] is not None and time.monotonic() - stored_at > widget_cache["TTL"]:
+            del widget_cache["WIDGETS"][widget_id]
+            widget_cache["BYTES"] -= size
+            return False, None
+        widget_cache["WIDGETS"].move_to_end(widget_id)
+        return True, widget_obj
+
+
+# records the stored state of a widget, None if it was deleted or doesn't exist
+def cache_widget(widget_cache: dict, widget_id: str, widget_obj: dict[str: str]) -> None:
+    if widget_cache is None:
+        return
+
+    size = len(widget_id) + (len(json.dumps(widget_obj)) if widget_obj is not None else 0)
+    with widget_cache["LOCK"]:
+        previous = widget_cache["WIDGETS"].pop(widget_id, None)
+        if previous is not None:
+            widget_cache["BYTES"] -= previous[1]
+        widget_cache["WIDGETS"][widget_id] = (dict(widget_obj) if widget_obj is not None else None, size,
+                                              time.monotonic())
+        widget_cache["BYTES"] += size
+        while widget_cache["BYTES"] > widget_cache["MAX_BYTES"] and widget_cache["WIDGETS"]:
+            _, (_, evicted_size, _) = widget_cache["WIDGETS"].popitem(last=False)
+            widget_cache["BYTES"] -= evicted_size
+
+
+# forgets the stored state of a widget, e.g. because writing it failed
+def invalidate_widget(widget_cache: dict, widget_id: str) -> None:
+    if widget_cache is None:
+        return
+    with widget_cache["LOCK"]:
+        entry = widget_cache["WIDGETS"].pop(widget_id, None)
+        if entry is not None:
+            widget_cache["BYTES"] -= entry[1]
+
+
+# wrapper method for deleting a widget from a specified location. Widgets the widget cache knows not to exist aren't
+# deleted, widgets it knows to exist are deleted without checking
+def delete_widget(logger, request_data: dict[str: str], widget_loc: dict[str: str], region: str,
+                  client_pool: dict = None) -> None:
+    run_client_calls(delete_widget_calls(logger, request_data, widget_loc, get_metrics(client_pool)), region,
+                     client_pool, widget_loc.get("REPLICATION_EXECUTOR"))
+
+
+# makes the client calls of delete_widget, see run_client_calls. A dual widget location is deleted from the dynamodb
+# table in the calling thread and from the s3 bucket on the replication executor. The conditional dynamodb delete
+# already tells whether the widget existed, so the s3 copy is deleted without an existence check
+def delete_widget_calls(logger, request_data: dict[str: str], widget_loc: dict[str: str], metrics: dict):
+    widget_cache = widget_loc.get("WIDGET_CACHE")
+    widget_known, cached_widget = get_cached_widget(widget_cache, request_data['widgetId'])
+    if widget_known:
+        increment_counter(metrics, "consumer_widget_cache_total", result="check-skipped")
+        if cached_widget is None:
+            logger.warning(f"Could not delete widget '{request_data['widgetId']}', widget does not exist.")
+            if widget_loc.get("WRITE_BUFFER") is not None:
+                buffer_request(widget_loc["WRITE_BUFFER"], request_data)
+            return
+
+    if widget_loc.get("WRITE_BUFFER") is not None:
+        yield functools.partial(delete_widget_buffered, logger, request_data, widget_loc["WRITE_BUFFER"],
+                                known_to_exist=widget_known)
+    elif widget_loc["WIDGET_BUCKET"] and widget_loc["DYNAMODB_TABLE"]:
+        yield [delete_widget_dynamodb_calls(logger, request_data, widget_loc["DYNAMODB_TABLE"]),
+               delete_widget_s3_calls(logger, request_data, widget_loc["WIDGET_BUCKET"], blind=True, log=False)]
+    elif widget_loc["WIDGET_BUCKET"]:
+        yield from delete_widget_s3_calls(logger, request_data, widget_loc["WIDGET_BUCKET"],
+                                          widget_loc.get("S3_BLIND_DELETES", False) or widget_known)
     else:
-        delete_widget_dynamodb(logger, request_data, widget_loc["DYNAMODB_TABLE"], region)
+        yield from delete_widget_dynamodb_calls(logger, request_data, widget_loc["DYNAMODB_TABLE"])
+    cache_widget(widget_cache, request_data['widgetId'], None)
 
 
-# deletes a widget from an s3 bucket, if the widget exists
-def delete_widget_s3(logger, request_data: dict[str: str], widget_bucket: str, region: str) -> None:
-    s3_client = boto3.client('s3', region_name=region)
+# deletes a widget from an s3 bucket, if the widget exists. Existence is checked with a head request, unless
+# blind is set, in which case the widget is deleted without checking (deleting a missing widget is not logged)
+def delete_widget_s3(logger, request_data: dict[str: str], widget_bucket: str, region: str,
+                     client_pool: dict = None, blind: bool = False) -> None:
+    run_client_calls(delete_widget_s3_calls(logger, request_data, widget_bucket, blind), region, client_pool)
 
-    bucket_owner = request_data['owner'].replace(" ", "-").lower()
-    widget_path = f"widgets/{bucket_owner}/{request_data['widgetId']}"
 
-    try:
-        s3_client.get_object(Bucket=widget_bucket, Key=widget_path)
-    except s3_client.exceptions.NoSuchKey:
-        logger.warning(f"Widget '{widget_path}' does not exist in s3 bucket '{widget_bucket}'.")
-        return
+# makes the client calls of delete_widget_s3, see run_client_calls. If log isn't set, the deletion isn't logged
+def delete_widget_s3_calls(logger, request_data: dict[str: str], widget_bucket: str, blind: bool = False,
+                           log: bool = True):
+    widget_path = get_widget_path(request_data)
+
+    if not blind:
+        try:
+            yield 's3', 'head_object', {"Bucket": widget_bucket, "Key": widget_path}
+        except botocore.exceptions.ClientError as error:
+            # head requests have no body, so a missing widget only shows up as a 404
+            if not is_client_error(error, "404", "NoSuchKey", "NotFound"):
+                raise
+            logger.warning(f"Widget '{widget_path}' does not exist in s3 bucket '{widget_bucket}'.")
+            return
+
+    yield 's3', 'delete_object', {"Bucket": widget_bucket, "Key": widget_path}
+    if log:
+        logger.info(f"Deleted Widget '{request_data['widgetId']}'")
 
-    s3_client.delete_object(Bucket=widget_bucket, Key=widget_path)
-    logger.info(f"Deleted Widget '{request_data['widgetId']}'")
 
+# deletes a widget from a dynamodb table, if the widget exists. The delete is conditional on the widget existing,
+# so checking and deleting only takes one call
+def delete_widget_dynamodb(logger, request_data: dict[str: str], widget_table: str, region: str,
+                           client_pool: dict = None) -> None:
+    run_client_calls(delete_widget_dynamodb_calls(logger, request_data, widget_table), region, client_pool)
 
-# deletes a widget from a dynamodb table, if the widget exists
-def delete_widget_dynamodb(logger, request_data: dict[str: str], widget_table: str, region: str) -> None:
-    dynamodb_client = boto3.client("dynamodb", region_name=region)
-    widget_obj = create_widget(logger, request_data, log=False)
 
-    item_key = {"id": {'S': widget_obj["widgetId"]}}
+# makes the client calls of delete_widget_dynamodb, see run_client_calls
+def delete_widget_dynamodb_calls(logger, request_data: dict[str: str], widget_table: str):
+    item_key = {"id": {'S': request_data["widgetId"]}}
 
-    response = dynamodb_client.get_item(TableName=widget_table, Key=item_key)
-    if 'Item' not in response.keys():
+    try:
+        yield "dynamodb", "delete_item", {"TableName": widget_table, "Key": item_key,
+                                          "ConditionExpression": "attribute_exists(id)"}
+    except botocore.exceptions.ClientError as error:
+        if not is_client_error(error, "ConditionalCheckFailedException"):
+            raise
         logger.warning(f"Could not delete widget '{request_data['widgetId']}', widget does not exist.")
         return
 
-    dynamodb_client.delete_item(TableName=widget_table, Key=item_key)
     logger.info(f"Deleted Widget '{request_data['widgetId']}'")
 
 
+# queues the deletion of a widget in the write buffer, if the widget exists. Widgets with a write waiting in the
+# buffer are checked against that write instead of the table or segment index, widgets known to exist aren't checked
+def delete_widget_buffered(logger, request_data: dict[str: str], write_buffer: dict, region: str,
+                           client_pool: dict = None, known_to_exist: bool = False) -> None:
+    widget_id = request_data['widgetId']
+    item_key = {"id": {'S': widget_id}}
+
+    pending_write = get_buffered_write(write_buffer, widget_id)
+    if pending_write is not None:
+        widget_exists = "PutRequest" in pending_write
+    elif known_to_exist:
+        widget_exists = True
+    elif write_buffer["TABLE"] is None:
+        # the index is only read while no flush is changing it
+        with write_buffer["FLUSH_LOCK"]:
+            index = get_segment_index(write_buffer, get_owner_path(request_data["owner"]), region, client_pool)
+        widget_exists = widget_id in index["widgets"]
+    else:
+        dynamodb_client = get_client(client_pool, "dynamodb", region)
+        response = dynamodb_client.get_item(TableName=write_buffer["TABLE"], Key=item_key, ProjectionExpression="id")
+        widget_exists = 'Item' in response.keys()
+
+    if not widget_exists:
+        logger.warning(f"Could not delete widget '{widget_id}', widget does not exist.")
+        buffer_request(write_buffer, request_data)
+        return
+
+    if write_buffer["TABLE"] is None:
+        buffer_write(write_buffer, widget_id, {"DeleteRequest": {"Owner": request_data["owner"]}}, request_data)
+    else:
+        buffer_write(write_buffer, widget_id, {"DeleteRequest": {"Key": item_key}}, request_data)
+    logger.info(f"Deleted Widget '{widget_id}'")
+
+
+# returns the key a widget is stored under in an s3 bucket
+def get_widget_path(widget_obj: dict[str: str]) -> str:
+    return f"{get_owner_path(widget_obj['owner'])}/{widget_obj['widgetId']}"
+
+
+# returns the prefix the widgets of an owner are stored under in an s3 bucket
+def get_owner_path(owner: str) -> str:
+    return f"widgets/{owner.replace(' ', '-').lower()}"
+
+
 # updates a widget from the given request
 def update_widget(logger, request_data: dict[str: str]):
     new_widget = {}
     for attr in request_data.keys():
-        if attr == "requestId" or attr == "type":  # ignore request specific attributes
+        if attr in REQUEST_ATTRIBUTES:  # ignore request specific attributes
             continue
         new_widget[attr] = request_data[attr]
 
@@ -73,84 +824,620 @@ def update_widget(logger, request_data: dict[str: str]):
 
 
 # wrapper method for retrieving requests
-def get_next_request(logger, request_loc: dict[str: str], region: str) -> (dict[str: str], int):
-    if request_loc["REQUEST_BUCKET"]:
-        return get_request_s3(logger, request_loc["REQUEST_BUCKET"], region)
+def get_next_request(logger, request_loc: dict[str: str], region: str,
+                     client_pool: dict = None) -> (dict[str: str], int):
+    if request_loc.get("REQUEST_STREAM") is not None:
+        return next(request_loc["REQUEST_STREAM"], None)
+    elif request_loc.get("S3_READER") is not None:
+        return get_request_s3_prefetched(logger, request_loc["S3_READER"], region, client_pool,
+                                         request_loc["IN_FLIGHT_KEYS"])
+    elif request_loc["REQUEST_BUCKET"]:
+        return get_request_s3(logger, request_loc["REQUEST_BUCKET"], region, client_pool,
+                              request_loc.get("IN_FLIGHT_KEYS"), request_loc.get("PARTITION"),
+                              request_loc.get("REQUEST_RETRIES"))
+    elif request_loc.get("SQS_BUFFER") is not None:
+        return get_request_sqs_batched(logger, request_loc["REQUEST_QUEUE"], region, request_loc["SQS_BUFFER"],
+                                       client_pool)
     else:
-        return get_request_sqs(logger, request_loc["REQUEST_QUEUE"], region)
+        return get_request_sqs(logger, request_loc["REQUEST_QUEUE"], region, client_pool,
+                               request_loc.get("SQS_WAIT_TIME", 0))
+
+
+# checks if a request key belongs to the given (index, count) partition of the request bucket. Keys are spread over
+# the partitions by hash, so consumer processes sharing a bucket never compete for the same requests. The key of an
+# s3 request says nothing about its widget, so requests for one widget may land in different partitions, and are then
+# only kept in order within each process
+def in_partition(request_key: str, partition: tuple[int, int] = None) -> bool:
+    if partition is None:
+        return True
+    index, count = partition
+    return zlib.crc32(request_key.encode("utf-8")) % count == index
+
+
+# creates the record of s3 request keys that failed to process. A key that failed is skipped while it cools down,
+# for REQUEST_RETRY_BASE seconds doubling with every failure, so a request that keeps failing isn't fetched again on
+# every poll ahead of the keys listed after it
+def create_request_retries() -> dict:
+    return {
+        # key -> (number of failures, time the key can be fetched again)
+        "KEYS": {},
+        "LOCK": threading.Lock()
+    }
+
 
+# records that the request with the given key failed to process, so it cools down before it is fetched again.
+# Does nothing if request_retries is None
+def record_request_failure(request_retries: dict, request_key: str) -> None:
+    if request_retries is None:
+        return
+    with request_retries["LOCK"]:
+        failures = request_retries["KEYS"].get(request_key, (0, None))[0] + 1
+        delay = min(REQUEST_RETRY_BASE * 2 ** (failures - 1), REQUEST_RETRY_MAX)
+        request_retries["KEYS"][request_key] = (failures, time.monotonic() + delay)
 
-# retrieves a request from an s3 bucket. If no request is found, returns None
-def get_request_s3(logger, bucket_name: str, region: str) -> dict[str: str]:
-    s3_client = boto3.client('s3', region_name=region)
+
+# forgets the failures of a request once it has been processed. Does nothing if request_retries is None
+def clear_request_failures(request_retries: dict, request_key: str) -> None:
+    if request_retries is None:
+        return
+    with request_retries["LOCK"]:
+        request_retries["KEYS"].pop(request_key, None)
+
+
+# returns the keys of failed requests that are still cooling down
+def get_cooling_keys(request_retries: dict) -> set[str]:
+    if request_retries is None:
+        return set()
+    now = time.monotonic()
+    with request_retries["LOCK"]:
+        return {key for key, (_, retry_time) in request_retries["KEYS"].items() if retry_time > now}
+
+
+# retrieves a request from an s3 bucket. If no request is found, returns None.
+# Requests whose keys are in in_flight_keys are still being processed and are skipped; the key of the
+# returned request is added to it. If a partition is given, only requests with keys in the partition are retrieved.
+# Requests that failed and are still cooling down in request_retries are skipped too
+def get_request_s3(logger, bucket_name: str, region: str, client_pool: dict = None,
+                   in_flight_keys: set = None, partition: tuple[int, int] = None,
+                   request_retries: dict = None) -> dict[str: str]:
+    s3_client = get_client(client_pool, 's3', region)
+    cooling_keys = get_cooling_keys(request_retries)
 
     # list_objects_v2 appears to always list in ascending order (likely the order the objects were uploaded),
     # so the first object in the list will always be the one with the smallest key
-    requests = s3_client.list_objects_v2(Bucket=bucket_name, MaxKeys=1).get("Contents")
+    skipped_keys = len(in_flight_keys) if in_flight_keys is not None else 0
+    max_keys = min(skipped_keys + len(cooling_keys) + 1, S3_MAX_LIST_KEYS)
+    if partition is not None:
+        max_keys = S3_MAX_LIST_KEYS
+    list_args = {"Bucket": bucket_name, "MaxKeys": max_keys}
+
+    while True:
+        response = s3_client.list_objects_v2(**list_args)
+        requests = response.get("Contents", [])
+        request_keys = [obj["Key"] for obj in requests
+                        if in_partition(obj["Key"], partition) and obj["Key"] not in cooling_keys
+                        and (in_flight_keys is None or obj["Key"] not in in_flight_keys)]
+        if request_keys or not requests or not response.get("IsTruncated"):
+            break
+        # every listed key is skipped, the next available key may be further into the bucket
+        list_args.update(StartAfter=requests[-1]["Key"], MaxKeys=S3_MAX_LIST_KEYS)
+
+    if not request_keys:
+        return None
+    if in_flight_keys is not None:
+        in_flight_keys.add(request_keys[0])
+
+    request_key = request_keys[0]
 
-    if requests is None:
+    request = fetch_request_s3(bucket_name, request_key, region, client_pool)
+    if request is None:
+        # another worker finished the request between listing and fetching it
+        if in_flight_keys is not None:
+            in_flight_keys.discard(request_key)
         return None
 
-    request_key = list(requests)[0]["Key"]
+    logger.debug("Retrieved request '%s' from s3 bucket '%s'", request.get('widgetId'), bucket_name)
 
-    response = s3_client.get_object(Bucket=bucket_name, Key=request_key)
+    return request
+
+
+# downloads and parses the request stored under the given key. If the request no longer exists, returns None
+def fetch_request_s3(bucket_name: str, request_key: str, region: str, client_pool: dict = None) -> dict[str: str]:
+    s3_client = get_client(client_pool, 's3', region)
+
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=request_key)
+    except s3_client.exceptions.NoSuchKey:
+        return None
     object_content = response["Body"].read().decode("utf-8")
 
     request = json.loads(object_content)
     request['key'] = request_key
+    return request
 
-    logger.debug(f"Retrieved request '{request['widgetId']}' from s3 bucket '{bucket_name}'")
 
-    return request
+# creates a reader that lists an s3 request bucket a page at a time and downloads the next requests in the
+# background. Keys are handed out in listing order, so the request with the smallest key still comes first.
+# If a partition is given, only keys in the partition are read. Unless threaded is set, the downloads are left to the
+# asyncio backend, which runs them as tasks instead of on the reader's threads
+def create_s3_reader(bucket_name: str, prefetch: int = 8, partition: tuple[int, int] = None,
+                     threaded: bool = True, request_retries: dict = None) -> dict:
+    return {
+        "BUCKET": bucket_name,
+        "PREFETCH": prefetch,
+        "PARTITION": partition,
+        # keys of failed requests that are cooling down are left for a later pass over the bucket
+        "REQUEST_RETRIES": request_retries,
+        # keys listed but not yet downloaded, the last key listed (where the next page starts after), and whether
+        # the last listing reached the end of the bucket
+        "KEYS": collections.deque(),
+        "CURSOR": None,
+        "EXHAUSTED": False,
+        # (key, future or task) pairs of the requests being downloaded, in key order
+        "FETCHES": collections.deque(),
+        "EXECUTOR": concurrent.futures.ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="s3-prefetch")
+        if threaded else None,
+        "LOCK": threading.Lock()
+    }
+
+
+# lists the next page of request keys after the reader's cursor, skipping keys that are still in flight. Once the
+# end of the bucket is reached, the cursor starts over, so requests that were left behind are picked up again
+def list_request_keys_s3(reader: dict, region: str, client_pool: dict, in_flight_keys: set) -> None:
+    s3_client = get_client(client_pool, 's3', region)
+
+    requests = s3_client.list_objects_v2(**get_reader_list_args(reader)).get("Contents", [])
+    add_listed_request_keys(reader, requests, in_flight_keys)
+
+
+# returns the arguments of the list_objects_v2 call that lists the s3 reader's next page
+def get_reader_list_args(reader: dict) -> dict:
+    list_args = {"Bucket": reader["BUCKET"], "MaxKeys": S3_MAX_LIST_KEYS}
+    if reader["CURSOR"] is not None:
+        list_args["StartAfter"] = reader["CURSOR"]
+    return list_args
+
+
+# moves the s3 reader's cursor past the listed requests, and queues the keys that aren't in flight or cooling down
+# to be downloaded
+def add_listed_request_keys(reader: dict, requests: list[dict], in_flight_keys: set) -> None:
+    reader["CURSOR"] = requests[-1]["Key"] if requests else None
+    reader["EXHAUSTED"] = not requests
+    cooling_keys = get_cooling_keys(reader.get("REQUEST_RETRIES"))
+    reader["KEYS"].extend(obj["Key"] for obj in requests
+                          if obj["Key"] not in in_flight_keys and obj["Key"] not in cooling_keys
+                          and in_partition(obj["Key"], reader["PARTITION"]))
+
+
+# retrieves the next request from the s3 reader, keeping up to the reader's prefetch count of requests
+# downloading ahead of the consumer. If no request is found, returns None
+def get_request_s3_prefetched(logger, reader: dict, region: str, client_pool: dict,
+                              in_flight_keys: set) -> dict[str: str]:
+    while True:
+        with reader["LOCK"]:
+            # after reaching the end of the bucket, the next listing waits until the downloads are used up
+            if not reader["KEYS"] and (not reader["FETCHES"]
+                                       or (not reader["EXHAUSTED"] and len(reader["FETCHES"]) < reader["PREFETCH"])):
+                list_request_keys_s3(reader, region, client_pool, in_flight_keys)
+
+            while reader["KEYS"] and len(reader["FETCHES"]) < reader["PREFETCH"]:
+                request_key = reader["KEYS"].popleft()
+                in_flight_keys.add(request_key)
+                reader["FETCHES"].append((request_key, reader["EXECUTOR"].submit(
+                    fetch_request_s3, reader["BUCKET"], request_key, region, client_pool)))
+
+            if not reader["FETCHES"]:
+                return None
+            request_key, fetch = reader["FETCHES"].popleft()
+
+        request = fetch.result()
+        if request is not None:
+            logger.debug("Retrieved request '%s' from s3 bucket '%s'", request.get('widgetId'), reader['BUCKET'])
+            return request
+
+        # the request was deleted after it was listed
+        in_flight_keys.discard(request_key)
+
+
+# stops the s3 reader's downloads. Requests that were downloaded but not handed out stay in the bucket
+def close_s3_reader(reader: dict) -> None:
+    with reader["LOCK"]:
+        reader["KEYS"].clear()
+        for _, fetch in reader["FETCHES"]:
+            fetch.cancel()
+        reader["FETCHES"].clear()
+    if reader["EXECUTOR"] is not None:
+        reader["EXECUTOR"].shutdown(wait=True)
+
+
+# yields (key, text) for every request stored in a local directory (one json request per request file, in file name
+# order), a jsonl file or stdin ("-", as jsonl). Lines are keyed by their line number
+def read_local_request_sources(path: str):
+    if os.path.isdir(path):
+        for file_name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, file_name)
+            if os.path.isfile(file_path) and is_request_file(file_name):
+                with open(file_path) as request_file:
+                    yield file_name, request_file.read()
+        return
+
+    request_file = sys.stdin if path == "-" else open(path)
+    try:
+        for line_number, line in enumerate(request_file, start=1):
+            if line.strip():
+                yield str(line_number), line
+    finally:
+        if request_file is not sys.stdin:
+            request_file.close()
+
+
+# checks if a file in a directory of request files holds a request: request files are named like the sample requests
+# (without an extension) or end in .json. Hidden files and files of other types, e.g. a .jsonl file, are left alone
+def is_request_file(file_name: str) -> bool:
+    if file_name.startswith("."):
+        return False
+    extension = os.path.splitext(file_name)[1]
+    return extension in ("", ".json")
+
+
+# lazily reads and parses the requests stored at the given local path, see read_local_request_sources. Requests that
+# aren't json objects are skipped. If a partition is given, only requests for widgets in the partition are read, so
+# every request for a widget is read by the same process, in order. Requests without a widgetId are partitioned by key
+def read_local_requests(logger, path: str, partition: tuple[int, int] = None):
+    for request_key, request_str in read_local_request_sources(path):
+        try:
+            request = json.loads(request_str)
+        except json.JSONDecodeError:
+            if in_partition(request_key, partition):
+                logger.warning(f"Request '{request_key}' in '{path}' is not valid json, skipping this request...")
+            continue
+        if not isinstance(request, dict):
+            if in_partition(request_key, partition):
+                logger.warning(f"Request '{request_key}' in '{path}' is not a json object, skipping this request...")
+            continue
+        if not in_partition(str(request.get('widgetId', request_key)), partition):
+            continue
+
+        request['key'] = request_key
+        logger.debug("Retrieved request '%s' from '%s'", request.get('widgetId'), path)
+        yield request
 
 
-# retrieves a request from an sqs queue. If no request is found, returns None
-def get_request_sqs(logger, sqs_queue: str, region: str) -> dict[str: str]:
-    sqs_client = boto3.client('sqs', region_name=region)
+# retrieves a request from an sqs queue, waiting up to wait_time seconds for one to arrive (long polling).
+# If no request is found, returns None
+def get_request_sqs(logger, sqs_queue: str, region: str, client_pool: dict = None,
+                    wait_time: int = 0) -> dict[str: str]:
+    sqs_client = get_client(client_pool, 'sqs', region)
 
     try:
-        response = sqs_client.receive_message(QueueUrl=sqs_queue, VisibilityTimeout=5)
+        response = sqs_client.receive_message(QueueUrl=sqs_queue, VisibilityTimeout=5, WaitTimeSeconds=wait_time,
+                                              AttributeNames=["SentTimestamp"])
         if 'Messages' not in response:
             return None
         request_str = response["Messages"][0]["Body"]
         request = json.loads(request_str)
 
         request['receipt_handle'] = response["Messages"][0]["ReceiptHandle"]
+        if "SentTimestamp" in response["Messages"][0].get("Attributes", {}):
+            request['sent_timestamp'] = int(response["Messages"][0]["Attributes"]["SentTimestamp"])
     except sqs_client.exceptions.InvalidAddress:
         logger.warning(f"'{sqs_queue}' is an invalid URL, unable to retrieve requests.")
         return None
     except IndexError:
         return None
 
-    logger.debug(f"Retrieved request '{request['widgetId']}' from SQS Queue '{sqs_queue}'")
+    logger.debug("Retrieved request '%s' from SQS Queue '%s'", request.get('widgetId'), sqs_queue)
     return request
 
 
-# wrapper method for saving a widget
-def save_widget(logger, widget_obj: dict[str: str], widget_loc: dict[str: str], region: str) -> None:
-    if widget_loc["WIDGET_BUCKET"]:
-        save_to_s3(logger, widget_obj, widget_loc["WIDGET_BUCKET"], region)
+# creates the in-memory buffers used to receive requests from and acknowledge requests to an sqs queue in batches.
+# The asyncio backend refills the buffer with up to receives receive calls at once
+def create_sqs_buffer(batch_size: int = SQS_MAX_BATCH_SIZE, wait_time: int = 20, visibility_timeout: int = 5,
+                      receives: int = 1) -> dict:
+    batch_size = max(1, min(batch_size, SQS_MAX_BATCH_SIZE))
+    receives = max(1, min(receives, SQS_MAX_CONCURRENT_RECEIVES))
+    return {
+        "BATCH_SIZE": batch_size,
+        "WAIT_TIME": wait_time,
+        "RECEIVES": receives,
+        # buffered messages wait on the ones received before them, so every message gets the time of a whole refill
+        "VISIBILITY_TIMEOUT": min(visibility_timeout * batch_size * receives, SQS_MAX_VISIBILITY_TIMEOUT),
+        "MESSAGES": collections.deque(),
+        "PENDING_DELETES": [],
+        "LOCK": threading.RLock()
+    }
+
+
+# retrieves a request from the sqs buffer, refilling it with one long polling receive call when it is empty.
+# If no request is found, returns None
+def get_request_sqs_batched(logger, sqs_queue: str, region: str, sqs_buffer: dict,
+                            client_pool: dict = None) -> dict[str: str]:
+    with sqs_buffer["LOCK"]:
+        if not sqs_buffer["MESSAGES"]:
+            # acknowledge the previous batch before asking for a new one, so deletes never outlive their visibility
+            flush_sqs_deletes(logger, sqs_queue, region, sqs_buffer, client_pool)
+
+            sqs_client = get_client(client_pool, 'sqs', region)
+            try:
+                response = sqs_client.receive_message(QueueUrl=sqs_queue,
+                                                      MaxNumberOfMessages=sqs_buffer["BATCH_SIZE"],
+                                                      WaitTimeSeconds=sqs_buffer["WAIT_TIME"],
+                                                      VisibilityTimeout=sqs_buffer["VISIBILITY_TIMEOUT"],
+                                                      AttributeNames=["SentTimestamp"])
+            except sqs_client.exceptions.InvalidAddress:
+                logger.warning(f"'{sqs_queue}' is an invalid URL, unable to retrieve requests.")
+                return None
+
+            sqs_buffer["MESSAGES"].extend(response.get("Messages", []))
+            logger.debug("Received %s requests from SQS Queue '%s'", len(sqs_buffer['MESSAGES']), sqs_queue)
+
+        if not sqs_buffer["MESSAGES"]:
+            return None
+        message = sqs_buffer["MESSAGES"].popleft()
+
+    request = parse_sqs_message(message)
+    logger.debug("Retrieved request '%s' from SQS Queue '%s'", request.get('widgetId'), sqs_queue)
+    return request
+
+
+# parses the request in a received sqs message, keeping what is needed to delete it and to order it
+def parse_sqs_message(message: dict) -> dict[str: str]:
+    request = json.loads(message["Body"])
+    request['receipt_handle'] = message["ReceiptHandle"]
+    if "SentTimestamp" in message.get("Attributes", {}):
+        request['sent_timestamp'] = int(message["Attributes"]["SentTimestamp"])
+    return request
+
+
+# deletes every buffered request from an sqs queue using batched deletes. Entries that fail on the sqs side are
+# retried, entries rejected as the sender's fault (e.g. an expired receipt handle) will be redelivered by sqs.
+def flush_sqs_deletes(logger, sqs_queue: str, region: str, sqs_buffer: dict, client_pool: dict = None) -> None:
+    run_client_calls(flush_sqs_deletes_calls(logger, sqs_queue, sqs_buffer, get_metrics(client_pool)), region,
+                     client_pool)
+
+
+# makes the client calls of flush_sqs_deletes, see run_client_calls
+def flush_sqs_deletes_calls(logger, sqs_queue: str, sqs_buffer: dict, metrics: dict):
+    with sqs_buffer["LOCK"]:
+        pending_deletes, sqs_buffer["PENDING_DELETES"] = sqs_buffer["PENDING_DELETES"], []
+
+    for start in range(0, len(pending_deletes), SQS_MAX_BATCH_SIZE):
+        batch = pending_deletes[start:start + SQS_MAX_BATCH_SIZE]
+        request_ids = {str(i): request_id for i, (request_id, _) in enumerate(batch)}
+        entries = [{"Id": str(i), "ReceiptHandle": receipt_handle} for i, (_, receipt_handle) in enumerate(batch)]
+
+        for _ in range(SQS_DELETE_RETRIES + 1):
+            response = yield "sqs", "delete_message_batch", {"QueueUrl": sqs_queue, "Entries": entries}
+            entries = get_retryable_sqs_deletes(logger, sqs_queue, entries, request_ids, response)
+            if not entries:
+                break
+            increment_counter(metrics, "consumer_batch_retries_total", len(entries), service="sqs",
+                              operation="DeleteMessageBatch")
+
+        for entry in entries:
+            logger.warning(f"Gave up deleting request {request_ids[entry['Id']]} from sqs queue {sqs_queue}, "
+                           f"it may be redelivered.")
+
+
+# logs the outcome of a delete_message_batch call, and returns the entries that failed on the sqs side
+def get_retryable_sqs_deletes(logger, sqs_queue: str, entries: list[dict], request_ids: dict[str: str],
+                              response: dict) -> list[dict]:
+    for success in response.get("Successful", []):
+        logger.debug("Deleted Request %s from sqs queue %s.", request_ids[success['Id']], sqs_queue)
+
+    failed_ids = set()
+    for failure in response.get("Failed", []):
+        if failure.get("SenderFault"):
+            logger.warning(f"Could not delete request {request_ids[failure['Id']]} from sqs queue "
+                           f"{sqs_queue} ({failure.get('Code')}), it may be redelivered.")
+        else:
+            failed_ids.add(failure["Id"])
+
+    return [entry for entry in entries if entry["Id"] in failed_ids]
+
+
+# wrapper method for saving a widget. If the widget is buffered, request_data is the request it was built from.
+# Widgets the widget cache knows to be stored exactly like this already aren't written again. If partial is set, the
+# widget only holds the attributes to change, and unbuffered dynamodb tables only get those attributes written
+def save_widget(logger, widget_obj: dict[str: str], widget_loc: dict[str: str], region: str,
+                client_pool: dict = None, request_data: dict[str: str] = None, partial: bool = False) -> None:
+    run_client_calls(save_widget_calls(logger, widget_obj, widget_loc, get_metrics(client_pool), request_data, partial),
+                     region, client_pool, widget_loc.get("REPLICATION_EXECUTOR"))
+
+
+# makes the client calls of save_widget, see run_client_calls. A dual widget location is written to the dynamodb table
+# in the calling thread and to the s3 bucket on the replication executor, so saving takes as long as the slower one.
+# Both get the whole widget, partial dynamodb updates aren't used so the two copies stay the same
+def save_widget_calls(logger, widget_obj: dict[str: str], widget_loc: dict[str: str], metrics: dict,
+                      request_data: dict[str: str] = None, partial: bool = False):
+    widget_cache = widget_loc.get("WIDGET_CACHE")
+    widget_known, cached_widget = get_cached_widget(widget_cache, widget_obj["widgetId"])
+    if widget_known and cached_widget == widget_obj:
+        increment_counter(metrics, "consumer_widget_cache_total", result="write-skipped")
+        logger.debug("Widget %s is already stored, skipping the write", widget_obj['widgetId'])
+        if widget_loc.get("WRITE_BUFFER") is not None and request_data is not None:
+            buffer_request(widget_loc["WRITE_BUFFER"], request_data)
+        return
+
+    write_buffer = widget_loc.get("WRITE_BUFFER")
+    if write_buffer is not None:
+        if write_buffer["TABLE"] is None:
+            write_request = {"PutRequest": {"Widget": widget_obj}}
+        else:
+            write_request = {"PutRequest": {"Item": create_dynamodb_item(widget_obj)}}
+        buffer_write(write_buffer, widget_obj["widgetId"], write_request, request_data)
+        logger.debug("Buffered widget %s for '%s'", widget_obj['widgetId'],
+                     write_buffer['TABLE'] or write_buffer['BUCKET'])
+    elif widget_loc["WIDGET_BUCKET"] and widget_loc["DYNAMODB_TABLE"]:
+        yield [save_to_dynamodb_calls(logger, widget_obj, widget_loc["DYNAMODB_TABLE"]),
+               save_to_s3_calls(logger, widget_obj, widget_loc["WIDGET_BUCKET"],
+                                widget_loc.get("WIDGET_CODEC", "json"))]
+    elif widget_loc["WIDGET_BUCKET"]:
+        yield from save_to_s3_calls(logger, widget_obj, widget_loc["WIDGET_BUCKET"],
+                                    widget_loc.get("WIDGET_CODEC", "json"))
+    elif partial and widget_loc.get("DYNAMODB_PARTIAL_UPDATES", False):
+        # the stored widget now mixes old and new attributes, so its state is no longer known
+        widget_exists = yield from update_widget_dynamodb_calls(logger, widget_obj, widget_loc["DYNAMODB_TABLE"])
+        invalidate_widget(widget_cache, widget_obj["widgetId"])
+        if not widget_exists:
+            cache_widget(widget_cache, widget_obj["widgetId"], None)
+        return
     else:
-        save_to_dynamodb(logger, widget_obj, widget_loc["DYNAMODB_TABLE"], region)
+        yield from save_to_dynamodb_calls(logger, widget_obj, widget_loc["DYNAMODB_TABLE"])
+    cache_widget(widget_cache, widget_obj["widgetId"], widget_obj)
 
 
-# saves the given widget object into an s3 bucket. If the widget already exists, this method overwrites it.
-def save_to_s3(logger, widget_obj: dict[str: str], bucket_name: str, region: str) -> None:
-    s3_client = boto3.client('s3', region_name=region)
+# saves the given widget object into an s3 bucket, encoded with the given codec. If the widget already exists, this
+# method overwrites it, unless only_new is set. Returns whether the widget was written
+def save_to_s3(logger, widget_obj: dict[str: str], bucket_name: str, region: str, client_pool: dict = None,
+               codec: str = "json", only_new: bool = False) -> bool:
+    return run_client_calls(save_to_s3_calls(logger, widget_obj, bucket_name, codec, only_new), region, client_pool)
 
-    bucket_owner = widget_obj['owner'].replace(" ", "-").lower()
-    widget_path = f"widgets/{bucket_owner}/{widget_obj['widgetId']}"
 
-    widget = json.dumps(widget_obj)
-    s3_client.put_object(Bucket=bucket_name, Key=widget_path, Body=widget)
+# makes the client calls of save_to_s3, see run_client_calls
+def save_to_s3_calls(logger, widget_obj: dict[str: str], bucket_name: str, codec: str = "json",
+                     only_new: bool = False):
+    widget_path = get_widget_path(widget_obj)
+
+    widget, metadata = encode_widget(widget_obj, codec)
+    put_args = {"Bucket": bucket_name, "Key": widget_path, "Body": widget, "Metadata": metadata}
+    if only_new:
+        put_args["IfNoneMatch"] = "*"
+    try:
+        yield 's3', 'put_object', put_args
+    except botocore.exceptions.ClientError as error:
+        # a conflict means another conditional write of the widget is in progress, so it exists too
+        if not only_new or not is_client_error(error, "PreconditionFailed", "ConditionalRequestConflict"):
+            raise
+        logger.debug("Widget %s already exists in s3 bucket '%s'", widget_obj['widgetId'], bucket_name)
+        return False
+
+    logger.debug("Uploaded widget in s3 bucket '%s' in '%s' as '%s' (%s, %s bytes)", bucket_name, widget_path,
+                 widget_obj['widgetId'], codec, len(widget))
+    return True
 
-    logger.debug(f"Uploaded widget in s3 bucket '{bucket_name}' in '{widget_path}' as '{widget_obj['widgetId']}.json'")
 
+# retrieves and decodes the widget stored under the given key of an s3 bucket. If the widget doesn't exist, returns
+# None
+def fetch_widget_s3(bucket_name: str, widget_path: str, region: str, client_pool: dict = None) -> dict[str: str]:
+    s3_client = get_client(client_pool, 's3', region)
 
-# saves the given widget object into a dynamodb table. if the widget already exists, this method overwrites it.
-def save_to_dynamodb(logger, widget_obj: dict[str: str], table_name: str, region: str) -> None:
-    dynamodb_client = boto3.client("dynamodb", region_name=region)
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=widget_path)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return decode_widget(response["Body"].read(), response.get("Metadata"))
 
+
+# returns the widget codecs whose libraries are installed
+def get_available_codecs() -> list[str]:
+    unavailable = {"zstd"} if zstandard is None else set()
+    if msgpack is None:
+        unavailable.add("msgpack")
+    return [codec for codec in WIDGET_CODECS if codec not in unavailable]
+
+
+# encodes a widget for storage in s3 with the given codec: compact json, gzip or zstd compressed compact json, or
+# msgpack. Returns the encoded widget and the object metadata recording the codec
+def encode_widget(widget_obj: dict[str: str], codec: str = "json") -> tuple[bytes, dict[str: str]]:
+    if codec == "msgpack":
+        body = msgpack.packb(widget_obj)
+    else:
+        body = json.dumps(widget_obj, separators=(",", ":")).encode("utf-8")
+        if codec == "gzip":
+            # without a timestamp, the same widget is always encoded the same way
+            body = gzip.compress(body, compresslevel=6, mtime=0)
+        elif codec == "zstd":
+            body = zstandard.ZstdCompressor().compress(body)
+        elif codec != "json":
+            raise ValueError(f"Unknown widget codec '{codec}'")
+    return body, {WIDGET_CODEC_METADATA: codec}
+
+
+# decodes a widget stored in s3 with the codec recorded in its object metadata
+def decode_widget(body: bytes, metadata: dict[str: str] = None) -> dict[str: str]:
+    codec = (metadata or {}).get(WIDGET_CODEC_METADATA, "json")
+    if codec == "msgpack":
+        return msgpack.unpackb(body)
+    if codec == "gzip":
+        body = gzip.decompress(body)
+    elif codec == "zstd":
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif codec != "json":
+        raise ValueError(f"Unknown widget codec '{codec}'")
+    return json.loads(body)
+
+
+# saves the given widget object into a dynamodb table. if the widget already exists, this method overwrites it, unless
+# only_new is set. Returns whether the widget was written
+def save_to_dynamodb(logger, widget_obj: dict[str: str], table_name: str, region: str,
+                     client_pool: dict = None, only_new: bool = False) -> bool:
+    return run_client_calls(save_to_dynamodb_calls(logger, widget_obj, table_name, only_new), region, client_pool)
+
+
+# makes the client calls of save_to_dynamodb, see run_client_calls
+def save_to_dynamodb_calls(logger, widget_obj: dict[str: str], table_name: str, only_new: bool = False):
+    item_dict = create_dynamodb_item(widget_obj)
+    put_args = {"TableName": table_name, "Item": item_dict}
+    if only_new:
+        put_args["ConditionExpression"] = "attribute_not_exists(id)"
+    try:
+        yield "dynamodb", "put_item", put_args
+    except botocore.exceptions.ClientError as error:
+        if not only_new or not is_client_error(error, "ConditionalCheckFailedException"):
+            raise
+        logger.debug("Widget %s already exists in '%s' table", widget_obj['widgetId'], table_name)
+        return False
+
+    logger.debug("Uploaded widget in '%s' table as %s", table_name, widget_obj['widgetId'])
+    return True
+
+
+# updates the attributes of a stored widget in a dynamodb table with update_item, leaving its other attributes as they
+# are. The update is conditional on the widget existing, so missing widgets are not created. Returns whether the
+# widget existed
+def update_widget_dynamodb(logger, widget_obj: dict[str: str], table_name: str, region: str,
+                           client_pool: dict = None) -> bool:
+    return run_client_calls(update_widget_dynamodb_calls(logger, widget_obj, table_name), region, client_pool)
+
+
+# makes the client calls of update_widget_dynamodb, see run_client_calls
+def update_widget_dynamodb_calls(logger, widget_obj: dict[str: str], table_name: str):
+    update_args = create_dynamodb_update_args(widget_obj, table_name)
+    try:
+        yield "dynamodb", "update_item", update_args
+    except botocore.exceptions.ClientError as error:
+        if not is_client_error(error, "ConditionalCheckFailedException"):
+            raise
+        logger.warning(f"Could not update widget '{widget_obj['widgetId']}', widget does not exist.")
+        return False
+
+    logger.debug("Updated widget %s in '%s' table", widget_obj['widgetId'], table_name)
+    return True
+
+
+# builds the arguments of the update_item call that sets a widget's attributes on its stored item, leaving the
+# attributes the widget doesn't have as they are. Empty values are stored like any other value. The update only
+# applies to widgets that exist
+def create_dynamodb_update_args(widget_obj: dict[str: str], table_name: str) -> dict:
+    item_dict = create_dynamodb_item(widget_obj)
+    item_key = {"id": item_dict.pop("id")}
+    attr_names, attr_values, set_actions = {}, {}, []
+    for i, (attr, value) in enumerate(item_dict.items()):
+        attr_names[f"#a{i}"] = attr
+        attr_values[f":v{i}"] = value
+        set_actions.append(f"#a{i} = :v{i}")
+
+    update_args = {"TableName": table_name, "Key": item_key, "ConditionExpression": "attribute_exists(id)"}
+    if set_actions:
+        update_args.update(UpdateExpression="SET " + ", ".join(set_actions), ExpressionAttributeNames=attr_names,
+                           ExpressionAttributeValues=attr_values)
+    return update_args
+
+
+# converts a widget object into a dynamodb item, flattening its other attributes into the item. Other attributes named
+# like the key attribute (id) are skipped, they would replace the widget's id
+def create_dynamodb_item(widget_obj: dict[str: str]) -> dict[str: dict[str: str]]:
     item_dict = {
         "id": {'S': widget_obj["widgetId"]}
     }
@@ -164,102 +1451,1866 @@ def save_to_dynamodb(logger, widget_obj: dict[str: str], table_name: str, region
         for attr_pair in widget_obj["otherAttributes"]:
             key = attr_pair['name']
             value = attr_pair['value']
+            if key == "id":
+                continue
 
             item_dict[key] = {"S": value}
 
-    dynamodb_client.put_item(TableName=table_name, Item=item_dict)
-    logger.debug(f"Uploaded widget in '{table_name}' table as {widget_obj['widgetId']}")
+    return item_dict
 
 
-# deletes a request from an s3 queue or SQS Queue.
-def delete_request(logger, request_data: dict[str: str], request_loc: dict["str": str], region: str) -> None:
-    if request_loc["REQUEST_BUCKET"]:
-        bucket = request_loc["REQUEST_BUCKET"]
-        key = request_data["key"]
+# turns an item of a dynamodb table back into the widget it was created from. Attributes that aren't part of the
+# widget schema are returned as otherAttributes, in the order of the item. Returns None if the item can't have been
+# created from a widget: it has no owner, or an attribute that isn't a string
+def create_widget_from_item(item_dict: dict[str: dict[str: str]]) -> dict[str: str]:
+    if "id" not in item_dict or "owner" not in item_dict or any(list(value) != ["S"] for value in item_dict.values()):
+        return None
 
-        s3_client = boto3.client('s3', region_name=region)
-        s3_client.delete_object(Bucket=bucket, Key=key)
-        logger.debug(f"Deleted Request {request_data['requestId']} from s3 bucket {bucket}.")
-    else:
-        sqs_client = boto3.client('sqs', region_name=region)
-        queue_url = request_loc['REQUEST_QUEUE']
-        request_key = request_data['receipt_handle']
+    widget_obj = {"widgetId": item_dict["id"]["S"]}
+    other_attributes = []
+    for attr, value in item_dict.items():
+        if attr == "id":
+            continue
+        if attr in WIDGET_ATTRIBUTES:
+            widget_obj[attr] = value["S"]
+        else:
+            other_attributes.append({"name": attr, "value": value["S"]})
+
+    if other_attributes:
+        widget_obj["otherAttributes"] = other_attributes
+    return widget_obj
+
+
+# creates a write-behind buffer that collects widget writes for a dynamodb table and sends them with
+# batch_write_item. Writes to the same widget within one flush are coalesced, so only the last one is sent.
+# Requests are only deleted from their request location once the writes they caused have been flushed. Widgets that
+# could not be written are removed from the given widget cache. If a bucket is given instead of a table, widgets are
+# written to it in the aggregated layout: one segment object and index delta per owner and flush, plus an index per
+# owner the deltas are merged into at compaction
+def create_write_buffer(table_name: str, max_wait: float = 1.0, widget_cache: dict = None, bucket_name: str = None,
+                        codec: str = "json") -> dict:
+    return {
+        "TABLE": table_name,
+        "BUCKET": bucket_name,
+        "CODEC": codec,
+        "MAX_BATCH": DYNAMODB_MAX_BATCH_SIZE if table_name else S3_SEGMENT_MAX_WIDGETS,
+        "MAX_WAIT": max_wait,
+        "WIDGET_CACHE": widget_cache,
+        # owner path -> segment index, for the aggregated s3 layout
+        "INDEXES": {},
+        # widgetId -> (write request, requests that led to it)
+        "WRITES": collections.OrderedDict(),
+        "FLUSHING": {},
+        # requests that didn't cause a write, e.g. deletes of missing widgets
+        "REQUESTS": [],
+        "OLDEST_WRITE": None,
+        "LOCK": threading.Lock(),
+        # only one flush may run at a time, so writes to a widget can never be sent out of order
+        "FLUSH_LOCK": threading.Lock()
+    }
+
+
+# adds a PutRequest or DeleteRequest for a widget to the write buffer, replacing any write for it not yet flushed.
+# The request that caused the write is deleted once the write has been flushed
+def buffer_write(write_buffer: dict, widget_id: str, write_request: dict, request: dict[str: str] = None) -> None:
+    with write_buffer["LOCK"]:
+        _, requests = write_buffer["WRITES"].pop(widget_id, (None, []))
+        if request is not None:
+            requests.append(request)
+        write_buffer["WRITES"][widget_id] = (write_request, requests)
+        if write_buffer["OLDEST_WRITE"] is None:
+            write_buffer["OLDEST_WRITE"] = time.monotonic()
+
+
+# returns the latest buffered or currently flushing write for a widget, or None if there is none
+def get_buffered_write(write_buffer: dict, widget_id: str) -> dict:
+    with write_buffer["LOCK"]:
+        pending_write = write_buffer["WRITES"].get(widget_id) or write_buffer["FLUSHING"].get(widget_id)
+        return pending_write[0] if pending_write is not None else None
+
+
+# adds a processed request that didn't cause a write to the write buffer, to be deleted at the next flush
+def buffer_request(write_buffer: dict, request: dict[str: str]) -> None:
+    with write_buffer["LOCK"]:
+        write_buffer["REQUESTS"].append(request)
+
+
+# checks if the write buffer holds a full batch, or if its oldest write has waited long enough
+def is_flush_due(write_buffer: dict) -> bool:
+    with write_buffer["LOCK"]:
+        if len(write_buffer["WRITES"]) >= write_buffer["MAX_BATCH"]:
+            return True
+        oldest_write = write_buffer["OLDEST_WRITE"]
+        if oldest_write is not None and time.monotonic() - oldest_write >= write_buffer["MAX_WAIT"]:
+            return True
+        return len(write_buffer["REQUESTS"]) > 0 and not write_buffer["WRITES"]
+
+
+# writes every buffered write to dynamodb or s3, then deletes the requests whose writes were stored. Requests for
+# widgets whose write could not be stored are kept in their request location, so they are processed again
+def flush_write_buffer(logger, write_buffer: dict, request_loc: dict[str: str], region: str,
+                       client_pool: dict = None) -> None:
+    with write_buffer["FLUSH_LOCK"]:
+        with write_buffer["LOCK"]:
+            writes, write_buffer["WRITES"] = write_buffer["WRITES"], collections.OrderedDict()
+            requests, write_buffer["REQUESTS"] = write_buffer["REQUESTS"], []
+            write_buffer["FLUSHING"] = writes
+            write_buffer["OLDEST_WRITE"] = None
+
+        try:
+            failed_ids = set()
+            write_items = [(widget_id, write_request) for widget_id, (write_request, _) in writes.items()]
+            if write_buffer["TABLE"] is None:
+                failed_ids = write_segments_s3(logger, write_buffer, dict(write_items), region, client_pool)
+            else:
+                for start in range(0, len(write_items), DYNAMODB_MAX_BATCH_SIZE):
+                    batch = dict(write_items[start:start + DYNAMODB_MAX_BATCH_SIZE])
+                    failed_ids |= batch_write_dynamodb(logger, batch, write_buffer["TABLE"], region, client_pool)
+        finally:
+            with write_buffer["LOCK"]:
+                write_buffer["FLUSHING"] = {}
+
+    for widget_id, (_, write_requests) in writes.items():
+        if widget_id in failed_ids:
+            logger.error(f"Widget '{widget_id}' could not be written, keeping its {len(write_requests)} requests.")
+            invalidate_widget(write_buffer.get("WIDGET_CACHE"), widget_id)
+            for request in write_requests:
+                release_request(request_loc, request)
+        else:
+            requests.extend(write_requests)
+
+    for request in requests:
+        delete_request(logger, request, request_loc, region, client_pool)
+
+
+# sends one batch of widget writes to a dynamodb table, retrying unprocessed writes with exponential backoff.
+# Returns the ids of the widgets that could not be written
+def batch_write_dynamodb(logger, writes: dict[str: dict], table_name: str, region: str,
+                         client_pool: dict = None) -> set[str]:
+    dynamodb_client = get_client(client_pool, "dynamodb", region)
+    write_requests = list(writes.values())
+
+    for attempt in range(DYNAMODB_BATCH_RETRIES + 1):
+        if attempt > 0:
+            backoff = min(DYNAMODB_BACKOFF_BASE * 2 ** attempt, DYNAMODB_BACKOFF_MAX)
+            time.sleep(random.uniform(backoff / 2, backoff))
+
+        response = dynamodb_client.batch_write_item(RequestItems={table_name: write_requests})
+        write_requests = response.get("UnprocessedItems", {}).get(table_name, [])
+        logger.debug("Wrote %s widgets in '%s' table", len(writes) - len(write_requests), table_name)
+        if not write_requests:
+            return set()
+        increment_counter(get_metrics(client_pool), "consumer_batch_retries_total", len(write_requests),
+                          service="dynamodb", operation="BatchWriteItem")
+        # unprocessed items are how batch writes get throttled
+        record_backend_throttle(client_pool.get("RATE_CONTROLLER") if client_pool is not None else None, "dynamodb")
+
+    failed_ids = set()
+    for write_request in write_requests:
+        if "PutRequest" in write_request:
+            failed_ids.add(write_request["PutRequest"]["Item"]["id"]["S"])
+        else:
+            failed_ids.add(write_request["DeleteRequest"]["Key"]["id"]["S"])
+    return failed_ids
+
+
+# returns the segment index of an owner in the aggregated s3 layout, loading it from the bucket the first time. The
+# caller must hold the flush lock of the write buffer, so the index isn't changed by a flush while it is read
+def get_segment_index(write_buffer: dict, owner_path: str, region: str, client_pool: dict = None) -> dict:
+    index = write_buffer["INDEXES"].get(owner_path)
+    if index is None:
+        index = load_segment_index(write_buffer["BUCKET"], owner_path, region, client_pool)
+        write_buffer["INDEXES"][owner_path] = index
+    return index
+
+
+# reads the segment index of an owner in the aggregated s3 layout. The index maps the id of every stored widget of
+# the owner to the segment, offset and length of its latest state, and the key of every segment to its size. It is
+# stored as a base index plus the deltas written by the flushes since the last compaction, which are applied in order.
+# Deltas numbered below the base's next segment were already merged into it
+def load_segment_index(bucket_name: str, owner_path: str, region: str, client_pool: dict = None) -> dict:
+    s3_client = get_client(client_pool, 's3', region)
+
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=f"{owner_path}/index")
+        index = json.loads(response["Body"].read())
+    except s3_client.exceptions.NoSuchKey:
+        index = {"next_segment": 0, "segments": {}, "widgets": {}}
+    index["deltas"] = []
+
+    list_args = {"Bucket": bucket_name, "Prefix": f"{owner_path}/deltas/"}
+    while True:
+        response = s3_client.list_objects_v2(**list_args)
+        for delta_object in response.get("Contents", []):
+            delta_key = delta_object["Key"]
+            if int(delta_key.rsplit("/", 1)[1]) < index["next_segment"]:
+                continue
+            delta = json.loads(s3_client.get_object(Bucket=bucket_name, Key=delta_key)["Body"].read())
+            apply_index_delta(index, delta, delta_key)
+        if not response.get("IsTruncated"):
+            return index
+        list_args["ContinuationToken"] = response["NextContinuationToken"]
+
+
+# applies a delta of the aggregated s3 layout to an index: the delta's segments are added, and its widgets point at
+# their new location, or are removed if their location is None
+def apply_index_delta(index: dict, delta: dict, delta_key: str) -> None:
+    index["segments"].update(delta["segments"])
+    for widget_id, location in delta["widgets"].items():
+        if location is None:
+            index["widgets"].pop(widget_id, None)
+        else:
+            index["widgets"][widget_id] = location
+    index["deltas"].append(delta_key)
+    index["next_segment"] = int(delta_key.rsplit("/", 1)[1]) + 1
+
+
+# writes the changes a flush made to the index of an owner in the aggregated s3 layout as a new delta object, then
+# applies them to the cached index. Only the delta is written, the base index is only rewritten at compaction
+def save_index_delta(write_buffer: dict, owner_path: str, index: dict, delta: dict, region: str,
+                     client_pool: dict = None) -> None:
+    # a delta written by a flush that failed later is overwritten by the next one
+    delta_key = f"{owner_path}/deltas/{index['next_segment']:012d}"
+    s3_client = get_client(client_pool, 's3', region)
+    s3_client.put_object(Bucket=write_buffer["BUCKET"], Key=delta_key,
+                         Body=json.dumps(delta, separators=(",", ":")).encode("utf-8"))
+    apply_index_delta(index, delta, delta_key)
+
+
+# writes the base index of an owner in the aggregated s3 layout, which all deltas written so far are merged into, and
+# makes it the cached index of its owner
+def save_segment_index(write_buffer: dict, owner_path: str, index: dict, region: str,
+                       client_pool: dict = None) -> None:
+    base_index = {"next_segment": index["next_segment"], "segments": index["segments"], "widgets": index["widgets"]}
+    s3_client = get_client(client_pool, 's3', region)
+    s3_client.put_object(Bucket=write_buffer["BUCKET"], Key=f"{owner_path}/index",
+                         Body=json.dumps(base_index, separators=(",", ":")).encode("utf-8"))
+    write_buffer["INDEXES"][owner_path] = dict(base_index, deltas=[])
+
+
+# writes widgets of one owner as the given segment of the aggregated s3 layout. Returns the key and size of the
+# segment, and the location of every widget in it
+def put_widget_segment(write_buffer: dict, owner_path: str, widgets: dict[str: dict], segment: int, region: str,
+                       client_pool: dict = None) -> tuple[str, int, dict[str: list]]:
+    # a segment written by a flush whose delta was never saved is overwritten by the next one
+    segment_key = f"{owner_path}/segments/{segment:012d}"
+    records, locations, offset = [], {}, 0
+    for widget_id, widget_obj in widgets.items():
+        record, metadata = encode_widget(widget_obj, write_buffer["CODEC"])
+        records.append(record)
+        locations[widget_id] = [segment_key, offset, len(record)]
+        offset += len(record)
+
+    s3_client = get_client(client_pool, 's3', region)
+    s3_client.put_object(Bucket=write_buffer["BUCKET"], Key=segment_key, Body=b"".join(records),
+                         Metadata={WIDGET_CODEC_METADATA: write_buffer["CODEC"]})
+    return segment_key, offset, locations
+
+
+# sends the buffered writes of a flush to the aggregated s3 layout: the widgets put by each owner go to one new
+# segment, then the changes to the index of the owner are written as one delta. Returns the ids of the widgets that
+# could not be written
+def write_segments_s3(logger, write_buffer: dict, writes: dict[str: dict], region: str,
+                      client_pool: dict = None) -> set[str]:
+    owner_writes = collections.defaultdict(dict)
+    for widget_id, write_request in writes.items():
+        if "PutRequest" in write_request:
+            owner = write_request["PutRequest"]["Widget"]["owner"]
+        else:
+            owner = write_request["DeleteRequest"]["Owner"]
+        owner_writes[get_owner_path(owner)][widget_id] = write_request
+
+    failed_ids = set()
+    for owner_path, write_requests in owner_writes.items():
+        try:
+            index = get_segment_index(write_buffer, owner_path, region, client_pool)
+            widgets = {widget_id: write_request["PutRequest"]["Widget"]
+                       for widget_id, write_request in write_requests.items() if "PutRequest" in write_request}
+            delta = {"segments": {}, "widgets": {widget_id: None for widget_id, write_request in write_requests.items()
+                                                 if "DeleteRequest" in write_request}}
+            if widgets:
+                segment_key, size, locations = put_widget_segment(write_buffer, owner_path, widgets,
+                                                                  index["next_segment"], region, client_pool)
+                delta["segments"][segment_key] = size
+                delta["widgets"].update(locations)
+            save_index_delta(write_buffer, owner_path, index, delta, region, client_pool)
+        except botocore.exceptions.ClientError:
+            logger.exception(f"Could not write {len(write_requests)} widgets of '{owner_path}' to s3 bucket "
+                             f"'{write_buffer['BUCKET']}'.")
+            failed_ids |= set(write_requests)
+            continue
+        logger.debug("Wrote %s widgets and deleted %s widgets of '%s' in s3 bucket '%s'", len(widgets),
+                     len(write_requests) - len(widgets), owner_path, write_buffer['BUCKET'])
+    return failed_ids
+
+
+# reads a widget from the aggregated s3 layout with a ranged get of its segment. Returns None if the widget does not
+# exist
+def fetch_aggregated_widget_s3(bucket_name: str, owner: str, widget_id: str, region: str,
+                               client_pool: dict = None) -> dict[str: str]:
+    index = load_segment_index(bucket_name, get_owner_path(owner), region, client_pool)
+    if widget_id not in index["widgets"]:
+        return None
+
+    segment_key, offset, length = index["widgets"][widget_id]
+    s3_client = get_client(client_pool, 's3', region)
+    response = s3_client.get_object(Bucket=bucket_name, Key=segment_key, Range=f"bytes={offset}-{offset + length - 1}")
+    return decode_widget(response["Body"].read(), response.get("Metadata"))
+
+
+# merges the index deltas of an owner into its base index, and rewrites the live widgets of the segments that are
+# mostly deleted or overwritten widgets, or too small once the owner has too many segments, into one new segment,
+# then deletes the merged deltas and old segments. Returns the number of segments deleted
+def compact_widget_segments(logger, write_buffer: dict, owner_path: str, region: str,
+                            client_pool: dict = None) -> int:
+    with write_buffer["FLUSH_LOCK"]:
+        current_index = get_segment_index(write_buffer, owner_path, region, client_pool)
+        live_bytes = collections.Counter()
+        for segment_key, _, length in current_index["widgets"].values():
+            live_bytes[segment_key] += length
+
+        segments = current_index["segments"]
+        sparse = {segment_key for segment_key, size in segments.items()
+                  if live_bytes[segment_key] < size * S3_COMPACTION_THRESHOLD}
+        compacted = set(sparse)
+        if len(segments) > S3_MAX_SEGMENTS:
+            compacted |= {segment_key for segment_key, size in segments.items() if size < S3_SEGMENT_TARGET_SIZE}
+        # rewriting a single segment that isn't sparse wouldn't free anything
+        if not sparse and len(compacted) < 2:
+            compacted = set()
+        if not compacted and not current_index["deltas"]:
+            return 0
+
+        s3_client = get_client(client_pool, 's3', region)
+        widgets = {}
+        for segment_key in sorted(compacted):
+            if not live_bytes[segment_key]:
+                continue
+            response = s3_client.get_object(Bucket=write_buffer["BUCKET"], Key=segment_key)
+            segment, metadata = response["Body"].read(), response.get("Metadata")
+            for widget_id, (widget_segment, offset, length) in current_index["widgets"].items():
+                if widget_segment == segment_key:
+                    widgets[widget_id] = decode_widget(segment[offset:offset + length], metadata)
+
+        index = {"next_segment": current_index["next_segment"],
+                 "segments": {segment_key: size for segment_key, size in segments.items()
+                              if segment_key not in compacted},
+                 "widgets": dict(current_index["widgets"])}
+        if widgets:
+            segment_key, size, locations = put_widget_segment(write_buffer, owner_path, widgets,
+                                                              index["next_segment"], region, client_pool)
+            index["segments"][segment_key] = size
+            index["widgets"].update(locations)
+            index["next_segment"] += 1
+        # the old deltas and segments are only deleted once the base index no longer needs them
+        save_segment_index(write_buffer, owner_path, index, region, client_pool)
+        for object_key in current_index["deltas"] + sorted(compacted):
+            s3_client.delete_object(Bucket=write_buffer["BUCKET"], Key=object_key)
+
+    logger.debug("Merged %s index deltas of '%s'", len(current_index['deltas']), owner_path)
+    if compacted:
+        logger.info(f"Compacted {len(compacted)} segments of '{owner_path}' into one with {len(widgets)} widgets")
+    return len(compacted)
+
+
+# starts a background thread compacting the segments of every owner the write buffer has written to, every interval
+# seconds. Returns the compaction, which stop_segment_compaction stops
+def start_segment_compaction(logger, write_buffer: dict, region: str, client_pool: dict, interval: float) -> dict:
+    compaction = {"STOP_EVENT": threading.Event()}
+
+    def compact_segments():
+        while not compaction["STOP_EVENT"].wait(interval):
+            for owner_path in list(write_buffer["INDEXES"]):
+                try:
+                    compact_widget_segments(logger, write_buffer, owner_path, region, client_pool)
+                except botocore.exceptions.ClientError:
+                    logger.exception(f"Could not compact the segments of '{owner_path}'.")
+
+    compaction["THREAD"] = threading.Thread(target=compact_segments, name="segment-compaction", daemon=True)
+    compaction["THREAD"].start()
+    return compaction
+
+
+# stops compacting segments, waiting for a compaction that is running to finish
+def stop_segment_compaction(compaction: dict) -> None:
+    compaction["STOP_EVENT"].set()
+    compaction["THREAD"].join()
+
+
+# deletes a request from an s3 queue or SQS Queue. Requests read from local files are not deleted
+def delete_request(logger, request_data: dict[str: str], request_loc: dict["str": str], region: str,
+                   client_pool: dict = None) -> None:
+    run_client_calls(delete_request_calls(logger, request_data, request_loc, get_metrics(client_pool)), region,
+                     client_pool)
+
+
+# makes the client calls of delete_request, see run_client_calls
+def delete_request_calls(logger, request_data: dict[str: str], request_loc: dict["str": str], metrics: dict):
+    with timed_stage(metrics, "delete-request", request_type_label(request_data)):
+        if request_loc.get("REQUEST_FILES"):
+            # local requests are archives, so they are kept
+            mark_request_processed(request_loc.get("DEDUPE_CACHE"), request_data['requestId'])
+        elif request_loc["REQUEST_BUCKET"]:
+            bucket = request_loc["REQUEST_BUCKET"]
+            key = request_data["key"]
+
+            yield 's3', 'delete_object', {"Bucket": bucket, "Key": key}
+            if request_loc.get("IN_FLIGHT_KEYS") is not None:
+                request_loc["IN_FLIGHT_KEYS"].discard(key)
+            clear_request_failures(request_loc.get("REQUEST_RETRIES"), key)
+            mark_request_processed(request_loc.get("DEDUPE_CACHE"), request_data['requestId'])
+            logger.debug("Deleted Request %s from s3 bucket %s.", request_data['requestId'], bucket)
+        else:
+            queue_url = request_loc['REQUEST_QUEUE']
+            request_key = request_data['receipt_handle']
+
+            mark_request_processed(request_loc.get("DEDUPE_CACHE"), request_data['requestId'])
+            if request_loc.get("VISIBILITY_EXTENDER") is not None:
+                untrack_message(request_loc["VISIBILITY_EXTENDER"], request_key)
+
+            sqs_buffer = request_loc.get("SQS_BUFFER")
+            if sqs_buffer is not None:
+                with sqs_buffer["LOCK"]:
+                    sqs_buffer["PENDING_DELETES"].append((request_data['requestId'], request_key))
+                    batch_full = len(sqs_buffer["PENDING_DELETES"]) >= SQS_MAX_BATCH_SIZE
+                if batch_full:
+                    yield from flush_sqs_deletes_calls(logger, queue_url, sqs_buffer, metrics)
+                return
+
+            yield 'sqs', 'delete_message', {"QueueUrl": queue_url, "ReceiptHandle": request_key}
+            logger.debug("Deleted Request %s from sqs queue %s.", request_data['requestId'], queue_url)
+
+
+# creates a cache of the ids of processed requests, so requests delivered more than once are only processed once.
+# Up to max_size ids are kept in memory for ttl seconds. If a store path is given, ids are also kept in an sqlite
+# database there, so they are remembered across runs and shared by consumer processes
+def create_dedupe_cache(max_size: int = DEDUPE_CACHE_SIZE, ttl: float = DEDUPE_TTL, store_path: str = None) -> dict:
+    store = None
+    if store_path is not None:
+        store = sqlite3.connect(store_path, timeout=30, check_same_thread=False)
+        store.execute("PRAGMA journal_mode=WAL")
+        store.execute("CREATE TABLE IF NOT EXISTS processed_requests "
+                      "(request_id TEXT PRIMARY KEY, processed_at REAL NOT NULL)")
+        store.commit()
+
+    return {
+        "MAX_SIZE": max_size,
+        "TTL": ttl,
+        # requestId -> time it was processed, oldest first
+        "PROCESSED": collections.OrderedDict(),
+        # requests currently being processed
+        "IN_FLIGHT": set(),
+        "STORE": store,
+        "LOCK": threading.Lock()
+    }
+
+
+# checks if a request was already processed or is being processed right now. Returns "processed", "in-flight" or
+# None if the request is new. Does nothing if dedupe_cache is None
+def check_duplicate_request(dedupe_cache: dict, request_id: str) -> str:
+    if dedupe_cache is None:
+        return None
+
+    with dedupe_cache["LOCK"]:
+        if request_id in dedupe_cache["IN_FLIGHT"]:
+            return "in-flight"
+
+        expired_before = time.time() - dedupe_cache["TTL"]
+        processed_at = dedupe_cache["PROCESSED"].get(request_id)
+        if processed_at is not None:
+            if processed_at >= expired_before:
+                return "processed"
+            del dedupe_cache["PROCESSED"][request_id]
+
+        if dedupe_cache["STORE"] is not None:
+            row = dedupe_cache["STORE"].execute(
+                "SELECT 1 FROM processed_requests WHERE request_id = ? AND processed_at >= ?",
+                (request_id, expired_before)).fetchone()
+            if row is not None:
+                return "processed"
+    return None
+
+
+# marks a request as being processed, so copies of it delivered in the meantime are skipped
+def mark_request_in_flight(dedupe_cache: dict, request_id: str) -> None:
+    if dedupe_cache is None:
+        return
+    with dedupe_cache["LOCK"]:
+        dedupe_cache["IN_FLIGHT"].add(request_id)
+
+
+# marks a request as processed, forgetting the oldest processed requests once the cache is full
+def mark_request_processed(dedupe_cache: dict, request_id: str) -> None:
+    if dedupe_cache is None:
+        return
+
+    processed_at = time.time()
+    with dedupe_cache["LOCK"]:
+        dedupe_cache["IN_FLIGHT"].discard(request_id)
+        dedupe_cache["PROCESSED"][request_id] = processed_at
+        dedupe_cache["PROCESSED"].move_to_end(request_id)
+        while len(dedupe_cache["PROCESSED"]) > dedupe_cache["MAX_SIZE"]:
+            dedupe_cache["PROCESSED"].popitem(last=False)
+
+        if dedupe_cache["STORE"] is not None:
+            dedupe_cache["STORE"].execute("INSERT OR REPLACE INTO processed_requests VALUES (?, ?)",
+                                          (request_id, processed_at))
+            dedupe_cache["STORE"].commit()
+
+
+# removes expired ids from the on-disk store and closes it
+def close_dedupe_cache(dedupe_cache: dict) -> None:
+    with dedupe_cache["LOCK"]:
+        if dedupe_cache["STORE"] is not None:
+            dedupe_cache["STORE"].execute("DELETE FROM processed_requests WHERE processed_at < ?",
+                                          (time.time() - dedupe_cache["TTL"],))
+            dedupe_cache["STORE"].commit()
+            dedupe_cache["STORE"].close()
+            dedupe_cache["STORE"] = None
+
+
+# creates an extender that keeps sqs requests hidden while they are processed, so slow requests aren't delivered
+# again. Every tracked message is made invisible for another visibility_timeout seconds when half of its current
+# timeout has passed, with batched change_message_visibility calls made from a background thread
+def create_visibility_extender(logger, sqs_queue: str, region: str, visibility_timeout: int,
+                               client_pool: dict = None) -> dict:
+    extender = {
+        "QUEUE": sqs_queue,
+        "VISIBILITY_TIMEOUT": min(visibility_timeout, SQS_MAX_VISIBILITY_TIMEOUT),
+        # receipt handle -> (requestId, time the message's visibility is extended next)
+        "MESSAGES": {},
+        "LOCK": threading.Lock(),
+        "STOP_EVENT": threading.Event()
+    }
+
+    def extend_visibility():
+        while not extender["STOP_EVENT"].wait(extender["VISIBILITY_TIMEOUT"] / 4):
+            extend_message_visibility(logger, extender, region, client_pool)
+
+    extender["THREAD"] = threading.Thread(target=extend_visibility, name="visibility-extender", daemon=True)
+    extender["THREAD"].start()
+    return extender
+
+
+# starts extending the visibility of a received message
+def track_message(extender: dict, request_id: str, receipt_handle: str) -> None:
+    with extender["LOCK"]:
+        extender["MESSAGES"][receipt_handle] = (request_id, time.monotonic() + extender["VISIBILITY_TIMEOUT"] / 2)
+
+
+# stops extending the visibility of a message, e.g. because it was deleted
+def untrack_message(extender: dict, receipt_handle: str) -> None:
+    with extender["LOCK"]:
+        extender["MESSAGES"].pop(receipt_handle, None)
+
+
+# extends the visibility of every tracked message whose extension is due
+def extend_message_visibility(logger, extender: dict, region: str, client_pool: dict = None) -> None:
+    now = time.monotonic()
+    with extender["LOCK"]:
+        due_messages = [(receipt_handle, request_id) for receipt_handle, (request_id, extend_at)
+                        in extender["MESSAGES"].items() if extend_at <= now]
+        for receipt_handle, request_id in due_messages:
+            extender["MESSAGES"][receipt_handle] = (request_id, now + extender["VISIBILITY_TIMEOUT"] / 2)
+    if not due_messages:
+        return
+
+    sqs_client = get_client(client_pool, 'sqs', region)
+    for start in range(0, len(due_messages), SQS_MAX_BATCH_SIZE):
+        batch = due_messages[start:start + SQS_MAX_BATCH_SIZE]
+        entries = [{"Id": str(i), "ReceiptHandle": receipt_handle, "VisibilityTimeout": extender["VISIBILITY_TIMEOUT"]}
+                   for i, (receipt_handle, _) in enumerate(batch)]
+        try:
+            response = sqs_client.change_message_visibility_batch(QueueUrl=extender["QUEUE"], Entries=entries)
+        except botocore.exceptions.ClientError:
+            logger.exception(f"Could not extend the visibility of {len(batch)} requests in sqs queue "
+                             f"{extender['QUEUE']}.")
+            continue
+        for failure in response.get("Failed", []):
+            logger.warning(f"Could not extend the visibility of request {batch[int(failure['Id'])][1]} "
+                           f"({failure.get('Code')}), it may be delivered again.")
+        logger.debug("Extended the visibility of %s requests in sqs queue %s.", len(batch), extender['QUEUE'])
+
+
+# stops extending the visibility of messages
+def stop_visibility_extender(extender: dict) -> None:
+    extender["STOP_EVENT"].set()
+    extender["THREAD"].join()
+
+
+# marks a fetched request as being processed: duplicates of it are skipped, and if it came from an sqs queue, it is
+# kept hidden until it is deleted or released
+def begin_request(request_loc: dict[str: str], request: dict[str: str]) -> None:
+    mark_request_in_flight(request_loc.get("DEDUPE_CACHE"), request['requestId'])
+    if request_loc.get("VISIBILITY_EXTENDER") is not None and 'receipt_handle' in request:
+        track_message(request_loc["VISIBILITY_EXTENDER"], request['requestId'], request['receipt_handle'])
 
-        sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=request_key)
-        logger.debug(f"Deleted Request {request_data['requestId']} from sqs queue {queue_url}.")
+
+# gives up on a request that could not be processed, leaving it in its request location so it is retried
+def release_request(request_loc: dict[str: str], request: dict[str: str]) -> None:
+    if request.get('key') is not None and request_loc.get("REQUEST_BUCKET"):
+        record_request_failure(request_loc.get("REQUEST_RETRIES"), request['key'])
+    if request_loc.get("IN_FLIGHT_KEYS") is not None:
+        request_loc["IN_FLIGHT_KEYS"].discard(request.get('key'))
+    dedupe_cache = request_loc.get("DEDUPE_CACHE")
+    if dedupe_cache is not None:
+        with dedupe_cache["LOCK"]:
+            dedupe_cache["IN_FLIGHT"].discard(request['requestId'])
+    if request_loc.get("VISIBILITY_EXTENDER") is not None and 'receipt_handle' in request:
+        untrack_message(request_loc["VISIBILITY_EXTENDER"], request['receipt_handle'])
 
 
 # wrapper function that directs the program to do specific things depending on what type the request is
-def process_request(logger, request: dict[str: str], user_info: dict["str": "str"], region: str) -> None:
+def process_request(logger, request: dict[str: str], user_info: dict["str": "str"], region: str,
+                    client_pool: dict = None) -> None:
+    metrics = get_metrics(client_pool)
+    request_type = request_type_label(request)
+
     if request['type'] == 'create':
-        widget = create_widget(logger, request)
-        save_widget(logger, widget, user_info["WIDGET_LOC"], region)
-        delete_request(logger, request, user_info["REQUEST_LOC"], region)
+        with timed_stage(metrics, "transform", request_type):
+            widget = create_widget(logger, request)
+        with timed_stage(metrics, "save", request_type):
+            save_widget(logger, widget, user_info["WIDGET_LOC"], region, client_pool, request)
 
     elif request['type'] == 'update':
-        widget = update_widget(logger, request)
-        save_widget(logger, widget, user_info["WIDGET_LOC"], region)
-        delete_request(logger, request, user_info["REQUEST_LOC"], region)
+        with timed_stage(metrics, "transform", request_type):
+            widget = update_widget(logger, request)
+        with timed_stage(metrics, "save", request_type):
+            save_widget(logger, widget, user_info["WIDGET_LOC"], region, client_pool, request, partial=True)
 
     elif request['type'] == 'delete':
-        delete_widget(logger, request, user_info["WIDGET_LOC"], region)
-        delete_request(logger, request, user_info["REQUEST_LOC"], region)
+        with timed_stage(metrics, "save", request_type):
+            delete_widget(logger, request, user_info["WIDGET_LOC"], region, client_pool)
 
     else:
         logger.warning(f"Widget Type '{request['type']}' is an Invalid Type, Skipping...")
+        increment_counter(metrics, "consumer_requests_total", type=request_type, outcome="skipped")
+        return
 
+    increment_counter(metrics, "consumer_requests_total", type=request_type, outcome="processed")
+
+    # buffered requests are deleted when the buffer is flushed
+    write_buffer = user_info["WIDGET_LOC"].get("WRITE_BUFFER")
+    if write_buffer is not None:
+        if is_flush_due(write_buffer):
+            flush_write_buffer(logger, write_buffer, user_info["REQUEST_LOC"], region, client_pool)
+    else:
+        delete_request(logger, request, user_info["REQUEST_LOC"], region, client_pool)
+
+
+# creates a sequencer that holds requests for up to window seconds after the first pending request for their widget
+# arrived, so requests for one widget that arrive out of order (e.g. an update before its create) are released in
+# the order they were sent. At most max_pending requests are held, the widgets waiting longest are released first
+def create_sequencer(window: float = 1.0, max_pending: int = 1000) -> dict:
+    return {
+        "WINDOW": window,
+        "MAX_PENDING": max_pending,
+        # widgetId -> [(order, request)], and widgetId -> time its requests are released, earliest first
+        "PENDING": {},
+        "RELEASE_TIMES": collections.OrderedDict(),
+        "COUNT": 0,
+        "ARRIVALS": itertools.count()
+    }
+
+
+# returns the key requests for one widget are ordered by: the time an sqs request was sent, or the key of an s3
+# request (sample-requests style keys are timestamps). Numeric keys come before other keys, which are compared as
+# text, so requests with both kinds of keys can still be ordered. Requests sent at the same time are ordered by type,
+# then by arrival
+def get_request_order(request: dict[str: str], arrival: int) -> tuple:
+    if 'sent_timestamp' in request:
+        sent = (0, request['sent_timestamp'])
+    elif 'key' in request and str(request['key']).isdigit():
+        sent = (0, int(request['key']))
+    elif 'key' in request:
+        sent = (1, str(request['key']))
+    else:
+        sent = (0, 0)
+    return sent, REQUEST_TYPE_ORDER.get(request['type'], len(REQUEST_TYPE_ORDER)), arrival
+
+
+# adds a request to the sequencer
+def add_to_sequencer(sequencer: dict, request: dict[str: str]) -> None:
+    widget_id = request['widgetId']
+    sequencer["PENDING"].setdefault(widget_id, []).append(
+        (get_request_order(request, next(sequencer["ARRIVALS"])), request))
+    if widget_id not in sequencer["RELEASE_TIMES"]:
+        sequencer["RELEASE_TIMES"][widget_id] = time.monotonic() + sequencer["WINDOW"]
+    sequencer["COUNT"] += 1
+
+
+# removes and returns the requests whose window has passed, or that no longer fit in the sequencer, ordered per
+# widget. If flush is set, every held request is returned
+def pop_ready_requests(sequencer: dict, flush: bool = False) -> list[dict[str: str]]:
+    now = time.monotonic()
+    ready_requests = []
+    while sequencer["RELEASE_TIMES"]:
+        widget_id, release_time = next(iter(sequencer["RELEASE_TIMES"].items()))
+        if not flush and release_time > now and sequencer["COUNT"] <= sequencer["MAX_PENDING"]:
+            break
+        del sequencer["RELEASE_TIMES"][widget_id]
+        pending = sequencer["PENDING"].pop(widget_id)
+        sequencer["COUNT"] -= len(pending)
+        ready_requests.extend(request for _, request in sorted(pending, key=lambda entry: entry[0]))
+    return ready_requests
+
+
+# returns the number of seconds until the sequencer releases requests, or None if it holds none
+def time_until_release(sequencer: dict) -> float:
+    if not sequencer["RELEASE_TIMES"]:
+        return None
+    return max(0.0, next(iter(sequencer["RELEASE_TIMES"].values())) - time.monotonic())
+
+
+# creates a pool of worker threads that process requests concurrently. Requests are sharded by widgetId, so every
+# request for a widget is handled by the same worker in the order it was received. Each worker holds a bounded
+# queue, so submitting blocks once the pool has max_in_flight requests waiting.
+def create_worker_pool(logger, user_info: dict[str: str], client_pool: dict, workers: int,
+                       max_in_flight: int) -> dict:
+    worker_pool = {
+        "QUEUES": [queue.Queue(maxsize=max(1, max_in_flight // workers)) for _ in range(workers)],
+        "THREADS": []
+    }
+
+    for i, request_queue in enumerate(worker_pool["QUEUES"]):
+        thread = threading.Thread(target=process_request_worker, name=f"consumer-worker-{i}", daemon=True,
+                                  args=(logger, request_queue, user_info, client_pool))
+        thread.start()
+        worker_pool["THREADS"].append(thread)
+
+    return worker_pool
+
+
+# hands a request to the worker responsible for its widget, waiting while that worker's queue is full
+def submit_request(worker_pool: dict, request: dict[str: str]) -> None:
+    shard = zlib.crc32(request['widgetId'].encode("utf-8")) % len(worker_pool["QUEUES"])
+    worker_pool["QUEUES"][shard].put(request)
+
+
+# waits for every submitted request to be processed, then stops the workers
+def shutdown_worker_pool(worker_pool: dict) -> None:
+    for request_queue in worker_pool["QUEUES"]:
+        request_queue.put(None)
+    for thread in worker_pool["THREADS"]:
+        thread.join()
+
+
+# processes requests from the given queue until it receives None. A request that fails is logged and left in its
+# request location, so that it is retried once it becomes visible again
+def process_request_worker(logger, request_queue: queue.Queue, user_info: dict[str: str], client_pool: dict) -> None:
+    while True:
+        request = request_queue.get()
+        if request is None:
+            return
 
-# validates a given request by comparing it to a json schema file
-def is_valid_request(logger, request: dict[str: str]) -> bool:
-    with open("./schemas/request-schema.json") as schema_file:
-        schema = json.load(schema_file)
         try:
-            jsonschema.validate(request, schema)
-            logger.debug(f"Validated Request {request['requestId']}")
-            return True
-        except jsonschema.exceptions.ValidationError:
-            logger.warning(f"Request {request['requestId']} could not be validated, skipping this request...")
+            process_request(logger, request, user_info, user_info["REGION"], client_pool)
+            logger.debug("Fulfilled request '%s'\n", request['requestId'])
+        except Exception:
+            logger.exception(f"Failed to process request '{request['requestId']}'")
+            increment_counter(get_metrics(client_pool), "consumer_requests_total",
+                              type=request_type_label(request), outcome="failed")
+            release_request(user_info["REQUEST_LOC"], request)
+
+
+# loads the json schema file and compiles it into a validator. The validator is cached, so the schema is only
+# read and checked once per schema file
+@functools.lru_cache(maxsize=None)
+def load_request_validator(schema_path: str = REQUEST_SCHEMA_PATH) -> jsonschema.protocols.Validator:
+    with open(schema_path) as schema_file:
+        schema = json.load(schema_file)
+
+    validator_cls = jsonschema.validators.validator_for(schema)
+    validator_cls.check_schema(schema)
+    return validator_cls(schema)
+
+
+# structural check that mirrors request-schema.json. Every request accepted here is also accepted by the schema,
+# requests rejected here still go through the full schema validation to decide.
+def is_well_formed_request(request: dict[str: str]) -> bool:
+    if not isinstance(request, dict):
+        return False
+
+    for attr in ("type", "requestId", "widgetId", "owner"):
+        if not isinstance(request.get(attr), str):
+            return False
+    for attr in ("label", "description"):
+        if attr in request and not isinstance(request[attr], str):
             return False
 
+    if not REQUEST_TYPE_PATTERN.search(request["type"]) or not REQUEST_OWNER_PATTERN.search(request["owner"]):
+        return False
 
-# creates a logger object to log what the program is doing while processing requests
-def create_logger(debug: bool, save_file: str) -> logging.Logger:
+    if "otherAttributes" in request:
+        other_attributes = request["otherAttributes"]
+        if not isinstance(other_attributes, list):
+            return False
+        for attr_pair in other_attributes:
+            if not (isinstance(attr_pair, dict) and isinstance(attr_pair.get("name"), str)
+                    and isinstance(attr_pair.get("value"), str)):
+                return False
+
+    return True
+
+
+# validates a given request by comparing it to the request json schema
+def is_valid_request(logger, request: dict[str: str], validator: jsonschema.protocols.Validator = None) -> bool:
+    if is_well_formed_request(request):
+        logger.debug("Validated Request %s", request['requestId'])
+        return True
+
+    if validator is None:
+        validator = load_request_validator()
+
+    try:
+        validator.validate(request)
+        logger.debug("Validated Request %s", request['requestId'])
+        return True
+    except jsonschema.exceptions.ValidationError:
+        logger.warning(f"Request {request.get('requestId')} could not be validated, skipping this request...")
+        return False
+
+
+# creates a logger object to log what the program is doing while processing requests. If buffered, log lines are
+# handed to a background thread that formats and writes them, so logging doesn't wait on console or disk I/O, and
+# only debug_sample_rate of the debug lines are kept. A logger that is already buffered keeps its thread, only its
+# level is set again
+def create_logger(debug: bool, save_file: str, buffered: bool = False,
+                  debug_sample_rate: float = 1.0) -> logging.Logger:
     logger = logging.getLogger(__name__)
+    if buffered and any(getattr(handler, "listener", None) is not None for handler in logger.handlers):
+        logger.setLevel(logging.DEBUG if debug else logging.INFO)
+        return logger
+
     logformatter = logging.Formatter("{asctime} {levelname} {name}: {message}", style='{')
     consoleHandler = logging.StreamHandler()
     consoleHandler.setFormatter(logformatter)
-    logger.addHandler(consoleHandler)
-
-    logging.basicConfig(
-        filename=save_file,
-        filemode='w',
-        format="{asctime} {levelname} {name}: {message}",
-        style="{",
-        datefmt="%H:%M:%S",
-        level=logging.DEBUG if debug else logging.INFO)
 
+    if not buffered:
+        logger.addHandler(consoleHandler)
+        logging.basicConfig(
+            filename=save_file,
+            filemode='w',
+            format="{asctime} {levelname} {name}: {message}",
+            style="{",
+            datefmt="%H:%M:%S",
+            level=logging.DEBUG if debug else logging.INFO)
+        return logger
+
+    # log lines are only queued by the logging thread, a listener thread formats and writes them
+    log_queue = queue.SimpleQueue()
+    fileHandler = logging.FileHandler(save_file, mode='w')
+    fileHandler.setFormatter(logging.Formatter("{asctime} {levelname} {name}: {message}", datefmt="%H:%M:%S",
+                                               style="{"))
+    # the file is only flushed once the queue is drained, so lines logged in bursts are written together
+    flush_file = fileHandler.flush
+    fileHandler.flush = lambda: flush_file() if log_queue.empty() else None
+
+    queueHandler = logging.handlers.QueueHandler(log_queue)
+    # records never leave the process, so they are queued as they are and formatted by the listener thread
+    queueHandler.prepare = lambda record: record
+    if debug_sample_rate < 1:
+        queueHandler.addFilter(lambda record: record.levelno > logging.DEBUG or random.random() < debug_sample_rate)
+    queueHandler.listener = logging.handlers.QueueListener(log_queue, consoleHandler, fileHandler)
+    queueHandler.listener.start()
+    # lines still queued when the program exits early are written out too, by one hook however often this is called
+    atexit.unregister(stop_logger)
+    atexit.register(stop_logger, logger)
+
+    logger.addHandler(queueHandler)
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    logger.propagate = False
     return logger
 
 
-# continuously looks for requests in the given request location until no requests are found for a given number of times
-def main(user_info: dict[str: str]) -> None:
-    logger = create_logger(debug=user_info["DEBUG"], save_file="./logs/consumer.log")
+# stops the listener thread of a buffered logger once it has written every queued log line
+def stop_logger(logger: logging.Logger) -> None:
+    for handler in list(logger.handlers):
+        listener = getattr(handler, "listener", None)
+        if listener is not None:
+            logger.removeHandler(handler)
+            handler.listener = None
+            listener.stop()
+            for listener_handler in listener.handlers:
+                listener_handler.close()
+
+
+# creates a scheduler that decides when to poll for requests and when to stop. Empty polls back off exponentially
+# with jitter between min_delay and max_delay seconds. Polling stops after more than max_empty_polls empty polls in
+# a row, or after idle_timeout seconds without requests; with neither set, it never stops. If the request source
+# long polls, the source already waits for requests, so empty polls aren't delayed any further
+def create_poll_scheduler(min_delay: float = 0.1, max_delay: float = 10.0, max_empty_polls: int = None,
+                          idle_timeout: float = None, long_polling: bool = False) -> dict:
+    return {
+        "MIN_DELAY": min_delay,
+        "MAX_DELAY": max_delay,
+        "MAX_EMPTY_POLLS": max_empty_polls,
+        "IDLE_TIMEOUT": idle_timeout,
+        "LONG_POLLING": long_polling,
+        "DELAY": 0.0,
+        "EMPTY_POLLS": 0,
+        "IDLE_SINCE": None,
+        # set to stop polling, also wakes up a waiting scheduler
+        "STOP_EVENT": threading.Event()
+    }
 
-    curr_failed_requests = 0
-    while curr_failed_requests <= user_info["MAX_REQUEST_LIMIT"]:
-        request = get_next_request(logger, user_info["REQUEST_LOC"], user_info["REGION"])
+
+# updates the scheduler with the result of a poll
+def record_poll(poll_scheduler: dict, found_request: bool) -> None:
+    if found_request:
+        poll_scheduler["DELAY"] = 0.0
+        poll_scheduler["EMPTY_POLLS"] = 0
+        poll_scheduler["IDLE_SINCE"] = None
+    else:
+        poll_scheduler["DELAY"] = min(poll_scheduler["MAX_DELAY"],
+                                      max(poll_scheduler["MIN_DELAY"], poll_scheduler["DELAY"] * 2))
+        poll_scheduler["EMPTY_POLLS"] += 1
+        if poll_scheduler["IDLE_SINCE"] is None:
+            poll_scheduler["IDLE_SINCE"] = time.monotonic()
+
+
+# waits until the next poll is due, but no longer than max_wait seconds. Returns early if polling is stopped
+def wait_for_next_poll(poll_scheduler: dict, max_wait: float = None) -> None:
+    if poll_scheduler["LONG_POLLING"] or poll_scheduler["DELAY"] <= 0:
+        return
+    delay = random.uniform(poll_scheduler["DELAY"] / 2, poll_scheduler["DELAY"])
+    poll_scheduler["STOP_EVENT"].wait(delay if max_wait is None else min(delay, max_wait))
+
+
+# returns the reason polling should stop, or None if it should continue
+def get_stop_reason(poll_scheduler: dict) -> str:
+    if poll_scheduler["STOP_EVENT"].is_set():
+        return "Stop requested"
+    max_empty_polls = poll_scheduler["MAX_EMPTY_POLLS"]
+    if max_empty_polls is not None and poll_scheduler["EMPTY_POLLS"] > max_empty_polls:
+        return "Max number of failed request polls reached"
+    idle_since = poll_scheduler["IDLE_SINCE"]
+    if poll_scheduler["IDLE_TIMEOUT"] and idle_since is not None \
+            and time.monotonic() - idle_since >= poll_scheduler["IDLE_TIMEOUT"]:
+        return f"No requests found for {poll_scheduler['IDLE_TIMEOUT']} seconds"
+    return None
+
+
+# stops the poll scheduler when the process receives SIGTERM or SIGINT, so requests that were already fetched are
+# finished and deleted before the consumer exits. Returns the previous handlers, which can only be replaced from the
+# main thread; elsewhere nothing is changed
+def handle_stop_signals(poll_scheduler: dict) -> dict:
+    if threading.current_thread() is not threading.main_thread():
+        return {}
+
+    def stop_polling(signum, frame):
+        poll_scheduler["STOP_EVENT"].set()
+
+    return {signum: signal.signal(signum, stop_polling) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+
+# hands a request to the worker pool, or processes it right away if there is none
+def dispatch_request(logger, request: dict[str: str], user_info: dict[str: str], client_pool: dict,
+                     worker_pool: dict = None) -> None:
+    if worker_pool is not None:
+        submit_request(worker_pool, request)
+    else:
+        process_request(logger, request, user_info, user_info["REGION"], client_pool)
+        logger.debug("Fulfilled request '%s'\n", request['requestId'])
+
+
+# validates a fetched request and checks it against the dedupe cache. Returns "process" for a request to process,
+# which is then marked as being processed, "delete" for a copy of a request that was already processed, or "skip".
+# Invalid requests and copies of a request still being processed are left in the request location, where copies are
+# found to be processed once they are delivered again
+def screen_request(logger, request: dict[str: str], request_loc: dict[str: str], validator, metrics: dict) -> str:
+    with timed_stage(metrics, "validate", request_type_label(request)):
+        request_valid = is_valid_request(logger, request, validator)
+    if not request_valid:
+        increment_counter(metrics, "consumer_requests_total", type=request_type_label(request), outcome="invalid")
+        skip_request(request_loc, request)
+        return "skip"
+
+    duplicate = check_duplicate_request(request_loc.get("DEDUPE_CACHE"), request['requestId'])
+    if duplicate is not None:
+        increment_counter(metrics, "consumer_requests_total", type=request_type_label(request), outcome="duplicate")
+        if duplicate == "processed":
+            logger.info(f"Request '{request['requestId']}' was already processed, deleting it.")
+            return "delete"
+        logger.debug("Request '%s' is already being processed, skipping it.", request['requestId'])
+        skip_request(request_loc, request)
+        return "skip"
+
+    begin_request(request_loc, request)
+    return "process"
+
+
+# tells if a poll found a request to work on. Skipped requests stay in a queue or bucket and are delivered again, so
+# there only a request to process counts, and requests skipped on every poll back off and still let the consumer stop.
+# A request file is read once, so any request read from it counts
+def is_found_request(request_loc: dict[str: str], action: str) -> bool:
+    if action is None:
+        return False
+    return action == "process" or request_loc.get("REQUEST_STREAM") is not None
+
+
+# leaves a skipped request in its request location. A request from a request bucket cools down like a failed one
+# before it is fetched again, so a request that is skipped every time isn't fetched over and over
+def skip_request(request_loc: dict[str: str], request: dict[str: str]) -> None:
+    if request.get('key') is None or not request_loc.get("REQUEST_BUCKET"):
+        return
+    record_request_failure(request_loc.get("REQUEST_RETRIES"), request['key'])
+    if request_loc.get("IN_FLIGHT_KEYS") is not None:
+        request_loc["IN_FLIGHT_KEYS"].discard(request['key'])
+
+
+# looks for requests in the request location and processes them until the poll scheduler decides to stop, then
+# finishes the requests that were fetched. Returns the reason polling stopped
+def consume_requests(logger, user_info: dict[str: str], client_pool: dict, validator, poll_scheduler: dict) -> str:
+    request_loc, widget_loc = user_info["REQUEST_LOC"], user_info["WIDGET_LOC"]
+    metrics = get_metrics(client_pool)
+
+    sequencer = None
+    if user_info["SEQUENCE_WINDOW"] > 0:
+        sequencer = create_sequencer(user_info["SEQUENCE_WINDOW"], user_info["MAX_PENDING"])
+    worker_pool = None
+    if user_info["WORKERS"] > 1:
+        worker_pool = create_worker_pool(logger, user_info, client_pool, user_info["WORKERS"],
+                                         user_info["MAX_IN_FLIGHT"])
+
+    while (stop_reason := get_stop_reason(poll_scheduler)) is None:
+        with timed_stage(metrics, "fetch"):
+            request = get_next_request(logger, request_loc, user_info["REGION"], client_pool)
+        increment_counter(metrics, "consumer_polls_total", result="empty" if request is None else "request")
+
+        action = None if request is None else screen_request(logger, request, request_loc, validator, metrics)
+        record_poll(poll_scheduler, is_found_request(request_loc, action))
+        if action == "delete":
+            delete_request(logger, request, request_loc, user_info["REGION"], client_pool)
+        elif action == "process" and sequencer is not None:
+            add_to_sequencer(sequencer, request)
+        elif action == "process":
+            dispatch_request(logger, request, user_info, client_pool, worker_pool)
+
+        if sequencer is not None:
+            for ready_request in pop_ready_requests(sequencer):
+                dispatch_request(logger, ready_request, user_info, client_pool, worker_pool)
+
+        write_buffer = widget_loc.get("WRITE_BUFFER")
+        if write_buffer is not None and (request is None or is_flush_due(write_buffer)):
+            flush_write_buffer(logger, write_buffer, request_loc, user_info["REGION"], client_pool)
+
+        if action != "process":
+            wait_for_next_poll(poll_scheduler, time_until_release(sequencer) if sequencer is not None else None)
+
+    if request_loc.get("S3_READER") is not None:
+        close_s3_reader(request_loc["S3_READER"])
+    if sequencer is not None:
+        for ready_request in pop_ready_requests(sequencer, flush=True):
+            dispatch_request(logger, ready_request, user_info, client_pool, worker_pool)
+    if worker_pool is not None:
+        shutdown_worker_pool(worker_pool)
+    if widget_loc.get("WRITE_BUFFER") is not None:
+        flush_write_buffer(logger, widget_loc["WRITE_BUFFER"], request_loc, user_info["REGION"], client_pool)
+    return stop_reason
+
+
+# creates the asyncio counterpart of a client pool. With aiobotocore installed, its clients are native asyncio clients
+# recording api calls in the client pool's metrics. Without it, the boto3 clients of the client pool are used, with
+# their calls run on up to max_pool_connections threads so they never block the event loop
+def create_async_client_pool(client_pool: dict, max_pool_connections: int = 10, tcp_keepalive: bool = True) -> dict:
+    session, config = None, None
+    if aiobotocore is not None:
+        session = aiobotocore.session.get_session()
+        config = aiobotocore.config.AioConfig(max_pool_connections=max_pool_connections, tcp_keepalive=tcp_keepalive)
+        if get_metrics(client_pool) is not None:
+            register_api_metrics(session, get_metrics(client_pool))
+        if client_pool.get("RATE_CONTROLLER") is not None:
+            register_rate_controller(session, client_pool["RATE_CONTROLLER"], asynchronous=True)
+
+    return {
+        "SESSION": session,
+        "CONFIG": config,
+        "CLIENTS": {},
+        "CLIENT_POOL": client_pool,
+        "METRICS": get_metrics(client_pool),
+        # native clients are closed with the pool, boto3 calls run on the executor
+        "EXIT_STACK": contextlib.AsyncExitStack(),
+        "EXECUTOR": concurrent.futures.ThreadPoolExecutor(max_workers=max_pool_connections,
+                                                          thread_name_prefix="async-io")
+    }
+
+
+# retrieves the client for the given service and region from the async client pool, creating it on first use
+async def get_async_client(async_pool: dict, service: str, region: str):
+    client_key = (service, region)
+    if client_key not in async_pool["CLIENTS"]:
+        if async_pool["SESSION"] is None:
+            client = get_client(async_pool["CLIENT_POOL"], service, region)
+        else:
+            client = await async_pool["EXIT_STACK"].enter_async_context(async_pool["SESSION"].create_client(
+                service, region_name=region, config=async_pool["CONFIG"]))
+        # tasks creating the same client at once keep the first one, the others are closed with the pool
+        async_pool["CLIENTS"].setdefault(client_key, client)
+    return async_pool["CLIENTS"][client_key]
+
+
+# makes an api call with a client of the async client pool. Native asyncio clients (which are async context managers)
+# are awaited, calls of boto3 clients are run on the pool's executor
+async def call_client(async_pool: dict, client, operation: str, **kwargs) -> dict:
+    method = getattr(client, operation)
+    if hasattr(client, "__aenter__"):
+        return await method(**kwargs)
+    return await asyncio.get_running_loop().run_in_executor(async_pool["EXECUTOR"],
+                                                            functools.partial(method, **kwargs))
+
+
+# async counterpart of run_client_calls, making the calls with the clients of the async client pool. Generators yielded
+# as a list run as concurrent tasks. Operations only the threaded backend has can't be run
+async def run_client_calls_async(calls, region: str, async_pool: dict):
+    response, error = None, None
+    while True:
+        try:
+            step = calls.send(response) if error is None else calls.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        response, error = None, None
+        try:
+            if isinstance(step, list):
+                response = await asyncio.gather(*(run_client_calls_async(step_calls, region, async_pool)
+                                                  for step_calls in step), return_exceptions=True)
+                error = next((result for result in response if isinstance(result, BaseException)), None)
+            else:
+                service, operation, kwargs = step
+                client = await get_async_client(async_pool, service, region)
+                response = await call_client(async_pool, client, operation, **kwargs)
+        except Exception as e:
+            error = e
+
+
+# reads the body of a get_object response, which native clients stream asynchronously
+async def read_body(body) -> bytes:
+    content = body.read()
+    return await content if inspect.isawaitable(content) else content
+
+
+# closes the clients of the async client pool and stops its executor
+async def close_async_client_pool(async_pool: dict) -> None:
+    await async_pool["EXIT_STACK"].aclose()
+    async_pool["EXECUTOR"].shutdown(wait=True)
+
+
+# async counterpart of get_next_request. s3 requests are always read through the s3 reader, and sqs requests through
+# the sqs buffer
+async def get_next_request_async(logger, request_loc: dict[str: str], region: str,
+                                 async_pool: dict) -> dict[str: str]:
+    if request_loc.get("REQUEST_STREAM") is not None:
+        return next(request_loc["REQUEST_STREAM"], None)
+    elif request_loc["REQUEST_BUCKET"]:
+        return await get_request_s3_prefetched_async(logger, request_loc["S3_READER"], region, async_pool,
+                                                     request_loc["IN_FLIGHT_KEYS"])
+    else:
+        return await get_request_sqs_async(logger, request_loc["REQUEST_QUEUE"], region, request_loc["SQS_BUFFER"],
+                                           async_pool)
+
+
+# async counterpart of get_request_s3_prefetched, downloading the requests ahead in tasks. Only the consumer loop reads
+# from the reader, so the reader's lock isn't needed
+async def get_request_s3_prefetched_async(logger, reader: dict, region: str, async_pool: dict,
+                                          in_flight_keys: set) -> dict[str: str]:
+    while True:
+        if not reader["KEYS"] and (not reader["FETCHES"]
+                                   or (not reader["EXHAUSTED"] and len(reader["FETCHES"]) < reader["PREFETCH"])):
+            s3_client = await get_async_client(async_pool, 's3', region)
+            response = await call_client(async_pool, s3_client, "list_objects_v2", **get_reader_list_args(reader))
+            add_listed_request_keys(reader, response.get("Contents", []), in_flight_keys)
+
+        while reader["KEYS"] and len(reader["FETCHES"]) < reader["PREFETCH"]:
+            request_key = reader["KEYS"].popleft()
+            in_flight_keys.add(request_key)
+            reader["FETCHES"].append((request_key, asyncio.ensure_future(
+                fetch_request_s3_async(reader["BUCKET"], request_key, region, async_pool))))
+
+        if not reader["FETCHES"]:
+            return None
+        request_key, fetch = reader["FETCHES"].popleft()
+
+        request = await fetch
         if request is not None:
-            if not is_valid_request(logger, request):
+            logger.debug("Retrieved request '%s' from s3 bucket '%s'", request.get('widgetId'), reader['BUCKET'])
+            return request
+
+        # the request was deleted after it was listed
+        in_flight_keys.discard(request_key)
+
+
+# async counterpart of fetch_request_s3
+async def fetch_request_s3_async(bucket_name: str, request_key: str, region: str, async_pool: dict) -> dict[str: str]:
+    s3_client = await get_async_client(async_pool, 's3', region)
+
+    try:
+        response = await call_client(async_pool, s3_client, "get_object", Bucket=bucket_name, Key=request_key)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    object_content = (await read_body(response["Body"])).decode("utf-8")
+
+    request = json.loads(object_content)
+    request['key'] = request_key
+    return request
+
+
+# async counterpart of get_request_sqs_batched. An empty buffer is refilled with the buffer's number of receive calls
+# at once, while the previous requests are deleted. Only the consumer loop receives requests, so the buffer's lock
+# isn't held while receiving
+async def get_request_sqs_async(logger, sqs_queue: str, region: str, sqs_buffer: dict,
+                                async_pool: dict) -> dict[str: str]:
+    if not sqs_buffer["MESSAGES"]:
+        sqs_client = await get_async_client(async_pool, 'sqs', region)
+        receive_args = {"QueueUrl": sqs_queue, "MaxNumberOfMessages": sqs_buffer["BATCH_SIZE"],
+                        "WaitTimeSeconds": sqs_buffer["WAIT_TIME"],
+                        "VisibilityTimeout": sqs_buffer["VISIBILITY_TIMEOUT"], "AttributeNames": ["SentTimestamp"]}
+        try:
+            _, *responses = await asyncio.gather(
+                flush_sqs_deletes_async(logger, sqs_queue, region, sqs_buffer, async_pool),
+                *(call_client(async_pool, sqs_client, "receive_message", **receive_args)
+                  for _ in range(sqs_buffer["RECEIVES"])))
+        except sqs_client.exceptions.InvalidAddress:
+            logger.warning(f"'{sqs_queue}' is an invalid URL, unable to retrieve requests.")
+            return None
+
+        for response in responses:
+            sqs_buffer["MESSAGES"].extend(response.get("Messages", []))
+        logger.debug("Received %s requests from SQS Queue '%s'", len(sqs_buffer['MESSAGES']), sqs_queue)
+
+    if not sqs_buffer["MESSAGES"]:
+        return None
+
+    request = parse_sqs_message(sqs_buffer["MESSAGES"].popleft())
+    logger.debug("Retrieved request '%s' from SQS Queue '%s'", request.get('widgetId'), sqs_queue)
+    return request
+
+
+# async counterpart of flush_sqs_deletes
+async def flush_sqs_deletes_async(logger, sqs_queue: str, region: str, sqs_buffer: dict, async_pool: dict) -> None:
+    await run_client_calls_async(flush_sqs_deletes_calls(logger, sqs_queue, sqs_buffer, get_metrics(async_pool)),
+                                 region, async_pool)
+
+
+# async counterpart of save_widget. Widgets are never buffered; dynamodb write buffers need the sync backend
+async def save_widget_async(logger, widget_obj: dict[str: str], widget_loc: dict[str: str], region: str,
+                            async_pool: dict, partial: bool = False) -> None:
+    await run_client_calls_async(save_widget_calls(logger, widget_obj, widget_loc, get_metrics(async_pool),
+                                                   partial=partial), region, async_pool)
+
+
+# async counterpart of delete_widget
+async def delete_widget_async(logger, request_data: dict[str: str], widget_loc: dict[str: str], region: str,
+                              async_pool: dict) -> None:
+    await run_client_calls_async(delete_widget_calls(logger, request_data, widget_loc, get_metrics(async_pool)),
+                                 region, async_pool)
+
+
+# async counterpart of delete_request. sqs requests are deleted in batches when the request location has an sqs buffer
+async def delete_request_async(logger, request_data: dict[str: str], request_loc: dict[str: str], region: str,
+                               async_pool: dict) -> None:
+    await run_client_calls_async(delete_request_calls(logger, request_data, request_loc, get_metrics(async_pool)),
+                                 region, async_pool)
+
+
+# async counterpart of process_request
+async def process_request_async(logger, request: dict[str: str], user_info: dict[str: str], region: str,
+                                async_pool: dict) -> None:
+    metrics = get_metrics(async_pool)
+    request_type = request_type_label(request)
+
+    if request['type'] == 'create':
+        with timed_stage(metrics, "transform", request_type):
+            widget = create_widget(logger, request)
+        with timed_stage(metrics, "save", request_type):
+            await save_widget_async(logger, widget, user_info["WIDGET_LOC"], region, async_pool)
+
+    elif request['type'] == 'update':
+        with timed_stage(metrics, "transform", request_type):
+            widget = update_widget(logger, request)
+        with timed_stage(metrics, "save", request_type):
+            await save_widget_async(logger, widget, user_info["WIDGET_LOC"], region, async_pool, partial=True)
+
+    elif request['type'] == 'delete':
+        with timed_stage(metrics, "save", request_type):
+            await delete_widget_async(logger, request, user_info["WIDGET_LOC"], region, async_pool)
+
+    else:
+        logger.warning(f"Widget Type '{request['type']}' is an Invalid Type, Skipping...")
+        increment_counter(metrics, "consumer_requests_total", type=request_type, outcome="skipped")
+        return
+
+    increment_counter(metrics, "consumer_requests_total", type=request_type, outcome="processed")
+    await delete_request_async(logger, request, user_info["REQUEST_LOC"], region, async_pool)
+
+
+# creates the asyncio counterpart of a worker pool, which processes every request in its own task. At most
+# max_in_flight tasks run at a time, and the task of a request waits for the task of the request for the same widget
+# before it, so requests for one widget are applied in the order they were submitted
+def create_task_pool(max_in_flight: int) -> dict:
+    return {
+        "SEMAPHORE": asyncio.Semaphore(max(1, max_in_flight)),
+        # widgetId -> task of the last request submitted for the widget
+        "WIDGET_TASKS": {},
+        "TASKS": set()
+    }
+
+
+# starts a task processing the request, waiting while the task pool is full
+async def submit_request_async(logger, task_pool: dict, request: dict[str: str], user_info: dict[str: str],
+                               async_pool: dict) -> None:
+    await task_pool["SEMAPHORE"].acquire()
+    widget_id = request['widgetId']
+    task = asyncio.ensure_future(process_request_task(logger, request, user_info, async_pool,
+                                                      task_pool["WIDGET_TASKS"].get(widget_id)))
+    task_pool["WIDGET_TASKS"][widget_id] = task
+    task_pool["TASKS"].add(task)
+    task.add_done_callback(functools.partial(finish_request_task, task_pool, widget_id))
+
+
+# frees the slot of a finished task in the task pool
+def finish_request_task(task_pool: dict, widget_id: str, task: asyncio.Task) -> None:
+    task_pool["SEMAPHORE"].release()
+    task_pool["TASKS"].discard(task)
+    if task_pool["WIDGET_TASKS"].get(widget_id) is task:
+        del task_pool["WIDGET_TASKS"][widget_id]
+
+
+# waits for every submitted request to be processed
+async def shutdown_task_pool(task_pool: dict) -> None:
+    if task_pool["TASKS"]:
+        await asyncio.wait(list(task_pool["TASKS"]))
+
+
+# processes a request once the task of the previous request for its widget is done. A request that fails is logged
+# and left in its request location, so that it is retried once it becomes visible again
+async def process_request_task(logger, request: dict[str: str], user_info: dict[str: str], async_pool: dict,
+                               previous_task: asyncio.Task = None) -> None:
+    if previous_task is not None:
+        await asyncio.wait([previous_task])
+
+    try:
+        await process_request_async(logger, request, user_info, user_info["REGION"], async_pool)
+        logger.debug("Fulfilled request '%s'\n", request['requestId'])
+    except Exception:
+        logger.exception(f"Failed to process request '{request['requestId']}'")
+        increment_counter(get_metrics(async_pool), "consumer_requests_total", type=request_type_label(request),
+                          outcome="failed")
+        release_request(user_info["REQUEST_LOC"], request)
+
+
+# async counterpart of consume_requests, run as an event loop. Fetching stays sequential, while up to max_in_flight
+# requests are processed at once in tasks of a task pool
+async def consume_requests_async(logger, user_info: dict[str: str], client_pool: dict, validator,
+                                 poll_scheduler: dict) -> str:
+    request_loc, region = user_info["REQUEST_LOC"], user_info["REGION"]
+    metrics = get_metrics(client_pool)
+    async_pool = create_async_client_pool(client_pool, user_info["MAX_POOL_CONNECTIONS"], user_info["TCP_KEEPALIVE"])
+    task_pool = create_task_pool(user_info["MAX_IN_FLIGHT"])
+
+    sequencer = None
+    if user_info["SEQUENCE_WINDOW"] > 0:
+        sequencer = create_sequencer(user_info["SEQUENCE_WINDOW"], user_info["MAX_PENDING"])
+
+    try:
+        while (stop_reason := get_stop_reason(poll_scheduler)) is None:
+            with timed_stage(metrics, "fetch"):
+                request = await get_next_request_async(logger, request_loc, region, async_pool)
+            increment_counter(metrics, "consumer_polls_total", result="empty" if request is None else "request")
+
+            action = None if request is None else screen_request(logger, request, request_loc, validator, metrics)
+            record_poll(poll_scheduler, is_found_request(request_loc, action))
+            if action == "delete":
+                await delete_request_async(logger, request, request_loc, region, async_pool)
+            elif action == "process" and sequencer is not None:
+                add_to_sequencer(sequencer, request)
+            elif action == "process":
+                await submit_request_async(logger, task_pool, request, user_info, async_pool)
+
+            if sequencer is not None:
+                for ready_request in pop_ready_requests(sequencer):
+                    await submit_request_async(logger, task_pool, ready_request, user_info, async_pool)
+
+            if action != "process":
+                # waited for in a thread, so a stop signal still ends the wait right away
+                await asyncio.get_running_loop().run_in_executor(
+                    None, wait_for_next_poll, poll_scheduler,
+                    time_until_release(sequencer) if sequencer is not None else None)
+
+        if request_loc.get("S3_READER") is not None:
+            close_s3_reader(request_loc["S3_READER"])
+        if sequencer is not None:
+            for ready_request in pop_ready_requests(sequencer, flush=True):
+                await submit_request_async(logger, task_pool, ready_request, user_info, async_pool)
+        await shutdown_task_pool(task_pool)
+        if request_loc.get("SQS_BUFFER") is not None:
+            await flush_sqs_deletes_async(logger, request_loc["REQUEST_QUEUE"], region, request_loc["SQS_BUFFER"],
+                                          async_pool)
+    finally:
+        await close_async_client_pool(async_pool)
+    return stop_reason
+
+
+# continuously looks for requests in the given request location until the poll scheduler decides to stop
+def main(user_info: dict[str: str]) -> None:
+    logger = create_logger(debug=user_info["DEBUG"], save_file=user_info["LOG_FILE"],
+                           buffered=user_info["BUFFERED_LOGGING"], debug_sample_rate=user_info["DEBUG_SAMPLE_RATE"])
+    validator = load_request_validator()
+    metrics = create_metrics()
+    # every worker and prefetch download may hold a connection to each service at the same time
+    max_pool_connections = max(user_info["MAX_POOL_CONNECTIONS"], user_info["WORKERS"] + user_info["S3_PREFETCH"])
+    rate_controller = None
+    if user_info["RATE_CONTROL"]:
+        rate_controller = create_rate_controller(max_pool_connections, user_info["RATE_LIMITS"], metrics)
+    client_pool = create_client_pool(max_pool_connections, user_info["TCP_KEEPALIVE"], metrics=metrics,
+                                     rate_controller=rate_controller)
+
+    metrics_server = None
+    if user_info["METRICS_PORT"]:
+        metrics_server = start_metrics_server(metrics, user_info["METRICS_PORT"], user_info["METRICS_HOST"])
+    metrics_dump = None
+    if user_info["METRICS_FILE"]:
+        metrics_dump = start_metrics_dump(metrics, user_info["METRICS_FILE"], user_info["METRICS_INTERVAL"])
+    stats_reports = None
+    if user_info["STATS_QUEUE"] is not None:
+        # the stats of a process that crashes are only known up to its last report
+        stats_reports = start_worker_stats_reports(user_info["STATS_QUEUE"], user_info["WORKER_INDEX"], metrics,
+                                                   SUPERVISOR_STATS_INTERVAL)
+
+    request_loc = user_info["REQUEST_LOC"]
+    # the asyncio backend always receives and deletes sqs requests through the buffer
+    if request_loc["REQUEST_QUEUE"] and (user_info["SQS_BATCH_SIZE"] > 1 or user_info["ASYNC_IO"]):
+        # one receive per batch of tasks keeps the asyncio backend's tasks busy
+        receives = -(-user_info["MAX_IN_FLIGHT"] // user_info["SQS_BATCH_SIZE"]) if user_info["ASYNC_IO"] else 1
+        request_loc["SQS_BUFFER"] = create_sqs_buffer(user_info["SQS_BATCH_SIZE"], request_loc["SQS_WAIT_TIME"],
+                                                      user_info["VISIBILITY_TIMEOUT"], receives)
+    if request_loc["REQUEST_QUEUE"] and user_info["EXTEND_VISIBILITY"]:
+        request_loc["VISIBILITY_EXTENDER"] = create_visibility_extender(logger, request_loc["REQUEST_QUEUE"],
+                                                                        user_info["REGION"],
+                                                                        user_info["VISIBILITY_TIMEOUT"], client_pool)
+    if user_info["DEDUPE_CACHE_SIZE"] > 0:
+        request_loc["DEDUPE_CACHE"] = create_dedupe_cache(user_info["DEDUPE_CACHE_SIZE"], user_info["DEDUPE_TTL"],
+                                                          user_info["DEDUPE_STORE"])
+
+    # local requests never come back once they are used up, daemons never stop polling, otherwise an idle timeout
+    # replaces the limit of empty polls
+    max_empty_polls, idle_timeout = user_info["MAX_REQUEST_LIMIT"], None
+    if request_loc["REQUEST_FILES"]:
+        request_loc["REQUEST_STREAM"] = read_local_requests(logger, request_loc["REQUEST_FILES"],
+                                                            request_loc.get("PARTITION"))
+        max_empty_polls = 0
+    elif user_info["DAEMON"]:
+        max_empty_polls = None
+    elif user_info["IDLE_TIMEOUT"] > 0:
+        max_empty_polls, idle_timeout = None, user_info["IDLE_TIMEOUT"]
+    long_polling = bool(request_loc["REQUEST_QUEUE"]) and request_loc["SQS_WAIT_TIME"] > 0
+    poll_scheduler = create_poll_scheduler(user_info["MIN_POLL_DELAY"], user_info["MAX_POLL_DELAY"], max_empty_polls,
+                                           idle_timeout, long_polling)
+    previous_handlers = handle_stop_signals(poll_scheduler)
+
+    widget_loc = user_info["WIDGET_LOC"]
+    if user_info["WIDGET_CACHE_MB"] > 0:
+        # widgets written by other consumers can only be missed for a bounded time in shared mode
+        widget_cache_ttl = user_info["WIDGET_CACHE_TTL"] if user_info["WIDGET_CACHE_MODE"] == "shared" else None
+        widget_loc["WIDGET_CACHE"] = create_widget_cache(int(user_info["WIDGET_CACHE_MB"] * 1024 * 1024),
+                                                         widget_cache_ttl)
+    if widget_loc["WIDGET_BUCKET"] and widget_loc["DYNAMODB_TABLE"] and not user_info["ASYNC_IO"]:
+        # the s3 copies of widgets are written next to the dynamodb ones, one at a time per worker
+        widget_loc["REPLICATION_EXECUTOR"] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=user_info["WORKERS"], thread_name_prefix="replication")
+    segment_compaction = None
+    if widget_loc["DYNAMODB_TABLE"] and user_info["DYNAMODB_BATCH_WRITES"]:
+        widget_loc["WRITE_BUFFER"] = create_write_buffer(widget_loc["DYNAMODB_TABLE"], user_info["BATCH_WRITE_WAIT"],
+                                                         widget_loc.get("WIDGET_CACHE"))
+    elif widget_loc["WIDGET_BUCKET"] and user_info["S3_LAYOUT"] == "aggregated":
+        widget_loc["WRITE_BUFFER"] = create_write_buffer(None, user_info["BATCH_WRITE_WAIT"],
+                                                         widget_loc.get("WIDGET_CACHE"), widget_loc["WIDGET_BUCKET"],
+                                                         widget_loc.get("WIDGET_CODEC", "json"))
+        if user_info["COMPACTION_INTERVAL"] > 0:
+            segment_compaction = start_segment_compaction(logger, widget_loc["WRITE_BUFFER"], user_info["REGION"],
+                                                          client_pool, user_info["COMPACTION_INTERVAL"])
+
+    if request_loc["REQUEST_BUCKET"]:
+        request_loc["REQUEST_RETRIES"] = create_request_retries()
+    if request_loc["REQUEST_BUCKET"] and (user_info["S3_PREFETCH"] > 0 or user_info["ASYNC_IO"]):
+        # the asyncio backend always downloads requests ahead, as tasks instead of threads
+        request_loc["S3_READER"] = create_s3_reader(request_loc["REQUEST_BUCKET"], user_info["S3_PREFETCH"] or 8,
+                                                    request_loc.get("PARTITION"),
+                                                    threaded=not user_info["ASYNC_IO"],
+                                                    request_retries=request_loc["REQUEST_RETRIES"])
+
+    if request_loc["REQUEST_BUCKET"] and (user_info["WORKERS"] > 1 or user_info["ASYNC_IO"]
+                                          or widget_loc.get("WRITE_BUFFER") is not None
+                                          or request_loc.get("S3_READER") is not None
+                                          or user_info["SEQUENCE_WINDOW"] > 0):
+        # s3 requests stay in the bucket until they are deleted, so keys being worked on must not be fetched again
+        request_loc["IN_FLIGHT_KEYS"] = set()
+
+    if user_info["ASYNC_IO"]:
+        stop_reason = asyncio.run(consume_requests_async(logger, user_info, client_pool, validator, poll_scheduler))
+    else:
+        stop_reason = consume_requests(logger, user_info, client_pool, validator, poll_scheduler)
+    if request_loc.get("SQS_BUFFER") is not None:
+        flush_sqs_deletes(logger, request_loc["REQUEST_QUEUE"], user_info["REGION"], request_loc["SQS_BUFFER"],
+                          client_pool)
+    if request_loc.get("VISIBILITY_EXTENDER") is not None:
+        stop_visibility_extender(request_loc["VISIBILITY_EXTENDER"])
+    if request_loc.get("DEDUPE_CACHE") is not None:
+        close_dedupe_cache(request_loc["DEDUPE_CACHE"])
+    if segment_compaction is not None:
+        stop_segment_compaction(segment_compaction)
+    if widget_loc.get("REPLICATION_EXECUTOR") is not None:
+        widget_loc["REPLICATION_EXECUTOR"].shutdown()
+
+    if metrics_dump is not None:
+        metrics_dump.set()
+        write_metrics_json(metrics, user_info["METRICS_FILE"])
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if stats_reports is not None:
+        stats_reports.set()
+    if user_info["STATS_QUEUE"] is not None:
+        send_worker_stats(user_info["STATS_QUEUE"], user_info["WORKER_INDEX"], metrics)
+
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+    logger.info(f"{stop_reason}, terminating program.")
+    stop_logger(logger)
+
+
+# creates the user info of one consumer process of a fleet. Each process reads its own partition of an s3 request
+# bucket, and gets its own log file, metrics port and metrics file
+def create_worker_info(user_info: dict[str: str], index: int, processes: int, stats_queue) -> dict[str: str]:
+    worker_info = dict(user_info, WORKER_INDEX=index, STATS_QUEUE=stats_queue)
+    worker_info["REQUEST_LOC"] = dict(user_info["REQUEST_LOC"], PARTITION=(index, processes))
+    worker_info["WIDGET_LOC"] = dict(user_info["WIDGET_LOC"])
+
+    log_base, log_ext = os.path.splitext(user_info["LOG_FILE"])
+    worker_info["LOG_FILE"] = f"{log_base}-{index}{log_ext}"
+    if user_info["METRICS_PORT"]:
+        worker_info["METRICS_PORT"] = user_info["METRICS_PORT"] + index
+    if user_info["METRICS_FILE"]:
+        metrics_base, metrics_ext = os.path.splitext(user_info["METRICS_FILE"])
+        worker_info["METRICS_FILE"] = f"{metrics_base}-{index}{metrics_ext}"
+    return worker_info
+
+
+# sends a snapshot of the metrics of a consumer process to its supervisor. Snapshots hold the totals since the process
+# started, so only the last one sent by each process is counted
+def send_worker_stats(stats_queue, index: int, metrics: dict) -> None:
+    stats_queue.put((index, os.getpid(), format_metrics_json(metrics)))
+
+
+# sends a snapshot of the metrics of a consumer process to its supervisor every interval seconds, from a background
+# thread, until the returned event is set
+def start_worker_stats_reports(stats_queue, index: int, metrics: dict, interval: float) -> threading.Event:
+    stop_event = threading.Event()
+
+    def report_stats():
+        while not stop_event.wait(interval):
+            send_worker_stats(stats_queue, index, metrics)
+
+    threading.Thread(target=report_stats, name="stats-reports", daemon=True).start()
+    return stop_event
+
+
+# sums the counters of the metrics snapshots sent by consumer processes, per worker index.
+# Returns {worker index: {(counter name, labels): value}}
+def aggregate_worker_stats(snapshots: list[tuple[int, dict]]) -> dict[int, collections.Counter]:
+    worker_stats = collections.defaultdict(collections.Counter)
+    for index, snapshot in snapshots:
+        for counter in snapshot["counters"]:
+            worker_stats[index][(counter["name"], tuple(sorted(counter["labels"].items())))] += counter["value"]
+    return dict(worker_stats)
+
+
+# logs how many requests each consumer process handled, by outcome, and the totals of the fleet
+def log_worker_stats(logger, worker_stats: dict[int, collections.Counter]) -> None:
+    def count_outcomes(counters):
+        outcomes = collections.Counter()
+        for (name, labels), value in counters.items():
+            if name == "consumer_requests_total":
+                outcomes[dict(labels)["outcome"]] += value
+        return ", ".join(f"{count} {outcome}" for outcome, count in sorted(outcomes.items())) or "no requests"
+
+    for index, counters in sorted(worker_stats.items()):
+        logger.info(f"Consumer process {index}: {count_outcomes(counters)}")
+    logger.info(f"All consumer processes: {count_outcomes(sum(worker_stats.values(), collections.Counter()))}")
+
+
+# starts a consumer process running main with the given user info
+def start_consumer_process(context, worker_info: dict[str: str]) -> multiprocessing.Process:
+    process = context.Process(target=main, args=(worker_info,), name=f"consumer-{worker_info['WORKER_INDEX']}")
+    process.start()
+    return process
+
+
+# runs a fleet of consumer processes against the same request location. Processes that crash are restarted, processes
+# that stop on their own (e.g. when idle) are not. On SIGTERM or SIGINT every process is asked to stop, so each one
+# finishes and deletes the requests it already fetched. Once all processes have stopped, their stats are logged
+def run_supervisor(user_info: dict[str: str], processes: int) -> None:
+    logger = create_logger(debug=user_info["DEBUG"], save_file=user_info["LOG_FILE"])
+    # spawned processes don't inherit the supervisor's logging handlers or signal handlers
+    context = multiprocessing.get_context("spawn")
+    stats_queue = context.Queue()
+    stop_event = threading.Event()
+
+    def stop_workers(signum, frame):
+        logger.info("Stopping consumer processes...")
+        stop_event.set()
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+
+    workers = {}
+    restart_times = {}
+    # (worker index, pid) -> last metrics snapshot sent by the process
+    snapshots = {}
+    previous_handlers = {signum: signal.signal(signum, stop_workers) for signum in (signal.SIGTERM, signal.SIGINT)}
+    for index in range(processes):
+        workers[index] = start_consumer_process(context, create_worker_info(user_info, index, processes, stats_queue))
+    logger.info(f"Started {processes} consumer processes.")
+
+    while workers or (restart_times and not stop_event.is_set()):
+        # stats are read while processes run, a process can't exit while its stats are still waiting to be sent
+        try:
+            index, pid, snapshot = stats_queue.get(timeout=SUPERVISOR_CHECK_INTERVAL)
+            snapshots[(index, pid)] = snapshot
+        except queue.Empty:
+            pass
+
+        for index, process in list(workers.items()):
+            if process.is_alive():
                 continue
+            process.join()
+            del workers[index]
+            if process.exitcode != 0 and not stop_event.is_set():
+                logger.warning(f"Consumer process {index} exited with code {process.exitcode}, restarting it.")
+                restart_times[index] = time.monotonic() + SUPERVISOR_RESTART_DELAY
+
+        for index, restart_time in list(restart_times.items()):
+            if time.monotonic() >= restart_time and not stop_event.is_set():
+                del restart_times[index]
+                workers[index] = start_consumer_process(
+                    context, create_worker_info(user_info, index, processes, stats_queue))
+
+    while True:
+        try:
+            index, pid, snapshot = stats_queue.get_nowait()
+            snapshots[(index, pid)] = snapshot
+        except queue.Empty:
+            break
+
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+    log_worker_stats(logger, aggregate_worker_stats([(index, snapshot)
+                                                     for (index, _), snapshot in snapshots.items()]))
+    logger.info("All consumer processes stopped, terminating program.")
+
+
+# loads the checkpoint of a migration between the given widget locations. It tracks every unit of the migration (a
+# segment of a dynamodb scan or the prefix of an owner in s3) as {"position", "done", "count"}, where position is
+# where to resume reading the unit. If save_file exists the progress saved there is loaded, so an interrupted
+# migration resumes where it stopped. Returns None if save_file belongs to a migration between other locations
+def load_migration_checkpoint(save_file: str, source: str, target: str) -> dict:
+    checkpoint = {
+        "FILE": save_file,
+        "SOURCE": source,
+        "TARGET": target,
+        # the number of segments of a dynamodb scan can't change once it has started
+        "SEGMENTS": None,
+        "UNITS": {},
+        "LOCK": threading.Lock()
+    }
+    if save_file is None or not os.path.exists(save_file):
+        return checkpoint
 
-            process_request(logger, request, user_info, user_info["REGION"])
+    with open(save_file) as checkpoint_file:
+        saved = json.load(checkpoint_file)
+    if saved["source"] != source or saved["target"] != target:
+        return None
+    checkpoint["SEGMENTS"] = saved["segments"]
+    checkpoint["UNITS"] = saved["units"]
+    return checkpoint
+
+
+# records the progress of a unit of a migration, saving the checkpoint to its file if it has one. The file is replaced
+# at once, so an interruption never leaves a partly written checkpoint behind
+def update_migration_checkpoint(checkpoint: dict, unit: str, position, done: bool, count: int) -> None:
+    with checkpoint["LOCK"]:
+        checkpoint["UNITS"][unit] = {"position": position, "done": done, "count": count}
+        if checkpoint["FILE"] is None:
+            return
+        saved = {"source": checkpoint["SOURCE"], "target": checkpoint["TARGET"], "segments": checkpoint["SEGMENTS"],
+                 "units": checkpoint["UNITS"]}
+        with open(checkpoint["FILE"] + ".tmp", "w") as checkpoint_file:
+            json.dump(saved, checkpoint_file)
+        os.replace(checkpoint["FILE"] + ".tmp", checkpoint["FILE"])
+
+
+# reads one segment of a parallel scan of a dynamodb table, a page at a time, starting after the given position (the
+# last key of the page before). Yields (widgets of the page, position after the page), the position is None once the
+# segment has been read. Items that aren't widgets are skipped
+def scan_widgets_dynamodb(logger, table_name: str, segment: int, total_segments: int, region: str,
+                          client_pool: dict = None, position: dict = None):
+    dynamodb_client = get_client(client_pool, "dynamodb", region)
+    while True:
+        scan_args = {"TableName": table_name, "Segment": segment, "TotalSegments": total_segments}
+        if position is not None:
+            scan_args["ExclusiveStartKey"] = position
+        response = dynamodb_client.scan(**scan_args)
+        position = response.get("LastEvaluatedKey")
+
+        widgets = []
+        for item in response.get("Items", []):
+            widget_obj = create_widget_from_item(item)
+            if widget_obj is None:
+                logger.warning(f"Skipped item with key {item.get('id')} of '{table_name}' table, it isn't a widget.")
+            else:
+                widgets.append(widget_obj)
+        yield widgets, position
+        if position is None:
+            return
+
+
+# returns the prefix of every owner with widgets in an s3 bucket
+def list_widget_owners_s3(bucket_name: str, region: str, client_pool: dict = None) -> list[str]:
+    s3_client = get_client(client_pool, 's3', region)
+    list_args = {"Bucket": bucket_name, "Prefix": "widgets/", "Delimiter": "/"}
+    owner_paths = []
+    while True:
+        response = s3_client.list_objects_v2(**list_args)
+        owner_paths.extend(prefix["Prefix"].rstrip("/") for prefix in response.get("CommonPrefixes", []))
+        if not response.get("IsTruncated"):
+            return owner_paths
+        list_args["ContinuationToken"] = response["NextContinuationToken"]
+
+
+# reads the widgets of one owner in an s3 bucket, a page of S3_MAX_LIST_KEYS at a time, starting after the given
+# position (the last key of the page before). The widgets of a page are downloaded concurrently on the executor.
+# Yields (widgets of the page, position after the page), the position is None once the owner has been read
+def list_widgets_s3(bucket_name: str, owner_path: str, region: str, executor: concurrent.futures.Executor,
+                    client_pool: dict = None, position: str = None):
+    s3_client = get_client(client_pool, 's3', region)
+    while True:
+        list_args = {"Bucket": bucket_name, "Prefix": owner_path + "/", "MaxKeys": S3_MAX_LIST_KEYS}
+        if position is not None:
+            list_args["StartAfter"] = position
+        response = s3_client.list_objects_v2(**list_args)
+        widget_paths = [widget["Key"] for widget in response.get("Contents", [])]
+        widgets = executor.map(lambda widget_path: fetch_widget_s3(bucket_name, widget_path, region, client_pool),
+                               widget_paths)
+        # widgets deleted since the listing are skipped
+        widgets = [widget_obj for widget_obj in widgets if widget_obj is not None]
+        position = widget_paths[-1] if response.get("IsTruncated") else None
+        yield widgets, position
+        if position is None:
+            return
+
+
+# writes widgets copied by a migration to the target widget location, one concurrent conditional put per widget. A
+# consumer writing to both locations may have written a newer state of a widget to the target since it was read from
+# the source, so widgets the target already has are skipped. Returns the widgets that were written. Raises if any
+# widget could not be written, so its page is copied again when the migration is resumed
+def write_migrated_widgets(logger, widgets: list[dict], migration: dict, region: str,
+                           client_pool: dict = None) -> list[dict]:
+    if migration["SOURCE"] == "s3":
+        written = migration["EXECUTOR"].map(
+            lambda widget_obj: save_to_dynamodb(logger, widget_obj, migration["DYNAMODB_TABLE"], region, client_pool,
+                                                only_new=True), widgets)
+    else:
+        written = migration["EXECUTOR"].map(
+            lambda widget_obj: save_to_s3(logger, widget_obj, migration["WIDGET_BUCKET"], region, client_pool,
+                                          migration["WIDGET_CODEC"], only_new=True), widgets)
+    return [widget_obj for widget_obj, widget_written in zip(widgets, list(written)) if widget_written]
+
+
+# deletes the widgets a migration wrote to the target again if the source no longer has them. A consumer writing to
+# both locations deletes a widget from both, so the only deleted widgets a migration can copy are those deleted after
+# they were read from the source and before their copy was written; checking the source once they are written finds
+# them. Returns the number of widgets deleted
+def remove_deleted_widgets(logger, widgets: list[dict], migration: dict, region: str,
+                           client_pool: dict = None) -> int:
+    def source_has_widget(widget_obj):
+        if migration["SOURCE"] == "dynamodb":
+            dynamodb_client = get_client(client_pool, "dynamodb", region)
+            response = dynamodb_client.get_item(TableName=migration["DYNAMODB_TABLE"],
+                                                Key={"id": {"S": widget_obj["widgetId"]}}, ProjectionExpression="id")
+            return "Item" in response
+        s3_client = get_client(client_pool, 's3', region)
+        try:
+            s3_client.head_object(Bucket=migration["WIDGET_BUCKET"], Key=get_widget_path(widget_obj))
+        except botocore.exceptions.ClientError as error:
+            if not is_client_error(error, "404", "NoSuchKey", "NotFound"):
+                raise
+            return False
+        return True
 
-            logger.debug(f"Fulfilled request '{request['requestId']}'\n")
-            curr_failed_requests = 0
-        else:
-            curr_failed_requests += 1
+    source_widgets = list(migration["EXECUTOR"].map(source_has_widget, widgets))
+    deleted = [widget_obj for widget_obj, widget_exists in zip(widgets, source_widgets) if not widget_exists]
+    if migration["SOURCE"] == "s3":
+        list(migration["EXECUTOR"].map(lambda widget_obj: delete_widget_dynamodb(
+            logger, widget_obj, migration["DYNAMODB_TABLE"], region, client_pool), deleted))
+    else:
+        list(migration["EXECUTOR"].map(lambda widget_obj: delete_widget_s3(
+            logger, widget_obj, migration["WIDGET_BUCKET"], region, client_pool, blind=True), deleted))
+    return len(deleted)
+
+
+# copies every widget of the source widget location to the other one. Units of the source are read by up to
+# migration["SEGMENTS"] workers at once: the segments of a parallel scan of a dynamodb table, or the owners of an s3
+# bucket. Progress is recorded in the checkpoint after every page, and units it has as done are skipped. Returns the
+# number of widgets the target has from the source, including the ones copied before the migration was resumed and
+# the ones it already had
+def migrate_widgets(logger, migration: dict, checkpoint: dict, region: str, client_pool: dict = None) -> int:
+    if migration["SOURCE"] == "dynamodb":
+        if checkpoint["SEGMENTS"] is None:
+            checkpoint["SEGMENTS"] = migration["SEGMENTS"]
+        units = [str(segment) for segment in range(checkpoint["SEGMENTS"])]
+    else:
+        units = list_widget_owners_s3(migration["WIDGET_BUCKET"], region, client_pool)
 
-    logger.info(f"Max number of failed request polls reached, terminating program.")
+    def migrate_unit(unit):
+        progress = checkpoint["UNITS"].get(unit, {"position": None, "done": False, "count": 0})
+        if progress["done"]:
+            return progress["count"]
+
+        if migration["SOURCE"] == "dynamodb":
+            pages = scan_widgets_dynamodb(logger, migration["DYNAMODB_TABLE"], int(unit), checkpoint["SEGMENTS"],
+                                          region, client_pool, progress["position"])
+        else:
+            pages = list_widgets_s3(migration["WIDGET_BUCKET"], unit, region, migration["EXECUTOR"], client_pool,
+                                    progress["position"])
+        count = progress["count"]
+        for widgets, position in pages:
+            written = write_migrated_widgets(logger, widgets, migration, region, client_pool)
+            deleted = remove_deleted_widgets(logger, written, migration, region, client_pool)
+            count += len(widgets) - deleted
+            update_migration_checkpoint(checkpoint, unit, position, position is None, count)
+            logger.debug("Copied %s widgets of '%s', %s were already copied and %s deleted meanwhile", len(written),
+                         unit, len(widgets) - len(written), deleted)
+        logger.info(f"Copied all {count} widgets of '{unit}'")
+        return count
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=migration["SEGMENTS"],
+                                               thread_name_prefix="migration") as unit_executor:
+        return sum(unit_executor.map(migrate_unit, units))
+
+
+# parses rate limits given as SERVICE=RATE into {service: rate}. Returns None if one of them is invalid
+def parse_rate_limits(rate_limit: tuple[str]) -> dict[str: float]:
+    rate_limits = {}
+    for service_limit in rate_limit:
+        service, _, limit = service_limit.partition("=")
+        if not re.fullmatch(r"\d+(\.\d*)?", limit) or float(limit) <= 0:
+            logging.error(f"Invalid rate limit '{service_limit}'. To see more information, type '--help'.")
+            return None
+        if service not in RATE_CONTROL_SERVICES:
+            logging.error(f"Unknown service '{service}' in rate limit '{service_limit}', expected one of "
+                          f"{', '.join(RATE_CONTROL_SERVICES)}. To see more information, type '--help'.")
+            return None
+        rate_limits[service] = float(limit)
+    return rate_limits
 
 
 # entry point of the program - packages the given user data into a dictionary to be used throughout the program
@@ -267,38 +3318,273 @@ def main(user_info: dict[str: str]) -> None:
 @click.option("--region", help="The region of the aws service instances")
 @click.option("--request-bucket", "-rb", help="Name of the s3 bucket that may contain requests.")
 @click.option("--request-queue", "-rq", help="URL of the SQS queue that may contain requests.")
-@click.option("--widget-bucket", "-wb", help="Name of the s3 bucket that may contain widgets.")
+@click.option("--request-files", "-rf",
+              help="Directory of request files, or jsonl file of requests ('-' for stdin) to import requests from.")
+@click.option("--widget-bucket", "-wb",
+              help="Name of the s3 bucket that may contain widgets. Given with --dynamodb-table, widgets are written "
+                   "to both at once, e.g. while migrating between them.")
 @click.option("--dynamodb-table", "-dbt", help="Name of the dynamodb table that may contain widgets.")
 @click.option("--max-request-limit", "-mrl", default=15,
-              help="The max number of failed request polls before terminating")
+              help="The max number of failed request polls in a row before terminating")
+@click.option("--idle-timeout", "-it", default=0.0,
+              help="If set, terminates after this many seconds without requests instead of counting failed polls.")
+@click.option("--daemon/--no-daemon", default=False,
+              help="If set, keeps polling for requests forever.")
+@click.option("--min-poll-delay", default=0.1,
+              help="The number of seconds waited after the first failed poll, doubling up to the max poll delay.")
+@click.option("--max-poll-delay", default=10.0,
+              help="The max number of seconds waited between failed polls.")
+@click.option("--sqs-batch-size", "-sbs", default=1,
+              help="The max number of requests received from and deleted in one SQS call (1-10).")
+@click.option("--sqs-wait-time", "-swt", type=int, default=None,
+              help="The number of seconds an SQS receive waits for requests to arrive (long polling), 0 to disable. "
+                   "Defaults to 20 with --sqs-batch-size, --async-io or --daemon, and to 0 otherwise.")
+@click.option("--visibility-timeout", "-vt", default=5,
+              help="The number of seconds a received SQS request is hidden for, per request in a batch.")
+@click.option("--extend-visibility/--no-extend-visibility", default=True,
+              help="If set, SQS requests are kept hidden while they are processed, so they aren't delivered again.")
+@click.option("--dedupe-cache-size", "-dcs", default=DEDUPE_CACHE_SIZE,
+              help="The number of processed request ids remembered to skip redelivered requests, 0 to disable.")
+@click.option("--dedupe-ttl", default=DEDUPE_TTL,
+              help="The number of seconds processed request ids are remembered for.")
+@click.option("--dedupe-store", default=None,
+              help="If set, processed request ids are also kept in this sqlite file, shared between processes.")
+@click.option("--sequence-window", "-sw", default=0.0,
+              help="If set, requests are held this many seconds so requests for one widget are applied in order.")
+@click.option("--max-pending", default=1000,
+              help="The max number of requests held for ordering, the ones held longest are released first.")
+@click.option("--s3-prefetch", "-sp", default=0,
+              help="The number of requests downloaded ahead from the request bucket. 0 fetches one at a time.")
+@click.option("--processes", "-p", default=1,
+              help="The number of consumer processes run by a supervisor. Crashed processes are restarted. Requests "
+                   "for one widget are only kept in order across processes with --request-files.")
+@click.option("--workers", "-w", default=1,
+              help="The number of requests processed concurrently. Requests for one widget stay in order.")
+@click.option("--max-in-flight", "-mif", default=100,
+              help="The max number of fetched requests waiting to be processed when using multiple workers, or "
+                   "being processed at once with --async-io.")
+@click.option("--async-io/--no-async-io", default=False,
+              help="If set, requests are processed concurrently by an asyncio event loop instead of worker threads.")
+@click.option("--dynamodb-partial-updates/--no-dynamodb-partial-updates", default=True,
+              help="If set, update requests only write their attributes to dynamodb, and never create widgets.")
+@click.option("--dynamodb-batch-writes/--no-dynamodb-batch-writes", default=False,
+              help="If set, widget writes to dynamodb are buffered and sent in batches of 25.")
+@click.option("--batch-write-wait", "-bww", default=1.0,
+              help="The max number of seconds a widget write waits in the buffer before being sent.")
+@click.option("--widget-codec", type=click.Choice(WIDGET_CODECS), default="json",
+              help="The format widgets are stored in s3 with. Widgets in any format can be read back.")
+@click.option("--s3-layout", type=click.Choice(["object", "aggregated"]), default="object",
+              help="'aggregated' buffers s3 widget writes and stores them as one segment per owner and flush, "
+                   "with an index delta per owner and flush. Only use it if no other consumer writes the widgets.")
+@click.option("--compaction-interval", default=300.0,
+              help="The number of seconds between compactions of aggregated s3 widget segments, 0 to disable.")
+@click.option("--s3-blind-deletes/--no-s3-blind-deletes", default=False,
+              help="If set, s3 widgets are deleted without an existence check, so missing widgets aren't logged.")
+@click.option("--widget-cache-mb", "-wcm", default=0.0,
+              help="If set, the last stored state of widgets is cached in up to this many MB, skipping no-op writes.")
+@click.option("--widget-cache-mode", type=click.Choice(["shared", "exclusive"]), default="shared",
+              help="'exclusive' trusts cached widgets until evicted, only use it if no other consumer writes widgets. "
+                   "'shared' trusts them for --widget-cache-ttl seconds.")
+@click.option("--widget-cache-ttl", default=5.0,
+              help="The number of seconds cached widgets are trusted for in shared mode.")
+@click.option("--max-pool-connections", "-mpc", default=10,
+              help="The max number of pooled connections kept open per aws client.")
+@click.option("--tcp-keepalive/--no-tcp-keepalive", default=True,
+              help="If set, enables TCP keep-alive on pooled aws client connections.")
+@click.option("--rate-control/--no-rate-control", default=True,
+              help="If set, api calls are paced per aws service and slowed down when the service throttles them.")
+@click.option("--rate-limit", multiple=True,
+              help="The max number of api calls per second to an aws service (s3, sqs or dynamodb), as SERVICE=RATE, "
+                   "e.g. dynamodb=500. Can be given once per service.")
+@click.option("--metrics-port", "-mp", default=0,
+              help="If set, serves prometheus metrics at /metrics on this port.")
+@click.option("--metrics-host", default="127.0.0.1",
+              help="The address the metrics are served on, e.g. 0.0.0.0 to accept connections from other hosts.")
+@click.option("--metrics-file", "-mf", default=None,
+              help="If set, metrics are periodically written to this file as json.")
+@click.option("--metrics-interval", "-mi", default=60.0,
+              help="The number of seconds between writes of the metrics file.")
 @click.option("--debug/--no-debug", default=False,
               help="If set, will print information about fetching and processing requests.")
-def cli(region, request_bucket, request_queue, widget_bucket, dynamodb_table, max_request_limit, debug):
-    if (widget_bucket and dynamodb_table) or (request_bucket and request_queue):
+@click.option("--buffered-logging/--no-buffered-logging", default=True,
+              help="If set, log lines are written by a background thread, in batches, instead of by the consumer.")
+@click.option("--debug-sample-rate", default=1.0,
+              help="The fraction of debug log lines kept with --buffered-logging, e.g. 0.01 keeps one in a hundred.")
+def cli(region, request_bucket, request_queue, request_files, widget_bucket, dynamodb_table, max_request_limit,
+        idle_timeout, daemon, min_poll_delay, max_poll_delay, sqs_batch_size, sqs_wait_time, visibility_timeout,
+        extend_visibility, dedupe_cache_size, dedupe_ttl, dedupe_store, sequence_window, max_pending, s3_prefetch,
+        processes, workers, max_in_flight, async_io, dynamodb_partial_updates, dynamodb_batch_writes, batch_write_wait,
+        widget_codec, s3_layout, compaction_interval, s3_blind_deletes, widget_cache_mb, widget_cache_mode,
+        widget_cache_ttl, max_pool_connections, tcp_keepalive, rate_control, rate_limit, metrics_port, metrics_host,
+        metrics_file, metrics_interval, debug, buffered_logging, debug_sample_rate):
+    request_sources = [request_source for request_source in (request_bucket, request_queue, request_files)
+                       if request_source]
+    if click.get_current_context().invoked_subcommand is not None:
+        return
+    if len(request_sources) > 1:
         logging.error("Mismatched Options. To see more information, type '--help'.")
         return
-    if not (request_bucket or request_queue):
+    if not request_sources:
         logging.error("Missing the Request Location. To see more information, type '--help'.")
         return
     if not (widget_bucket or dynamodb_table):
         logging.error("Missing the Widget Location. To see more information, type '--help'.")
         return
+    if async_io and (workers > 1 or dynamodb_batch_writes or s3_layout == "aggregated"):
+        logging.error("--async-io can't be combined with --workers, --dynamodb-batch-writes or the aggregated s3 "
+                      "layout. To see more information, type '--help'.")
+        return
+    if widget_bucket and dynamodb_table and (dynamodb_batch_writes or s3_layout == "aggregated"):
+        logging.error("Writing widgets to both --widget-bucket and --dynamodb-table can't be combined with "
+                      "--dynamodb-batch-writes or the aggregated s3 layout. To see more information, type '--help'.")
+        return
+    if s3_layout == "aggregated" and processes > 1:
+        logging.error("The aggregated s3 layout needs a single writer per owner, so it can't be combined with "
+                      "--processes. To see more information, type '--help'.")
+        return
+    if widget_codec not in get_available_codecs():
+        logging.error(f"The '{widget_codec}' widget codec is not installed. To see more information, type '--help'.")
+        return
+    rate_limits = parse_rate_limits(rate_limit)
+    if rate_limits is None:
+        return
+    if sqs_wait_time is None:
+        # each empty long poll takes the whole wait time, so without batching or a daemon the default
+        # --max-request-limit would keep an idle consumer around for minutes
+        sqs_wait_time = SQS_LONG_POLL_WAIT_TIME if sqs_batch_size > 1 or async_io or daemon else 0
+    if request_files == "-" and processes > 1:
+        logging.error("Requests from stdin can only be read by one process. To see more information, type '--help'.")
+        return
 
     user_info = {
         "REQUEST_LOC": {
             "REQUEST_BUCKET": request_bucket,
-            "REQUEST_QUEUE": request_queue
+            "REQUEST_QUEUE": request_queue,
+            "REQUEST_FILES": request_files,
+            "SQS_WAIT_TIME": sqs_wait_time
         },
         "WIDGET_LOC": {
             "WIDGET_BUCKET": widget_bucket,
-            "DYNAMODB_TABLE": dynamodb_table
+            "DYNAMODB_TABLE": dynamodb_table,
+            "DYNAMODB_PARTIAL_UPDATES": dynamodb_partial_updates,
+            "S3_BLIND_DELETES": s3_blind_deletes,
+            "WIDGET_CODEC": widget_codec
         },
         "MAX_REQUEST_LIMIT": max_request_limit,
+        "IDLE_TIMEOUT": idle_timeout,
+        "DAEMON": daemon,
+        "MIN_POLL_DELAY": min_poll_delay,
+        "MAX_POLL_DELAY": max_poll_delay,
+        "SQS_BATCH_SIZE": sqs_batch_size,
+        "VISIBILITY_TIMEOUT": visibility_timeout,
+        "EXTEND_VISIBILITY": extend_visibility,
+        "DEDUPE_CACHE_SIZE": dedupe_cache_size,
+        "DEDUPE_TTL": dedupe_ttl,
+        "DEDUPE_STORE": dedupe_store,
+        "SEQUENCE_WINDOW": sequence_window,
+        "MAX_PENDING": max_pending,
+        "S3_PREFETCH": s3_prefetch,
+        "WORKERS": workers,
+        "MAX_IN_FLIGHT": max_in_flight,
+        "ASYNC_IO": async_io,
+        "DYNAMODB_BATCH_WRITES": dynamodb_batch_writes,
+        "BATCH_WRITE_WAIT": batch_write_wait,
+        "S3_LAYOUT": s3_layout,
+        "COMPACTION_INTERVAL": compaction_interval,
+        "WIDGET_CACHE_MB": widget_cache_mb,
+        "WIDGET_CACHE_MODE": widget_cache_mode,
+        "WIDGET_CACHE_TTL": widget_cache_ttl,
+        "MAX_POOL_CONNECTIONS": max_pool_connections,
+        "TCP_KEEPALIVE": tcp_keepalive,
+        "RATE_CONTROL": rate_control,
+        "RATE_LIMITS": rate_limits,
+        "METRICS_PORT": metrics_port,
+        "METRICS_HOST": metrics_host,
+        "METRICS_FILE": metrics_file,
+        "METRICS_INTERVAL": metrics_interval,
+        "LOG_FILE": "./logs/consumer.log",
+        # set for the processes of a fleet run by a supervisor
+        "WORKER_INDEX": None,
+        "STATS_QUEUE": None,
         "DEBUG": debug,
+        "BUFFERED_LOGGING": buffered_logging,
+        "DEBUG_SAMPLE_RATE": debug_sample_rate,
         "REGION": region
     }
 
-    main(user_info)
+    if processes > 1:
+        run_supervisor(user_info, processes)
+    else:
+        main(user_info)
+
+
+# copies every widget of one widget location to the other, e.g. to backfill a dynamodb table from an s3 bucket while
+# consumers write to both. The progress is saved in the checkpoint file, so an interrupted migration can be resumed
+@cli.command("migrate")
+@click.option("--source", type=click.Choice(["s3", "dynamodb"]), default="s3",
+              help="The widget location copied from, widgets are copied to the other one.")
+@click.option("--region", help="The region of the aws service instances")
+@click.option("--widget-bucket", "-wb", help="Name of the s3 bucket widgets are copied from or to.")
+@click.option("--dynamodb-table", "-dbt", help="Name of the dynamodb table widgets are copied from or to.")
+@click.option("--segments", "-s", default=4,
+              help="The number of parts of the source read at once: segments of a dynamodb scan, or owners in s3.")
+@click.option("--checkpoint", "-c", default=None,
+              help="If set, the progress is saved in this file, and a migration saved there is resumed.")
+@click.option("--widget-codec", type=click.Choice(WIDGET_CODECS), default="json",
+              help="The format widgets are stored in s3 with. Widgets in any format can be read back.")
+@click.option("--max-pool-connections", "-mpc", default=10,
+              help="The max number of pooled connections kept open per aws client.")
+@click.option("--rate-control/--no-rate-control", default=True,
+              help="If set, api calls are paced per aws service and slowed down when the service throttles them.")
+@click.option("--rate-limit", multiple=True,
+              help="The max number of api calls per second to an aws service (s3, sqs or dynamodb), as SERVICE=RATE, "
+                   "e.g. dynamodb=500. Can be given once per service.")
+@click.option("--debug/--no-debug", default=False,
+              help="If set, will print information about every page of copied widgets.")
+def migrate(source, region, widget_bucket, dynamodb_table, segments, checkpoint, widget_codec, max_pool_connections,
+            rate_control, rate_limit, debug):
+    if not (widget_bucket and dynamodb_table):
+        logging.error("Missing the Widget Location. A migration needs both --widget-bucket and --dynamodb-table. "
+                      "To see more information, type '--help'.")
+        return
+    if widget_codec not in get_available_codecs():
+        logging.error(f"The '{widget_codec}' widget codec is not installed. To see more information, type '--help'.")
+        return
+    rate_limits = parse_rate_limits(rate_limit)
+    if rate_limits is None:
+        return
+
+    widget_locs = {"s3": f"s3://{widget_bucket}", "dynamodb": f"dynamodb://{dynamodb_table}"}
+    target = "dynamodb" if source == "s3" else "s3"
+    migration_checkpoint = load_migration_checkpoint(checkpoint, widget_locs[source], widget_locs[target])
+    if migration_checkpoint is None:
+        logging.error(f"The checkpoint '{checkpoint}' belongs to another migration. To see more information, "
+                      f"type '--help'.")
+        return
+
+    logger = create_logger(debug=debug, save_file="./logs/migrate.log")
+    metrics = create_metrics()
+    # every worker may wait on a page of downloads or writes at the same time
+    max_pool_connections = max(max_pool_connections, segments)
+    rate_controller = create_rate_controller(max_pool_connections, rate_limits, metrics) if rate_control else None
+    client_pool = create_client_pool(max_pool_connections, metrics=metrics, rate_controller=rate_controller)
+    migration = {
+        "SOURCE": source,
+        "WIDGET_BUCKET": widget_bucket,
+        "DYNAMODB_TABLE": dynamodb_table,
+        "WIDGET_CODEC": widget_codec,
+        "SEGMENTS": segments,
+        "EXECUTOR": concurrent.futures.ThreadPoolExecutor(max_workers=max_pool_connections,
+                                                          thread_name_prefix="migration-io")
+    }
+
+    logger.info(f"Copying widgets from {widget_locs[source]} to {widget_locs[target]}...")
+    try:
+        count = migrate_widgets(logger, migration, migration_checkpoint, region, client_pool)
+    finally:
+        migration["EXECUTOR"].shutdown()
+    logger.info(f"Copied {count} widgets from {widget_locs[source]} to {widget_locs[target]}, terminating program.")
+    stop_logger(logger)
 
 
 if __name__ == "__main__":
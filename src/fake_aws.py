@@ -0,0 +1,390 @@
+import asyncio
+import collections
+import contextvars
+import inspect
+import io
+import itertools
+import random
+import re
+import threading
+import time
+import types
+import zlib
+
+import botocore.exceptions
+
+
+# error codes each service answers with when it throttles a call
+THROTTLE_CODES = {
+    "s3": "SlowDown",
+    "sqs": "ThrottlingException",
+    "dynamodb": "ProvisionedThroughputExceededException"
+}
+
+# set while an asyncio stand-in makes a call, which has already made the attempts of the call
+ATTEMPTED = contextvars.ContextVar("attempted", default=False)
+
+
+# creates an exception class that behaves like the modeled exceptions of a boto3 client
+def client_exception(name: str) -> type:
+    return type(name, (botocore.exceptions.ClientError,), {})
+
+
+# base class of the in-process aws stand-ins. Every attempt of a call is counted, delayed by the configured latency
+# and fails with the service's throttling error at the configured rate, or once more calls per second are made than
+# the configured capacity allows. If the stand-in has the event emitter of a session, it emits the before-send and
+# needs-retry events of each attempt like botocore does, and retries when a needs-retry handler asks for it
+class FakeClient:
+    service = None
+    events = None
+
+    def __init__(self, latency: float = 0.0, throttle_rate: float = 0.0, capacity: float = 0.0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.capacity = capacity
+        self.tokens = capacity / 10
+        self.refilled = time.monotonic()
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def _call(self, operation: str) -> None:
+        if ATTEMPTED.get():
+            return
+        attempts = 1
+        while True:
+            if self.events is not None:
+                self.events.emit(f"before-send.{self.service}.{operation}", request=None)
+            if self.latency:
+                time.sleep(self.latency)
+            error = self._attempt(operation)
+            if self.events is None:
+                break
+            responses = self.events.emit(f"needs-retry.{self.service}.{operation}", response=fake_response(error),
+                                         attempts=attempts, caught_exception=None, operation=None, endpoint=None,
+                                         request_dict={"context": {}})
+            retry_delay = next((response for _, response in responses if response is not None), None)
+            if error is None or not retry_delay:
+                break
+            time.sleep(retry_delay)
+            attempts += 1
+        if error is not None:
+            raise botocore.exceptions.ClientError(error, operation)
+
+    # counts an attempt of a call, and returns the error response it fails with if it is throttled
+    def _attempt(self, operation: str) -> dict:
+        with self.lock:
+            self.calls[operation] += 1
+            throttled = self.throttle_rate and random.random() < self.throttle_rate
+            if self.capacity:
+                now = time.monotonic()
+                self.tokens = min(self.capacity / 10, self.tokens + (now - self.refilled) * self.capacity)
+                self.refilled = now
+                throttled = throttled or self.tokens < 1
+                if self.tokens >= 1:
+                    self.tokens -= 1
+            if not throttled:
+                return None
+            self.calls["Throttled"] += 1
+        return {"Error": {"Code": THROTTLE_CODES[self.service], "Message": "Throttled"},
+                "ResponseMetadata": {"HTTPStatusCode": 400}}
+
+
+# returns the (http response, parsed response) pair botocore passes to needs-retry handlers for an attempt that failed
+# with the given error response, or succeeded if it is None
+def fake_response(error: dict = None) -> tuple:
+    parsed = error or {"ResponseMetadata": {"HTTPStatusCode": 200}}
+    http_response = types.SimpleNamespace(status_code=parsed["ResponseMetadata"]["HTTPStatusCode"], headers={},
+                                          content=b"")
+    return http_response, parsed
+
+
+# in-memory s3, lists keys in ascending order like s3 does
+class FakeS3(FakeClient):
+    service = "s3"
+
+    class exceptions:
+        NoSuchKey = client_exception("NoSuchKey")
+
+    def __init__(self, latency: float = 0.0, throttle_rate: float = 0.0, capacity: float = 0.0):
+        super().__init__(latency, throttle_rate, capacity)
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call("PutObject")
+        with self.lock:
+            if kwargs.get("IfNoneMatch") == "*" and (Bucket, Key) in self.objects:
+                raise botocore.exceptions.ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+            self.objects[(Bucket, Key)] = (Body.encode("utf-8") if isinstance(Body, str) else Body,
+                                           kwargs.get("Metadata", {}))
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call("GetObject")
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise self.exceptions.NoSuchKey({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+            body, metadata = self.objects[(Bucket, Key)]
+        if "Range" in kwargs:
+            first, last = kwargs["Range"].removeprefix("bytes=").split("-")
+            body = body[int(first):int(last) + 1]
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), "Metadata": metadata}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call("HeadObject")
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise botocore.exceptions.ClientError({"Error": {"Code": "404"}}, "HeadObject")
+            body, metadata = self.objects[(Bucket, Key)]
+        return {"ContentLength": len(body), "Metadata": metadata}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call("DeleteObject")
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    # with a delimiter, keys sharing a prefix up to the delimiter are rolled up into one common prefix. The
+    # continuation token is the last key or common prefix of the page before
+    def list_objects_v2(self, Bucket, MaxKeys=1000, StartAfter="", Prefix="", Delimiter="", ContinuationToken="",
+                        **kwargs):
+        self._call("ListObjectsV2")
+        start_after = max(StartAfter, ContinuationToken)
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects
+                          if bucket == Bucket and key > start_after and key.startswith(Prefix))
+            entries = []
+            for key in keys:
+                if Delimiter and Delimiter in key[len(Prefix):]:
+                    common_prefix = key[:key.index(Delimiter, len(Prefix)) + len(Delimiter)]
+                    if common_prefix == ContinuationToken or (entries and entries[-1][0] == common_prefix):
+                        continue
+                    entries.append((common_prefix, None))
+                else:
+                    entries.append((key, len(self.objects[(Bucket, key)][0])))
+        page = entries[:MaxKeys]
+        contents = [{"Key": key, "Size": size} for key, size in page if size is not None]
+        common_prefixes = [{"Prefix": key} for key, size in page if size is None]
+        response = {"KeyCount": len(page), "IsTruncated": len(entries) > MaxKeys}
+        if contents:
+            response["Contents"] = contents
+        if common_prefixes:
+            response["CommonPrefixes"] = common_prefixes
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1][0]
+        return response
+
+
+# in-memory sqs queue. Message bodies can come from an iterator, so very large request streams don't have to be
+# held in memory. Received messages stay in flight until deleted; visibility timeouts are not simulated
+class FakeSQS(FakeClient):
+    service = "sqs"
+
+    class exceptions:
+        InvalidAddress = client_exception("InvalidAddress")
+
+    def __init__(self, bodies=(), latency: float = 0.0, throttle_rate: float = 0.0, capacity: float = 0.0):
+        super().__init__(latency, throttle_rate, capacity)
+        self.bodies = iter(bodies)
+        self.sent = collections.deque()
+        self.in_flight = {}
+        self.handles = itertools.count()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self._call("SendMessage")
+        with self.lock:
+            self.sent.append(MessageBody)
+        return {}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        self._call("ReceiveMessage")
+        messages = []
+        with self.lock:
+            while len(messages) < MaxNumberOfMessages:
+                body = self.sent.popleft() if self.sent else next(self.bodies, None)
+                if body is None:
+                    break
+                receipt_handle = str(next(self.handles))
+                self.in_flight[receipt_handle] = body
+                messages.append({"Body": body, "ReceiptHandle": receipt_handle})
+        return {"Messages": messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self._call("DeleteMessage")
+        with self.lock:
+            self.in_flight.pop(ReceiptHandle, None)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self._call("DeleteMessageBatch")
+        with self.lock:
+            for entry in Entries:
+                self.in_flight.pop(entry["ReceiptHandle"], None)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        self._call("ChangeMessageVisibilityBatch")
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+
+# applies an update expression made of SET and REMOVE clauses of plain attribute names (the subset of the expression
+# language the consumer uses) to an item
+def apply_update_expression(item: dict, update_expression: str, attr_names: dict = None,
+                            attr_values: dict = None) -> None:
+    attr_names, attr_values = attr_names or {}, attr_values or {}
+    for clause in re.split(r"\s(?=SET |REMOVE )", update_expression.strip()):
+        if not clause:
+            continue
+        action, actions = clause.split(" ", 1)
+        for update_action in actions.split(","):
+            if action == "SET":
+                name, value = (part.strip() for part in update_action.split("="))
+                item[attr_names.get(name, name)] = attr_values[value]
+            else:
+                name = update_action.strip()
+                item.pop(attr_names.get(name, name), None)
+
+
+# in-memory dynamodb table store, keyed by the "id" attribute
+class FakeDynamoDB(FakeClient):
+    service = "dynamodb"
+
+    class exceptions:
+        ConditionalCheckFailedException = client_exception("ConditionalCheckFailedException")
+
+    def __init__(self, latency: float = 0.0, throttle_rate: float = 0.0, capacity: float = 0.0):
+        super().__init__(latency, throttle_rate, capacity)
+        self.tables = collections.defaultdict(dict)
+
+    def put_item(self, TableName, Item, ConditionExpression=None, **kwargs):
+        self._call("PutItem")
+        with self.lock:
+            if ConditionExpression == "attribute_not_exists(id)" and Item["id"]["S"] in self.tables[TableName]:
+                raise self.exceptions.ConditionalCheckFailedException(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem")
+            self.tables[TableName][Item["id"]["S"]] = Item
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self._call("GetItem")
+        with self.lock:
+            item = self.tables[TableName].get(Key["id"]["S"])
+        return {"Item": item} if item is not None else {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, **kwargs):
+        self._call("DeleteItem")
+        with self.lock:
+            table = self.tables[TableName]
+            if ConditionExpression == "attribute_exists(id)" and Key["id"]["S"] not in table:
+                raise self.exceptions.ConditionalCheckFailedException(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}}, "DeleteItem")
+            table.pop(Key["id"]["S"], None)
+        return {}
+
+    def update_item(self, TableName, Key, ConditionExpression=None, UpdateExpression="", ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        self._call("UpdateItem")
+        with self.lock:
+            item = self.tables[TableName].get(Key["id"]["S"])
+            if ConditionExpression == "attribute_exists(id)" and item is None:
+                raise self.exceptions.ConditionalCheckFailedException(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+            item = dict(item or Key)
+            apply_update_expression(item, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            self.tables[TableName][Key["id"]["S"]] = item
+        return {}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self._call("BatchWriteItem")
+        with self.lock:
+            for table_name, write_requests in RequestItems.items():
+                table = self.tables[table_name]
+                for write_request in write_requests:
+                    if "PutRequest" in write_request:
+                        item = write_request["PutRequest"]["Item"]
+                        table[item["id"]["S"]] = item
+                    else:
+                        table.pop(write_request["DeleteRequest"]["Key"]["id"]["S"], None)
+        return {"UnprocessedItems": {}}
+
+    # items are spread over the segments of a parallel scan by the hash of their id, and scanned in id order
+    def scan(self, TableName, Segment=0, TotalSegments=1, Limit=None, ExclusiveStartKey=None, **kwargs):
+        self._call("Scan")
+        start_id = ExclusiveStartKey["id"]["S"] if ExclusiveStartKey is not None else ""
+        with self.lock:
+            items = [item for item_id, item in sorted(self.tables[TableName].items())
+                     if item_id > start_id and zlib.crc32(item_id.encode("utf-8")) % TotalSegments == Segment]
+        page = items[:Limit] if Limit is not None else items
+        response = {"Items": page, "Count": len(page), "ScannedCount": len(page)}
+        if len(items) > len(page):
+            response["LastEvaluatedKey"] = {"id": page[-1]["id"]}
+        return response
+
+
+# asyncio stand-in for a native async client, wrapping one of the in-process stand-ins. Every call is a coroutine that
+# spends the stand-in's latency in asyncio.sleep instead of blocking a thread
+class AsyncFakeClient:
+    events = None
+
+    def __init__(self, fake_client: FakeClient):
+        self.fake_client = fake_client
+        self.service = fake_client.service
+        self.exceptions = fake_client.exceptions
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    def __getattr__(self, operation):
+        method = getattr(self.fake_client, operation)
+        operation_name = "".join(part.title() for part in operation.split("_"))
+
+        # the attempts are made here, so waiting on latency, event handlers and retries doesn't block the event loop
+        async def call(**kwargs):
+            attempts = 1
+            while True:
+                if self.events is not None:
+                    await emit_event(self.events, f"before-send.{self.service}.{operation_name}", request=None)
+                if self.fake_client.latency:
+                    await asyncio.sleep(self.fake_client.latency)
+                error = self.fake_client._attempt(operation_name)
+                if self.events is None:
+                    break
+                responses = await emit_event(self.events, f"needs-retry.{self.service}.{operation_name}",
+                                             response=fake_response(error), attempts=attempts,
+                                             caught_exception=None, operation=None, endpoint=None,
+                                             request_dict={"context": {}})
+                retry_delay = next((response for _, response in responses if response is not None), None)
+                if error is None or not retry_delay:
+                    break
+                await asyncio.sleep(retry_delay)
+                attempts += 1
+            if error is not None:
+                raise botocore.exceptions.ClientError(error, operation_name)
+
+            token = ATTEMPTED.set(True)
+            try:
+                return method(**kwargs)
+            finally:
+                ATTEMPTED.reset(token)
+        return call
+
+
+# emits an event with the emitter of a botocore or aiobotocore session, whose emit is a coroutine
+async def emit_event(events, event_name: str, **kwargs) -> list:
+    responses = events.emit(event_name, **kwargs)
+    return await responses if inspect.isawaitable(responses) else responses
+
+
+# puts the given stand-ins into a client pool or async client pool, so the consumer uses them instead of real aws
+# clients. The stand-ins emit their events with the pool's session, like the clients it creates
+def install_fake_clients(client_pool: dict, region: str, *fake_clients: FakeClient) -> dict:
+    session = client_pool["SESSION"]
+    events = None
+    if session is not None:
+        events = session.events if hasattr(session, "events") else session.get_component("event_emitter")
+    for fake_client in fake_clients:
+        fake_client.events = events
+        client_pool["CLIENTS"][(fake_client.service, region)] = fake_client
+    return client_pool
@@ -1,9 +1,27 @@
 import unittest
+import unittest.mock
+import asyncio
+import concurrent.futures
+import io
+import itertools
 import os
+import queue
 from src import consumer
+from src import fake_aws
 import json
+import logging
+import logging.handlers
 import jsonschema
 import boto3
+import botocore.awsrequest
+import botocore.config
+import botocore.endpoint
+import botocore.retries.standard
+import botocore.stub
+import threading
+import types
+import time
+import tempfile
 
 # created as a global for 3 reasons:
 # 1. Every test function uses the exact same configuration
@@ -50,8 +68,7 @@ def get_objects_s3(bucket_name, region):
     widgets = []
     for key in keys:
         response = s3_client.get_object(Bucket=bucket_name, Key=key)
-        widget_str = response["Body"].read().decode("utf-8")
-        widgets.append(json.loads(widget_str))
+        widgets.append(consumer.decode_widget(response["Body"].read(), response.get("Metadata")))
     return widgets
 
 
@@ -86,6 +103,146 @@ def flatten_obj(data_obj):
     return data_flat
 
 
+# in-memory stand-in for an sqs client, records every receive and delete call made against it.
+# Receipt handles listed in fail_once fail with a server side error the first time they are deleted
+class FakeSQSClient:
+    exceptions = types.SimpleNamespace(InvalidAddress=type("InvalidAddress", (Exception,), {}))
+
+    def __init__(self, requests, fail_once=()):
+        self.messages = [{"Body": json.dumps(request), "ReceiptHandle": f"handle-{i}"}
+                         for i, request in enumerate(requests)]
+        self.fail_once = set(fail_once)
+        self.receive_calls = []
+        self.deleted_handles = []
+        self.delete_batch_calls = 0
+        self.visibility_changes = []
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        self.receive_calls.append(dict(kwargs, MaxNumberOfMessages=MaxNumberOfMessages))
+        messages, self.messages = self.messages[:MaxNumberOfMessages], self.messages[MaxNumberOfMessages:]
+        return {"Messages": messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.deleted_handles.append(ReceiptHandle)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.delete_batch_calls += 1
+        response = {"Successful": [], "Failed": []}
+        for entry in Entries:
+            if entry["ReceiptHandle"] in self.fail_once:
+                self.fail_once.remove(entry["ReceiptHandle"])
+                response["Failed"].append({"Id": entry["Id"], "SenderFault": False, "Code": "InternalError"})
+            else:
+                self.deleted_handles.append(entry["ReceiptHandle"])
+                response["Successful"].append({"Id": entry["Id"]})
+        return response
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.visibility_changes.extend((entry["ReceiptHandle"], entry["VisibilityTimeout"]) for entry in Entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+
+# in-memory stand-in for an s3 client, lists keys in ascending order like s3 does
+class FakeS3Client:
+    exceptions = types.SimpleNamespace(NoSuchKey=type("NoSuchKey", (Exception,), {}))
+
+    def __init__(self):
+        self.objects = {}
+        self.list_calls = 0
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with self.lock:
+            self.objects[Key] = Body.encode("utf-8") if isinstance(Body, str) else Body
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            if Key not in self.objects:
+                raise self.exceptions.NoSuchKey()
+            return {"Body": io.BytesIO(self.objects[Key])}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self.objects.pop(Key, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, MaxKeys=1000, StartAfter="", **kwargs):
+        self.list_calls += 1
+        with self.lock:
+            keys = sorted(key for key in self.objects if key > StartAfter)
+        response = {"IsTruncated": len(keys) > MaxKeys}
+        if keys:
+            response["Contents"] = [{"Key": key} for key in keys[:MaxKeys]]
+        return response
+
+
+# in-memory stand-in for a dynamodb client, records the order in which widgets were written to it.
+# The first batch write leaves the writes for widgets listed in unprocessed_once unprocessed
+class FakeDynamoDBClient:
+    def __init__(self, unprocessed_once=()):
+        self.items = {}
+        self.writes = []
+        self.batch_write_calls = 0
+        self.unprocessed_once = set(unprocessed_once)
+        self.lock = threading.Lock()
+
+    def put_item(self, TableName, Item, **kwargs):
+        with self.lock:
+            self.items[Item["id"]["S"]] = Item
+            self.writes.append(("put", Item["id"]["S"], Item.get("label", {}).get("S")))
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self.items.get(Key["id"]["S"])
+        return {"Item": item} if item is not None else {}
+
+    exceptions = types.SimpleNamespace(
+        ConditionalCheckFailedException=fake_aws.client_exception("ConditionalCheckFailedException"))
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, **kwargs):
+        with self.lock:
+            if ConditionExpression == "attribute_exists(id)" and Key["id"]["S"] not in self.items:
+                raise self.exceptions.ConditionalCheckFailedException(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}}, "DeleteItem")
+            self.items.pop(Key["id"]["S"], None)
+            self.writes.append(("delete", Key["id"]["S"], None))
+        return {}
+
+    def update_item(self, TableName, Key, ConditionExpression, UpdateExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues=None):
+        with self.lock:
+            if Key["id"]["S"] not in self.items:
+                raise self.exceptions.ConditionalCheckFailedException(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+            item = dict(self.items[Key["id"]["S"]])
+            fake_aws.apply_update_expression(item, UpdateExpression, ExpressionAttributeNames,
+                                             ExpressionAttributeValues)
+            self.items[Key["id"]["S"]] = item
+            self.writes.append(("update", Key["id"]["S"], UpdateExpression))
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        self.batch_write_calls += 1
+        unprocessed = []
+        for table_name, write_requests in RequestItems.items():
+            for write_request in write_requests:
+                if "PutRequest" in write_request:
+                    widget_id = write_request["PutRequest"]["Item"]["id"]["S"]
+                else:
+                    widget_id = write_request["DeleteRequest"]["Key"]["id"]["S"]
+
+                if widget_id in self.unprocessed_once:
+                    self.unprocessed_once.remove(widget_id)
+                    unprocessed.append(write_request)
+                elif "PutRequest" in write_request:
+                    self.put_item(table_name, write_request["PutRequest"]["Item"])
+                else:
+                    self.delete_item(table_name, write_request["DeleteRequest"]["Key"])
+        return {"UnprocessedItems": {table_name: unprocessed} if unprocessed else {}}
+
+
 class TestConsumer(unittest.TestCase):
 
     # tests creating widget by comparing it against a schema
@@ -257,5 +414,973 @@ class TestConsumer(unittest.TestCase):
             self.assertIn(widget, dynamodb_widgets)
 
 
+    # tests that requests accepted by the structural fast path are also accepted by the request schema
+    def test_is_valid_request(self):
+        validator = consumer.load_request_validator()
+        self.assertIs(validator, consumer.load_request_validator())
+
+        for file in os.listdir("sample-requests"):
+            with open("sample-requests/" + file) as request_file:
+                try:
+                    request = json.load(request_file)
+                except json.decoder.JSONDecodeError:
+                    continue
+            schema_valid = validator.is_valid(request)
+            if consumer.is_well_formed_request(request):
+                self.assertTrue(schema_valid)
+            self.assertEqual(consumer.is_valid_request(logger, request, validator), schema_valid)
+
+        self.assertFalse(consumer.is_well_formed_request({"type": "create", "requestId": "1", "widgetId": "1",
+                                                          "owner": "Mary", "otherAttributes": [{"name": "a"}]}))
+
+
+    # tests that the client pool creates one client per service and region and reuses it afterwards
+    def test_client_pool(self):
+        client_pool = consumer.create_client_pool(max_pool_connections=4)
+
+        s3_client = consumer.get_client(client_pool, 's3', "us-east-1")
+        self.assertIs(s3_client, consumer.get_client(client_pool, 's3', "us-east-1"))
+        self.assertIsNot(s3_client, consumer.get_client(client_pool, 's3', "us-west-2"))
+        self.assertIsNot(s3_client, consumer.get_client(client_pool, 'sqs', "us-east-1"))
+        self.assertEqual(len(client_pool["CLIENTS"]), 3)
+        self.assertEqual(s3_client.meta.config.max_pool_connections, 4)
+
+
+    # tests that batched sqs mode receives and deletes requests in batches, retrying failed deletes
+    def test_get_request_sqs_batched(self):
+        requests = get_test_sample_requests()[:12]
+        region = "us-east-1"
+        sqs_client = FakeSQSClient(requests, fail_once=["handle-3"])
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('sqs', region)] = sqs_client
+        request_loc = {
+            "REQUEST_QUEUE": "fake-queue",
+            "REQUEST_BUCKET": None,
+            "SQS_BUFFER": consumer.create_sqs_buffer(batch_size=10, wait_time=20, visibility_timeout=5)
+        }
+
+        sqs_request_ids = []
+        request = consumer.get_next_request(logger, request_loc, region, client_pool)
+        while request is not None:
+            sqs_request_ids.append(request['requestId'])
+            consumer.delete_request(logger, request, request_loc, region, client_pool)
+            request = consumer.get_next_request(logger, request_loc, region, client_pool)
+        consumer.flush_sqs_deletes(logger, "fake-queue", region, request_loc["SQS_BUFFER"], client_pool)
+
+        self.assertEqual(sqs_request_ids, [request['requestId'] for request in requests])
+        self.assertEqual(len(sqs_client.receive_calls), 3)
+        self.assertEqual(sqs_client.receive_calls[0]["WaitTimeSeconds"], 20)
+        self.assertEqual(sqs_client.receive_calls[0]["VisibilityTimeout"], 50)
+        self.assertEqual(sorted(sqs_client.deleted_handles), sorted(f"handle-{i}" for i in range(len(requests))))
+        self.assertEqual(sqs_client.delete_batch_calls, 3)
+
+
+    # tests that buffered dynamodb writes are coalesced, retried and only then delete their requests
+    def test_write_buffer(self):
+        region = "us-east-1"
+        deleted_requests = []
+        sqs_client = FakeSQSClient([])
+        sqs_client.delete_message = lambda QueueUrl, ReceiptHandle: deleted_requests.append(ReceiptHandle)
+        dynamodb_client = FakeDynamoDBClient(unprocessed_once=["widget-1"])
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('sqs', region)] = sqs_client
+        client_pool["CLIENTS"][('dynamodb', region)] = dynamodb_client
+        write_buffer = consumer.create_write_buffer("widgets", max_wait=60)
+        user_info = {
+            "REQUEST_LOC": {"REQUEST_QUEUE": "fake-queue", "REQUEST_BUCKET": None},
+            "WIDGET_LOC": {"WIDGET_BUCKET": None, "DYNAMODB_TABLE": "widgets", "WRITE_BUFFER": write_buffer},
+            "REGION": region
+        }
+
+        requests = [("create", "widget-1"), ("update", "widget-1"), ("create", "widget-2"), ("delete", "widget-2"),
+                    ("delete", "widget-3")]
+        for i, (request_type, widget_id) in enumerate(requests):
+            request = {"type": request_type, "requestId": str(i), "widgetId": widget_id, "owner": "Mary Matthews",
+                       "label": str(i), "receipt_handle": str(i)}
+            consumer.process_request(logger, request, user_info, region, client_pool)
+        self.assertEqual(dynamodb_client.writes, [])
+
+        consumer.flush_write_buffer(logger, write_buffer, user_info["REQUEST_LOC"], region, client_pool)
+
+        self.assertEqual(dynamodb_client.writes, [("delete", "widget-2", None), ("put", "widget-1", "1")])
+        self.assertEqual(dynamodb_client.batch_write_calls, 2)
+        self.assertEqual(sorted(deleted_requests), ["0", "1", "2", "3", "4"])
+
+
+    # tests that deleting a widget from dynamodb takes one call, and that missing widgets are logged
+    def test_delete_widget_dynamodb_conditional(self):
+        region = "us-east-1"
+        dynamodb_client = FakeDynamoDBClient()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('dynamodb', region)] = dynamodb_client
+        dynamodb_client.get_item = None  # existence must not be checked with a separate read
+
+        request = {"type": "delete", "requestId": "1", "widgetId": "widget-1", "owner": "Mary Matthews"}
+        consumer.save_to_dynamodb(logger, consumer.create_widget(logger, request), "widgets", region, client_pool)
+        consumer.delete_widget_dynamodb(logger, request, "widgets", region, client_pool)
+        self.assertEqual(dynamodb_client.items, {})
+
+        with self.assertLogs(logger, level="WARNING"):
+            consumer.delete_widget_dynamodb(logger, request, "widgets", region, client_pool)
+
+
+    # tests that the prefetching s3 reader hands out every request in key order with few list calls
+    def test_get_request_s3_prefetched(self):
+        requests = get_test_sample_requests()
+        region = "us-east-1"
+        s3_client = FakeS3Client()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('s3', region)] = s3_client
+        for i, request in enumerate(requests):
+            s3_client.put_object(Bucket="requests", Key=f"{i:04}", Body=json.dumps(request))
+
+        request_loc = {
+            "REQUEST_QUEUE": None,
+            "REQUEST_BUCKET": "requests",
+            "S3_READER": consumer.create_s3_reader("requests", prefetch=4),
+            "IN_FLIGHT_KEYS": set()
+        }
+        s3_keys = []
+        request = consumer.get_next_request(logger, request_loc, region, client_pool)
+        while request is not None:
+            s3_keys.append(request['key'])
+            consumer.delete_request(logger, request, request_loc, region, client_pool)
+            request = consumer.get_next_request(logger, request_loc, region, client_pool)
+        consumer.close_s3_reader(request_loc["S3_READER"])
+
+        self.assertEqual(s3_keys, [f"{i:04}" for i in range(len(requests))])
+        self.assertEqual(s3_client.objects, {})
+        self.assertEqual(request_loc["IN_FLIGHT_KEYS"], set())
+        self.assertLessEqual(s3_client.list_calls, 3)
+
+
+    # tests that an s3 request that failed is skipped while it cools down, instead of being fetched again ahead of the
+    # requests after it
+    def test_get_request_s3_failed(self):
+        requests = get_test_sample_requests()[:3]
+        region = "us-east-1"
+        s3_client = FakeS3Client()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('s3', region)] = s3_client
+        for i, request in enumerate(requests):
+            s3_client.put_object(Bucket="requests", Key=f"{i:04}", Body=json.dumps(request))
+
+        request_loc = {"REQUEST_QUEUE": None, "REQUEST_BUCKET": "requests", "IN_FLIGHT_KEYS": set(),
+                       "REQUEST_RETRIES": consumer.create_request_retries()}
+        request = consumer.get_next_request(logger, request_loc, region, client_pool)
+        self.assertEqual(request['key'], "0000")
+        consumer.release_request(request_loc, request)
+        self.assertEqual(consumer.get_cooling_keys(request_loc["REQUEST_RETRIES"]), {"0000"})
+
+        s3_keys = []
+        request = consumer.get_next_request(logger, request_loc, region, client_pool)
+        while request is not None:
+            s3_keys.append(request['key'])
+            consumer.delete_request(logger, request, request_loc, region, client_pool)
+            request = consumer.get_next_request(logger, request_loc, region, client_pool)
+        self.assertEqual(s3_keys, ["0001", "0002"])
+
+        # once cooled down, the failed request is fetched again, and forgotten once it is processed
+        failures, _ = request_loc["REQUEST_RETRIES"]["KEYS"]["0000"]
+        request_loc["REQUEST_RETRIES"]["KEYS"]["0000"] = (failures, time.monotonic())
+        request = consumer.get_next_request(logger, request_loc, region, client_pool)
+        self.assertEqual(request['key'], "0000")
+        consumer.delete_request(logger, request, request_loc, region, client_pool)
+        self.assertEqual(request_loc["REQUEST_RETRIES"]["KEYS"], {})
+
+
+    # tests that an invalid s3 request (here without a widgetId) is skipped without staying in flight, and cools down
+    # instead of being fetched again on the next poll, with and without the prefetching reader
+    def test_get_request_s3_invalid(self):
+        region = "us-east-1"
+        validator = consumer.load_request_validator()
+        for prefetch in (0, 4):
+            s3_client = FakeS3Client()
+            client_pool = consumer.create_client_pool()
+            client_pool["CLIENTS"][('s3', region)] = s3_client
+            s3_client.put_object(Bucket="requests", Key="0000", Body=json.dumps({"type": "create", "requestId": "1"}))
+            s3_client.put_object(Bucket="requests", Key="0001", Body=json.dumps(get_test_sample_requests("create")[0]))
+
+            request_retries = consumer.create_request_retries()
+            request_loc = {"REQUEST_QUEUE": None, "REQUEST_BUCKET": "requests", "IN_FLIGHT_KEYS": set(),
+                           "REQUEST_RETRIES": request_retries}
+            if prefetch:
+                request_loc["S3_READER"] = consumer.create_s3_reader("requests", prefetch,
+                                                                     request_retries=request_retries)
+
+            request = consumer.get_next_request(logger, request_loc, region, client_pool)
+            self.assertEqual(request['key'], "0000")
+            self.assertEqual(consumer.screen_request(logger, request, request_loc, validator, None), "skip")
+            self.assertNotIn("0000", request_loc["IN_FLIGHT_KEYS"])
+            self.assertEqual(consumer.get_cooling_keys(request_retries), {"0000"})
+
+            request = consumer.get_next_request(logger, request_loc, region, client_pool)
+            self.assertEqual(request['key'], "0001")
+            consumer.delete_request(logger, request, request_loc, region, client_pool)
+            self.assertIsNone(consumer.get_next_request(logger, request_loc, region, client_pool))
+            if prefetch:
+                consumer.close_s3_reader(request_loc["S3_READER"])
+
+
+    # tests that consumer processes sharing a request bucket each read a separate part of it
+    def test_get_request_s3_partitioned(self):
+        requests = get_test_sample_requests()
+        region = "us-east-1"
+        s3_client = FakeS3Client()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('s3', region)] = s3_client
+        for i, request in enumerate(requests):
+            s3_client.put_object(Bucket="requests", Key=f"{i:04}", Body=json.dumps(request))
+
+        partition_keys = []
+        for index in range(3):
+            request_loc = {"REQUEST_QUEUE": None, "REQUEST_BUCKET": "requests", "PARTITION": (index, 3)}
+            if index == 2:
+                request_loc["S3_READER"] = consumer.create_s3_reader("requests", prefetch=4, partition=(index, 3))
+                request_loc["IN_FLIGHT_KEYS"] = set()
+
+            s3_keys = []
+            request = consumer.get_next_request(logger, request_loc, region, client_pool)
+            while request is not None:
+                s3_keys.append(request['key'])
+                consumer.delete_request(logger, request, request_loc, region, client_pool)
+                request = consumer.get_next_request(logger, request_loc, region, client_pool)
+            if index == 2:
+                consumer.close_s3_reader(request_loc["S3_READER"])
+
+            self.assertEqual(s3_keys, sorted(s3_keys))
+            self.assertTrue(all(consumer.in_partition(key, (index, 3)) for key in s3_keys))
+            partition_keys.extend(s3_keys)
+
+        self.assertEqual(sorted(partition_keys), [f"{i:04}" for i in range(len(requests))])
+        self.assertEqual(s3_client.objects, {})
+
+        # a process whose keys all come after the first page of the listing still finds them
+        other_keys = [key for key in (f"0-{i:05}" for i in range(3000)) if not consumer.in_partition(key, (0, 2))]
+        late_key = next(key for key in (f"1-{i:05}" for i in range(10)) if consumer.in_partition(key, (0, 2)))
+        for key in other_keys[:consumer.S3_MAX_LIST_KEYS + 10] + [late_key]:
+            s3_client.put_object(Bucket="requests", Key=key, Body=json.dumps(requests[0]))
+        request = consumer.get_request_s3(logger, "requests", region, client_pool, partition=(0, 2))
+        self.assertEqual(request['key'], late_key)
+
+
+    # tests that the metrics snapshots of consumer processes are summed per process
+    def test_aggregate_worker_stats(self):
+        snapshots = []
+        for index, outcomes in [(0, ["processed", "processed"]), (1, ["invalid"]), (0, ["processed", "failed"])]:
+            metrics = consumer.create_metrics()
+            for outcome in outcomes:
+                consumer.increment_counter(metrics, "consumer_requests_total", type="create", outcome=outcome)
+            snapshots.append((index, consumer.format_metrics_json(metrics)))
+
+        worker_stats = consumer.aggregate_worker_stats(snapshots)
+        processed = ("consumer_requests_total", (("outcome", "processed"), ("type", "create")))
+        self.assertEqual(worker_stats[0][processed], 3)
+        self.assertEqual(worker_stats[1][processed], 0)
+        self.assertEqual(sum(worker_stats[0].values()), 4)
+
+        # processes report their totals periodically, tagged with their pid so restarted processes add up
+        stats_queue = queue.Queue()
+        stats_reports = consumer.start_worker_stats_reports(stats_queue, 1, metrics, 0.01)
+        index, pid, snapshot = stats_queue.get(timeout=5)
+        stats_reports.set()
+        self.assertEqual((index, pid), (1, os.getpid()))
+        self.assertEqual(snapshot["counters"], consumer.format_metrics_json(metrics)["counters"])
+
+        worker_info = consumer.create_worker_info({"REQUEST_LOC": {"REQUEST_BUCKET": "requests"}, "WIDGET_LOC": {},
+                                                   "LOG_FILE": "./logs/consumer.log", "METRICS_PORT": 9100,
+                                                   "METRICS_FILE": None}, 2, 4, None)
+        self.assertEqual(worker_info["REQUEST_LOC"]["PARTITION"], (2, 4))
+        self.assertEqual(worker_info["LOG_FILE"], "./logs/consumer-2.log")
+        self.assertEqual(worker_info["METRICS_PORT"], 9102)
+
+
+    # tests that requests are streamed from a directory of request files and from a jsonl file, skipping bad ones
+    def test_read_local_requests(self):
+        requests = get_test_sample_requests()
+        region = "us-east-1"
+
+        with tempfile.TemporaryDirectory() as request_dir:
+            for i, request in enumerate(requests):
+                with open(os.path.join(request_dir, f"{i:04}"), "w") as request_file:
+                    json.dump(request, request_file)
+            with open(os.path.join(request_dir, "9999"), "w") as request_file:
+                request_file.write("{not json")
+            jsonl_path = os.path.join(request_dir, "requests.jsonl")
+            with open(jsonl_path, "w") as jsonl_file:
+                jsonl_file.write("\n".join([json.dumps(request) for request in requests] + ["", "[1, 2]", ""]))
+
+            for path in (request_dir, jsonl_path):
+                request_loc = {"REQUEST_QUEUE": None, "REQUEST_BUCKET": None, "REQUEST_FILES": path,
+                               "REQUEST_STREAM": consumer.read_local_requests(logger, path)}
+                request_ids = []
+                request = consumer.get_next_request(logger, request_loc, region)
+                while request is not None:
+                    request_ids.append(request['requestId'])
+                    consumer.delete_request(logger, request, request_loc, region)
+                    request = consumer.get_next_request(logger, request_loc, region)
+                self.assertEqual(request_ids, [request['requestId'] for request in requests])
+
+            partition_ids = []
+            for index in range(2):
+                partition_requests = list(consumer.read_local_requests(logger, jsonl_path, (index, 2)))
+                self.assertTrue(all(consumer.in_partition(request['widgetId'], (index, 2))
+                                    for request in partition_requests))
+                partition_ids.extend(request['requestId'] for request in partition_requests)
+            self.assertEqual(sorted(partition_ids), sorted(request['requestId'] for request in requests))
+
+            self.assertEqual(len(os.listdir(request_dir)), len(requests) + 2)
+
+            # only request files are read from a directory, other files aren't even warned about
+            os.remove(os.path.join(request_dir, "9999"))
+            with open(os.path.join(request_dir, ".DS_Store"), "w") as other_file:
+                other_file.write("\0")
+            with self.assertNoLogs(logger, level="WARNING"):
+                self.assertEqual(len(list(consumer.read_local_requests(logger, request_dir))), len(requests))
+
+
+    # tests that api calls and stages are recorded in the metrics and exported
+    def test_metrics(self):
+        region = "us-east-1"
+        metrics = consumer.create_metrics()
+        client_pool = consumer.create_client_pool(session=boto3.session.Session(), metrics=metrics)
+        sqs_client = consumer.get_client(client_pool, 'sqs', region)
+        request_loc = {"REQUEST_QUEUE": "https://sqs.us-east-1.amazonaws.com/0/requests", "REQUEST_BUCKET": None}
+        request = {"type": "create", "requestId": "1", "receipt_handle": "handle"}
+
+        with botocore.stub.Stubber(sqs_client) as stubber:
+            stubber.add_response("delete_message", {})
+            consumer.delete_request(logger, request, request_loc, region, client_pool)
+
+        api_labels = (("operation", "DeleteMessage"), ("service", "sqs"))
+        self.assertEqual(metrics["COUNTERS"][("consumer_api_calls_total", api_labels)], 1)
+        stage_histogram = metrics["HISTOGRAMS"][("consumer_stage_seconds",
+                                                 (("stage", "delete-request"), ("type", "create")))]
+        self.assertEqual(stage_histogram["COUNT"], 1)
+
+        prometheus_text = consumer.format_metrics_prometheus(metrics)
+        self.assertIn('consumer_api_calls_total{operation="DeleteMessage",service="sqs"} 1', prometheus_text)
+        self.assertIn('consumer_stage_seconds_count{stage="delete-request",type="create"} 1', prometheus_text)
+        self.assertIn('le="+Inf"} 1', prometheus_text)
+        self.assertEqual(json.loads(json.dumps(consumer.format_metrics_json(metrics)))["counters"][0]["value"], 1)
+
+        # the metrics server only listens on the loopback address unless told otherwise
+        metrics_server = consumer.start_metrics_server(metrics, 0)
+        try:
+            self.assertEqual(metrics_server.server_address[0], "127.0.0.1")
+        finally:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+
+    # tests that empty polls back off exponentially up to the max delay and stop according to the policy
+    def test_poll_scheduler(self):
+        poll_scheduler = consumer.create_poll_scheduler(min_delay=0.01, max_delay=0.04, max_empty_polls=3)
+        delays = []
+        for _ in range(3):
+            consumer.record_poll(poll_scheduler, found_request=False)
+            delays.append(poll_scheduler["DELAY"])
+            self.assertIsNone(consumer.get_stop_reason(poll_scheduler))
+        consumer.record_poll(poll_scheduler, found_request=False)
+        delays.append(poll_scheduler["DELAY"])
+        self.assertIsNotNone(consumer.get_stop_reason(poll_scheduler))
+        self.assertEqual(delays, [0.01, 0.02, 0.04, 0.04])
+
+        consumer.record_poll(poll_scheduler, found_request=True)
+        self.assertEqual(poll_scheduler["DELAY"], 0.0)
+        for _ in range(4):
+            consumer.record_poll(poll_scheduler, found_request=False)
+        self.assertIsNotNone(consumer.get_stop_reason(poll_scheduler))
+
+        idle_scheduler = consumer.create_poll_scheduler(min_delay=0.01, max_delay=0.01, idle_timeout=0.02)
+        consumer.record_poll(idle_scheduler, found_request=False)
+        self.assertIsNone(consumer.get_stop_reason(idle_scheduler))
+        time.sleep(0.03)
+        self.assertIsNotNone(consumer.get_stop_reason(idle_scheduler))
+
+        daemon_scheduler = consumer.create_poll_scheduler()
+        for _ in range(100):
+            consumer.record_poll(daemon_scheduler, found_request=False)
+        self.assertIsNone(consumer.get_stop_reason(daemon_scheduler))
+        daemon_scheduler["STOP_EVENT"].set()
+        self.assertIsNotNone(consumer.get_stop_reason(daemon_scheduler))
+
+
+    # tests that a request that is skipped on every poll counts as an empty poll, so the consumer backs off and stops,
+    # while skipped requests from request files count as found
+    def test_consume_skipped_requests(self):
+        invalid_request = {"type": "create", "requestId": "1"}
+        user_info = {"REQUEST_LOC": {"REQUEST_QUEUE": None, "REQUEST_BUCKET": None,
+                                     "REQUEST_STREAM": itertools.repeat(invalid_request)},
+                     "WIDGET_LOC": {"WIDGET_BUCKET": None, "DYNAMODB_TABLE": "widgets"}, "REGION": "us-east-1",
+                     "SEQUENCE_WINDOW": 0, "MAX_PENDING": 0, "WORKERS": 1, "MAX_IN_FLIGHT": 1}
+        poll_scheduler = consumer.create_poll_scheduler(min_delay=0.001, max_delay=0.004, max_empty_polls=3)
+        stop_reason = consumer.consume_requests(logger, user_info, consumer.create_client_pool(),
+                                                consumer.load_request_validator(), poll_scheduler)
+        self.assertEqual(stop_reason, "Max number of failed request polls reached")
+        self.assertEqual(poll_scheduler["EMPTY_POLLS"], 4)
+        self.assertEqual(poll_scheduler["DELAY"], 0.004)
+
+        # invalid requests read from request files are never read again, so they don't end the import early
+        request_stream = iter([invalid_request] * 3)
+        user_info["REQUEST_LOC"]["REQUEST_STREAM"] = request_stream
+        poll_scheduler = consumer.create_poll_scheduler(min_delay=0.001, max_delay=0.004, max_empty_polls=0)
+        consumer.consume_requests(logger, user_info, consumer.create_client_pool(), consumer.load_request_validator(),
+                                  poll_scheduler)
+        self.assertIsNone(next(request_stream, None))
+        self.assertEqual(poll_scheduler["EMPTY_POLLS"], 1)
+
+
+    # tests that processed and in-flight requests are recognized as duplicates, in memory and in the on-disk store
+    def test_dedupe_cache(self):
+        dedupe_cache = consumer.create_dedupe_cache(max_size=2, ttl=60)
+        self.assertIsNone(consumer.check_duplicate_request(dedupe_cache, "1"))
+        consumer.mark_request_in_flight(dedupe_cache, "1")
+        self.assertEqual(consumer.check_duplicate_request(dedupe_cache, "1"), "in-flight")
+        for request_id in ("1", "2", "3"):
+            consumer.mark_request_processed(dedupe_cache, request_id)
+        self.assertIsNone(consumer.check_duplicate_request(dedupe_cache, "1"))
+        self.assertEqual(consumer.check_duplicate_request(dedupe_cache, "3"), "processed")
+
+        expired_cache = consumer.create_dedupe_cache(ttl=0)
+        consumer.mark_request_processed(expired_cache, "1")
+        time.sleep(0.01)
+        self.assertIsNone(consumer.check_duplicate_request(expired_cache, "1"))
+
+        with tempfile.TemporaryDirectory() as store_dir:
+            store_path = os.path.join(store_dir, "dedupe.sqlite")
+            dedupe_cache = consumer.create_dedupe_cache(max_size=1, store_path=store_path)
+            consumer.mark_request_processed(dedupe_cache, "1")
+            consumer.mark_request_processed(dedupe_cache, "2")
+            self.assertEqual(consumer.check_duplicate_request(dedupe_cache, "1"), "processed")
+            consumer.close_dedupe_cache(dedupe_cache)
+
+            dedupe_cache = consumer.create_dedupe_cache(store_path=store_path)
+            self.assertEqual(consumer.check_duplicate_request(dedupe_cache, "2"), "processed")
+            consumer.close_dedupe_cache(dedupe_cache)
+
+
+    # tests that requests being processed are kept hidden until they are deleted or released
+    def test_visibility_extender(self):
+        region = "us-east-1"
+        sqs_client = FakeSQSClient([])
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('sqs', region)] = sqs_client
+        extender = consumer.create_visibility_extender(logger, "fake-queue", region, 60, client_pool)
+        request_loc = {"REQUEST_QUEUE": "fake-queue", "REQUEST_BUCKET": None, "VISIBILITY_EXTENDER": extender,
+                       "DEDUPE_CACHE": consumer.create_dedupe_cache()}
+
+        requests = [{"type": "create", "requestId": str(i), "receipt_handle": f"handle-{i}"} for i in range(3)]
+        for request in requests:
+            consumer.begin_request(request_loc, request)
+        consumer.extend_message_visibility(logger, extender, region, client_pool)
+        self.assertEqual(sqs_client.visibility_changes, [])
+
+        with extender["LOCK"]:
+            for receipt_handle, (request_id, _) in extender["MESSAGES"].items():
+                extender["MESSAGES"][receipt_handle] = (request_id, time.monotonic())
+        consumer.delete_request(logger, requests[0], request_loc, region, client_pool)
+        consumer.release_request(request_loc, requests[1])
+        consumer.extend_message_visibility(logger, extender, region, client_pool)
+        consumer.stop_visibility_extender(extender)
+
+        self.assertEqual(sqs_client.deleted_handles, ["handle-0"])
+        self.assertEqual(sqs_client.visibility_changes, [("handle-2", 60)])
+        self.assertEqual(consumer.check_duplicate_request(request_loc["DEDUPE_CACHE"], "0"), "processed")
+        self.assertIsNone(consumer.check_duplicate_request(request_loc["DEDUPE_CACHE"], "1"))
+        self.assertEqual(consumer.check_duplicate_request(request_loc["DEDUPE_CACHE"], "2"), "in-flight")
+
+
+    # tests that held requests for a widget are released in the order they were sent, not the order they arrived
+    def test_sequencer(self):
+        def make_request(request_type, widget_id, key):
+            return {"type": request_type, "requestId": key, "widgetId": widget_id, "owner": "Mary Matthews",
+                    "key": key}
+
+        sequencer = consumer.create_sequencer(window=60, max_pending=4)
+        arrivals = [make_request("update", "widget-1", "1612306369227"),
+                    make_request("create", "widget-2", "1612306369300"),
+                    make_request("delete", "widget-1", "1612306369451"),
+                    make_request("create", "widget-1", "1612306368338")]
+        for request in arrivals:
+            consumer.add_to_sequencer(sequencer, request)
+        self.assertEqual(consumer.pop_ready_requests(sequencer), [])
+        self.assertGreater(consumer.time_until_release(sequencer), 0)
+
+        # a fifth request overflows the sequencer, so the widget waiting longest is released
+        consumer.add_to_sequencer(sequencer, make_request("update", "widget-2", "1612306369100"))
+        released = consumer.pop_ready_requests(sequencer)
+        self.assertEqual([(request['type'], request['widgetId']) for request in released],
+                         [("create", "widget-1"), ("update", "widget-1"), ("delete", "widget-1")])
+
+        released = consumer.pop_ready_requests(sequencer, flush=True)
+        self.assertEqual([request['type'] for request in released], ["update", "create"])
+        self.assertIsNone(consumer.time_until_release(sequencer))
+
+        sqs_requests = [{"type": "update", "widgetId": "widget-3", "sent_timestamp": 2},
+                        {"type": "create", "widgetId": "widget-3", "sent_timestamp": 2}]
+        sequencer = consumer.create_sequencer(window=0)
+        for request in sqs_requests:
+            consumer.add_to_sequencer(sequencer, request)
+        self.assertEqual([request['type'] for request in consumer.pop_ready_requests(sequencer)], ["create", "update"])
+
+        # numeric and text keys for one widget can be ordered together
+        sequencer = consumer.create_sequencer(window=0)
+        for request in [make_request("delete", "widget-4", "requests.jsonl:2"),
+                        make_request("create", "widget-4", "1612306368338")]:
+            consumer.add_to_sequencer(sequencer, request)
+        self.assertEqual([request['type'] for request in consumer.pop_ready_requests(sequencer)], ["create", "delete"])
+        self.assertNotIn("sent_timestamp", consumer.create_widget(logger, dict(sqs_requests[1], receipt_handle="1"),
+                                                                  log=False))
+
+
+    # tests that writes which wouldn't change a widget and deletes of widgets known to be missing are skipped
+    def test_widget_cache(self):
+        region = "us-east-1"
+        dynamodb_client = FakeDynamoDBClient()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('dynamodb', region)] = dynamodb_client
+        client_pool["CLIENTS"][('sqs', region)] = FakeSQSClient([])
+        user_info = {
+            "REQUEST_LOC": {"REQUEST_QUEUE": "fake-queue", "REQUEST_BUCKET": None},
+            "WIDGET_LOC": {"WIDGET_BUCKET": None, "DYNAMODB_TABLE": "widgets",
+                           "WIDGET_CACHE": consumer.create_widget_cache(1024 * 1024)},
+            "REGION": region
+        }
+
+        requests = [("create", "A"), ("update", "A"), ("update", "B"), ("delete", None), ("delete", None)]
+        for i, (request_type, label) in enumerate(requests):
+            request = {"type": request_type, "requestId": str(i), "widgetId": "widget-1", "owner": "Mary Matthews",
+                       "receipt_handle": str(i)}
+            if label is not None:
+                request["label"] = label
+            consumer.process_request(logger, request, user_info, region, client_pool)
+        self.assertEqual(dynamodb_client.writes, [("put", "widget-1", "A"), ("put", "widget-1", "B"),
+                                                  ("delete", "widget-1", None)])
+        self.assertEqual(client_pool["CLIENTS"][('sqs', region)].deleted_handles, [str(i) for i in range(5)])
+
+        widget_cache = consumer.create_widget_cache(max_bytes=100)
+        consumer.cache_widget(widget_cache, "widget-1", {"widgetId": "widget-1", "label": "x" * 40})
+        consumer.cache_widget(widget_cache, "widget-2", {"widgetId": "widget-2", "label": "x" * 40})
+        self.assertEqual(consumer.get_cached_widget(widget_cache, "widget-1"), (False, None))
+        self.assertTrue(consumer.get_cached_widget(widget_cache, "widget-2")[0])
+        consumer.invalidate_widget(widget_cache, "widget-2")
+        self.assertEqual(widget_cache["BYTES"], 0)
+
+        shared_cache = consumer.create_widget_cache(max_bytes=100, ttl=0)
+        consumer.cache_widget(shared_cache, "widget-1", None)
+        time.sleep(0.01)
+        self.assertEqual(consumer.get_cached_widget(shared_cache, "widget-1"), (False, None))
+
+
+    # tests that update requests only set the attributes they hold, and don't create missing widgets
+    def test_update_widget_dynamodb(self):
+        region = "us-east-1"
+        dynamodb_client = FakeDynamoDBClient()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('dynamodb', region)] = dynamodb_client
+        client_pool["CLIENTS"][('sqs', region)] = FakeSQSClient([])
+        user_info = {
+            "REQUEST_LOC": {"REQUEST_QUEUE": "fake-queue", "REQUEST_BUCKET": None},
+            "WIDGET_LOC": {"WIDGET_BUCKET": None, "DYNAMODB_TABLE": "widgets", "DYNAMODB_PARTIAL_UPDATES": True},
+            "REGION": region
+        }
+
+        requests = [
+            {"type": "create", "widgetId": "widget-1", "label": "A", "description": "old",
+             "otherAttributes": [{"name": "color", "value": "red"}, {"name": "size", "value": "3"}]},
+            {"type": "update", "widgetId": "widget-1", "label": "", "description": "new",
+             "otherAttributes": [{"name": "color", "value": "blue"}, {"name": "id", "value": "widget-9"}]},
+            {"type": "update", "widgetId": "widget-2", "description": "new"}
+        ]
+        for i, request in enumerate(requests):
+            request.update(requestId=str(i), owner="Mary Matthews", receipt_handle=str(i))
+            consumer.process_request(logger, request, user_info, region, client_pool)
+
+        self.assertEqual([write[0] for write in dynamodb_client.writes], ["put", "update"])
+        self.assertEqual(dynamodb_client.items, {"widget-1": {
+            "id": {"S": "widget-1"}, "owner": {"S": "Mary Matthews"}, "label": {"S": ""}, "description": {"S": "new"},
+            "color": {"S": "blue"}, "size": {"S": "3"}}})
+        self.assertNotIn("widget-2", dynamodb_client.items)
+
+
+    # tests that the worker pool processes every request, keeping requests for the same widget in order
+    def test_worker_pool(self):
+        region = "us-east-1"
+        sqs_client = FakeSQSClient([])
+        sqs_client.delete_message = lambda QueueUrl, ReceiptHandle: {}
+        dynamodb_client = FakeDynamoDBClient()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('sqs', region)] = sqs_client
+        client_pool["CLIENTS"][('dynamodb', region)] = dynamodb_client
+        user_info = {
+            "REQUEST_LOC": {"REQUEST_QUEUE": "fake-queue", "REQUEST_BUCKET": None},
+            "WIDGET_LOC": {"WIDGET_BUCKET": None, "DYNAMODB_TABLE": "widgets"},
+            "REGION": region
+        }
+
+        requests = []
+        for widget in range(8):
+            for step, request_type in enumerate(["create", "update", "update", "delete"]):
+                requests.append({"type": request_type, "requestId": f"{widget}-{step}", "widgetId": f"widget-{widget}",
+                                 "owner": "Mary Matthews", "label": str(step), "receipt_handle": f"{widget}-{step}"})
+
+        worker_pool = consumer.create_worker_pool(logger, user_info, client_pool, workers=4, max_in_flight=4)
+        for request in requests:
+            consumer.submit_request(worker_pool, request)
+        consumer.shutdown_worker_pool(worker_pool)
+
+        self.assertEqual(dynamodb_client.items, {})
+        for widget in range(8):
+            widget_writes = [write for write in dynamodb_client.writes if write[1] == f"widget-{widget}"]
+            self.assertEqual(widget_writes, [("put", f"widget-{widget}", "0"), ("put", f"widget-{widget}", "1"),
+                                             ("put", f"widget-{widget}", "2"), ("delete", f"widget-{widget}", None)])
+
+
+    # tests that the asyncio backend receives sqs requests with concurrent receive calls, processes them in tasks
+    # keeping requests for the same widget in order, and deletes every request in batches
+    def test_async_backend(self):
+        region = "us-east-1"
+        requests = []
+        for step, request_type in enumerate(["create", "update", "update", "delete"]):
+            for widget in range(8):
+                requests.append({"type": request_type, "requestId": f"{widget}-{step}", "widgetId": f"widget-{widget}",
+                                 "owner": "Mary Matthews", "label": str(step)})
+        sqs_client = FakeSQSClient(requests)
+        dynamodb_client = FakeDynamoDBClient()
+        user_info = {
+            "REQUEST_LOC": {"REQUEST_QUEUE": "fake-queue", "REQUEST_BUCKET": None,
+                            "SQS_BUFFER": consumer.create_sqs_buffer(batch_size=5, wait_time=0, receives=3)},
+            "WIDGET_LOC": {"WIDGET_BUCKET": None, "DYNAMODB_TABLE": "widgets"},
+            "REGION": region
+        }
+
+        async def consume():
+            async_pool = consumer.create_async_client_pool(consumer.create_client_pool(), max_pool_connections=4)
+            async_pool["CLIENTS"][('sqs', region)] = sqs_client
+            async_pool["CLIENTS"][('dynamodb', region)] = dynamodb_client
+            task_pool = consumer.create_task_pool(max_in_flight=4)
+            while (request := await consumer.get_next_request_async(logger, user_info["REQUEST_LOC"], region,
+                                                                    async_pool)) is not None:
+                await consumer.submit_request_async(logger, task_pool, request, user_info, async_pool)
+            await consumer.shutdown_task_pool(task_pool)
+            await consumer.flush_sqs_deletes_async(logger, "fake-queue", region, user_info["REQUEST_LOC"]["SQS_BUFFER"],
+                                                   async_pool)
+            await consumer.close_async_client_pool(async_pool)
+
+        asyncio.run(consume())
+
+        self.assertEqual([call["MaxNumberOfMessages"] for call in sqs_client.receive_calls], [5] * 12)
+        self.assertEqual(sorted(sqs_client.deleted_handles), sorted(f"handle-{i}" for i in range(len(requests))))
+        self.assertEqual(dynamodb_client.items, {})
+        for widget in range(8):
+            widget_writes = [write for write in dynamodb_client.writes if write[1] == f"widget-{widget}"]
+            self.assertEqual(widget_writes, [("put", f"widget-{widget}", "0"), ("put", f"widget-{widget}", "1"),
+                                             ("put", f"widget-{widget}", "2"), ("delete", f"widget-{widget}", None)])
+
+
+    # tests that the asyncio backend awaits native async clients, saving and deleting widgets in both copies of a dual
+    # widget location, and that a missing widget is only warned about
+    def test_async_native_clients(self):
+        region = "us-east-1"
+        s3_client = fake_aws.FakeS3()
+        dynamodb_client = fake_aws.FakeDynamoDB()
+        widget = {"widgetId": "widget-1", "owner": "Mary Matthews", "label": "A"}
+        widget_loc = {"WIDGET_BUCKET": "widgets", "DYNAMODB_TABLE": "widgets"}
+
+        async def run():
+            async_pool = consumer.create_async_client_pool(consumer.create_client_pool())
+            async_pool["CLIENTS"][('s3', region)] = fake_aws.AsyncFakeClient(s3_client)
+            async_pool["CLIENTS"][('dynamodb', region)] = fake_aws.AsyncFakeClient(dynamodb_client)
+            # native clients are awaited, so nothing may run on the executor
+            async_pool["EXECUTOR"].shutdown()
+
+            await consumer.save_widget_async(logger, widget, widget_loc, region, async_pool)
+            self.assertIn(("widgets", "widgets/mary-matthews/widget-1"), s3_client.objects)
+            self.assertIn("widget-1", dynamodb_client.tables["widgets"])
+
+            await consumer.delete_widget_async(logger, widget, widget_loc, region, async_pool)
+            self.assertEqual(s3_client.objects, {})
+            self.assertEqual(dynamodb_client.tables["widgets"], {})
+
+            with self.assertLogs(logger, level="WARNING") as logs:
+                await consumer.delete_widget_async(logger, widget, widget_loc, region, async_pool)
+                await consumer.delete_widget_async(logger, widget, {"WIDGET_BUCKET": "widgets", "DYNAMODB_TABLE": None},
+                                                   region, async_pool)
+            self.assertEqual(len(logs.records), 2)
+            await async_pool["EXIT_STACK"].aclose()
+
+        asyncio.run(run())
+
+
+    # tests that widgets are stored in s3 with the configured codec, and that widgets in any format (including plain
+    # json without metadata) are read back
+    def test_widget_codecs(self):
+        region = "us-east-1"
+        s3_client = fake_aws.FakeS3()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('s3', region)] = s3_client
+        widget = {"widgetId": "widget-1", "owner": "Mary Matthews", "label": "A", "description": "note " * 100,
+                  "otherAttributes": [{"name": "color", "value": "red"}]}
+        widget_path = "widgets/mary-matthews/widget-1"
+
+        json_size = None
+        for codec in consumer.get_available_codecs():
+            consumer.save_to_s3(logger, widget, "widgets", region, client_pool, codec)
+            body, metadata = s3_client.objects[("widgets", widget_path)]
+            self.assertEqual(metadata, {"codec": codec})
+            self.assertEqual(consumer.fetch_widget_s3("widgets", widget_path, region, client_pool), widget)
+            if codec == "json":
+                json_size = len(body)
+            elif codec in ("gzip", "zstd"):
+                self.assertLess(len(body), json_size / 4)
+
+        s3_client.objects[("widgets", widget_path)] = (json.dumps(widget).encode("utf-8"), {})
+        self.assertEqual(consumer.fetch_widget_s3("widgets", widget_path, region, client_pool), widget)
+        self.assertIsNone(consumer.fetch_widget_s3("widgets", "widgets/mary-matthews/widget-2", region, client_pool))
+        with self.assertRaises(ValueError):
+            consumer.encode_widget(widget, "xml")
+
+
+    # tests that the aggregated s3 layout writes one segment and index per owner and flush, and that compaction drops
+    # deleted and overwritten widgets without changing what is read back
+    def test_aggregated_s3_layout(self):
+        region = "us-east-1"
+        s3_client = fake_aws.FakeS3()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"][('s3', region)] = s3_client
+        write_buffer = consumer.create_write_buffer(None, max_wait=60, bucket_name="widgets", codec="gzip")
+        user_info = {
+            "REQUEST_LOC": {"REQUEST_FILES": "requests.jsonl", "REQUEST_QUEUE": None, "REQUEST_BUCKET": None},
+            "WIDGET_LOC": {"WIDGET_BUCKET": "widgets", "DYNAMODB_TABLE": None, "WRITE_BUFFER": write_buffer},
+            "REGION": region
+        }
+
+        def process(requests):
+            for request_type, widget_id, owner in requests:
+                request = {"type": request_type, "requestId": widget_id, "widgetId": widget_id, "owner": owner,
+                           "label": request_type}
+                consumer.process_request(logger, request, user_info, region, client_pool)
+            consumer.flush_write_buffer(logger, write_buffer, user_info["REQUEST_LOC"], region, client_pool)
+
+        process([("create", f"widget-{i}", "Mary Matthews") for i in range(10)] + [("create", "widget-x", "Sue Smith")])
+        self.assertEqual(sorted(key for _, key in s3_client.objects),
+                         ["widgets/mary-matthews/deltas/000000000000", "widgets/mary-matthews/segments/000000000000",
+                          "widgets/sue-smith/deltas/000000000000", "widgets/sue-smith/segments/000000000000"])
+        self.assertEqual(s3_client.calls["PutObject"], 4)
+
+        process([("update", f"widget-{i}", "Mary Matthews") for i in range(6)]
+                + [("delete", "widget-9", "Mary Matthews"), ("delete", "widget-10", "Mary Matthews")])
+        # the flush only writes a segment and a delta, never the whole index
+        self.assertEqual(s3_client.calls["PutObject"], 6)
+        expected = {f"widget-{i}": "update" if i < 6 else "create" for i in range(9)}
+        for widget_id, label in expected.items():
+            widget = consumer.fetch_aggregated_widget_s3("widgets", "Mary Matthews", widget_id, region, client_pool)
+            self.assertEqual(widget["label"], label)
+        self.assertIsNone(consumer.fetch_aggregated_widget_s3("widgets", "Mary Matthews", "widget-9", region,
+                                                              client_pool))
+
+        self.assertEqual(consumer.compact_widget_segments(logger, write_buffer, "widgets/mary-matthews", region,
+                                                          client_pool), 1)
+        self.assertEqual(consumer.compact_widget_segments(logger, write_buffer, "widgets/sue-smith", region,
+                                                          client_pool), 0)
+        self.assertEqual(sorted(key for _, key in s3_client.objects),
+                         ["widgets/mary-matthews/index", "widgets/mary-matthews/segments/000000000001",
+                          "widgets/mary-matthews/segments/000000000002", "widgets/sue-smith/index",
+                          "widgets/sue-smith/segments/000000000000"])
+        self.assertEqual(consumer.load_segment_index("widgets", "widgets/mary-matthews", region, client_pool),
+                         write_buffer["INDEXES"]["widgets/mary-matthews"])
+        for widget_id, label in expected.items():
+            widget = consumer.fetch_aggregated_widget_s3("widgets", "Mary Matthews", widget_id, region, client_pool)
+            self.assertEqual(widget["label"], label)
+
+
+    # tests that a buffered logger writes its lines from the queue once stopped, keeping the sampled debug lines only
+    def test_buffered_logger(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            save_file = os.path.join(log_dir, "consumer.log")
+            try:
+                consumer.create_logger(debug=False, save_file=save_file, buffered=True, debug_sample_rate=0.0)
+                # creating the logger again keeps its thread, but takes the new level
+                buffered_logger = consumer.create_logger(debug=True, save_file=save_file, buffered=True,
+                                                         debug_sample_rate=0.0)
+                self.assertEqual(buffered_logger.level, logging.DEBUG)
+                self.assertEqual(len([handler for handler in buffered_logger.handlers
+                                      if isinstance(handler, logging.handlers.QueueHandler)]), 1)
+                buffered_logger.info("Created Widget '%s'", "widget-1")
+                buffered_logger.debug("Validated Request %s", "1")
+                buffered_logger.warning("Could not delete widget '%s', widget does not exist.", "widget-2")
+                consumer.stop_logger(buffered_logger)
+            finally:
+                logger.setLevel(logging.NOTSET)
+                logger.propagate = True
+
+            with open(save_file) as log_file:
+                lines = log_file.read().splitlines()
+        self.assertEqual([line.split(": ", 1)[1] for line in lines],
+                         ["Created Widget 'widget-1'", "Could not delete widget 'widget-2', widget does not exist."])
+        self.assertFalse(any(isinstance(handler, logging.handlers.QueueHandler) for handler in logger.handlers))
+
+
+    # tests that calls throttled by a backend are retried through the rate controller until they get through, and
+    # that the controller cuts the limits of the backend and reports them as gauges
+    def test_rate_controller(self):
+        region = "us-east-1"
+        metrics = consumer.create_metrics()
+        rate_controller = consumer.create_rate_controller(8, metrics=metrics)
+        dynamodb = fake_aws.FakeDynamoDB(capacity=500)
+        client_pool = fake_aws.install_fake_clients(
+            consumer.create_client_pool(metrics=metrics, rate_controller=rate_controller), region, dynamodb)
+
+        def save_widgets(start):
+            for i in range(start, start + 100):
+                consumer.save_to_dynamodb(logger, {"widgetId": f"widget-{i}", "owner": "Mary Matthews"}, "widgets",
+                                          region, client_pool)
+
+        workers = [threading.Thread(target=save_widgets, args=(start,)) for start in range(0, 800, 100)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(len(dynamodb.tables["widgets"]), 800)
+        self.assertGreater(dynamodb.calls["Throttled"], 0)
+        backend = rate_controller["BACKENDS"]["dynamodb"]
+        self.assertEqual(backend["IN_FLIGHT"], 0)
+        self.assertIsNotNone(backend["RATE"])
+        gauges = {name: value for (name, labels), value in metrics["GAUGES"].items()
+                  if labels == (("service", "dynamodb"),)}
+        self.assertEqual(set(gauges), {"consumer_backend_call_rate", "consumer_backend_concurrency_limit",
+                                       "consumer_backend_rate_limit"})
+        self.assertIn("# TYPE consumer_backend_rate_limit gauge", consumer.format_metrics_prometheus(metrics))
+
+        self.assertEqual(consumer.parse_rate_limits(("dynamodb=500", "s3=10.5")), {"dynamodb": 500.0, "s3": 10.5})
+        with self.assertLogs(level="ERROR"):
+            self.assertIsNone(consumer.parse_rate_limits(("dynamo=500",)))
+
+
+    # tests that botocore's own retry handler decides first whether a throttled call is retried, and that the rate
+    # controller only retries the call once botocore has used up its attempts
+    def test_rate_controller_botocore_retries(self):
+        region = "us-east-1"
+        rate_controller = consumer.create_rate_controller(8)
+        session = boto3.session.Session(aws_access_key_id="test", aws_secret_access_key="test", region_name=region)
+        attempts = []
+
+        # answers the first three attempts with a throttling error instead of sending them
+        def send(request, **kwargs):
+            attempts.append(request.url)
+            if len(attempts) <= 3:
+                status, body = 400, b'{"__type": "ProvisionedThroughputExceededException", "message": "slow down"}'
+            else:
+                status, body = 200, b'{}'
+            return botocore.awsrequest.AWSResponse(request.url, status, {}, types.SimpleNamespace(
+                stream=lambda: iter([body])))
+
+        session.events.register("before-send.dynamodb.PutItem", send)
+        client_pool = consumer.create_client_pool(session=session, rate_controller=rate_controller)
+        client_pool["CONFIG"] = botocore.config.Config(retries={"mode": "standard", "total_max_attempts": 2})
+
+        delays = []
+        with unittest.mock.patch.object(botocore.retries.standard.RetryPolicy, "compute_retry_delay",
+                                        lambda policy, context: 0.002), \
+                unittest.mock.patch.object(consumer, "get_throttle_backoff", lambda attempt: 0.001), \
+                unittest.mock.patch.object(botocore.endpoint, "time", types.SimpleNamespace(sleep=delays.append)):
+            consumer.save_to_dynamodb(logger, {"widgetId": "widget-1", "owner": "Mary Matthews"}, "widgets", region,
+                                      client_pool)
+
+        self.assertEqual(len(attempts), 4)
+        # botocore's delay is used for its one retry, the rate controller's for the retries after it
+        self.assertEqual(delays, [0.002, 0.001, 0.001])
+        self.assertEqual(rate_controller["BACKENDS"]["dynamodb"]["IN_FLIGHT"], 0)
+
+
+    # tests that widgets are written to both backends in dual mode, and that a migration between them copies every
+    # widget and resumes from its checkpoint, only copying the owners it hadn't finished
+    def test_dual_backend_migration(self):
+        region = "us-east-1"
+        s3_client, dynamodb_client = fake_aws.FakeS3(), fake_aws.FakeDynamoDB()
+        client_pool = consumer.create_client_pool()
+        client_pool["CLIENTS"].update({("s3", region): s3_client, ("dynamodb", region): dynamodb_client})
+        widget_loc = {"WIDGET_BUCKET": "widgets", "DYNAMODB_TABLE": "widgets", "DYNAMODB_PARTIAL_UPDATES": True,
+                      "REPLICATION_EXECUTOR": concurrent.futures.ThreadPoolExecutor(max_workers=2)}
+        owners = ["Mary Matthews", "Sue Smith", "Bob Brown"]
+        for i in range(30):
+            widget = {"widgetId": f"widget-{i}", "owner": owners[i % 3], "label": "create",
+                      "otherAttributes": [{"name": "color", "value": "blue"}]}
+            consumer.save_widget(logger, widget, widget_loc, region, client_pool)
+        consumer.save_widget(logger, {"widgetId": "widget-0", "owner": owners[0], "label": "update"}, widget_loc,
+                             region, client_pool, partial=True)
+        consumer.delete_widget(logger, {"widgetId": "widget-1", "owner": owners[1]}, widget_loc, region, client_pool)
+        widget_loc["REPLICATION_EXECUTOR"].shutdown()
+
+        s3_widgets = {key: consumer.fetch_widget_s3("widgets", key, region, client_pool)
+                      for _, key in s3_client.objects}
+        self.assertEqual(len(s3_widgets), 29)
+        self.assertEqual(s3_widgets["widgets/mary-matthews/widget-0"], {"widgetId": "widget-0", "owner": owners[0],
+                                                                        "label": "update"})
+        self.assertEqual(sorted(s3_widgets.values(), key=lambda widget: widget["widgetId"]),
+                         [consumer.create_widget_from_item(item)
+                          for _, item in sorted(dynamodb_client.tables["widgets"].items())])
+
+        # copying s3 to a new table fails for one owner, so resuming only copies that owner again
+        class FailingDynamoDB(fake_aws.FakeDynamoDB):
+            failing_owner = owners[2]
+
+            def put_item(self, TableName, Item, **kwargs):
+                if Item["owner"]["S"] == self.failing_owner:
+                    raise RuntimeError("Injected failure")
+                return super().put_item(TableName, Item, **kwargs)
+
+        target_client = FailingDynamoDB()
+        target_pool = consumer.create_client_pool()
+        target_pool["CLIENTS"].update({("s3", region): s3_client, ("dynamodb", region): target_client})
+        migration = {"SOURCE": "s3", "WIDGET_BUCKET": "widgets", "DYNAMODB_TABLE": "copies", "WIDGET_CODEC": "json",
+                     "SEGMENTS": 3, "EXECUTOR": concurrent.futures.ThreadPoolExecutor(max_workers=4)}
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            save_file = os.path.join(checkpoint_dir, "checkpoint.json")
+            checkpoint = consumer.load_migration_checkpoint(save_file, "s3://widgets", "dynamodb://copies")
+            with self.assertRaises(RuntimeError):
+                consumer.migrate_widgets(logger, migration, checkpoint, region, target_pool)
+            self.assertEqual(len(target_client.tables["copies"]), 19)
+
+            # a newer state of a widget written to the target by a consumer isn't overwritten by its older copy
+            target_client.failing_owner = None
+            newer_item = consumer.create_dynamodb_item({"widgetId": "widget-2", "owner": owners[2], "label": "newer"})
+            target_client.tables["copies"]["widget-2"] = newer_item
+            gets = s3_client.calls["GetObject"]
+            checkpoint = consumer.load_migration_checkpoint(save_file, "s3://widgets", "dynamodb://copies")
+            self.assertEqual(consumer.migrate_widgets(logger, migration, checkpoint, region, target_pool), 29)
+            self.assertEqual(s3_client.calls["GetObject"] - gets, 10)
+            self.assertEqual(target_client.tables["copies"], dict(dynamodb_client.tables["widgets"],
+                                                                  **{"widget-2": newer_item}))
+            self.assertIsNone(consumer.load_migration_checkpoint(save_file, "s3://widgets", "dynamodb://widgets"))
+
+        # copying the table back to a new bucket with a parallel scan gives the same widgets, skipping items that
+        # aren't widgets and removing the copy of a widget deleted while it was copied
+        dynamodb_client.tables["widgets"]["counter"] = {"id": {"S": "counter"}, "count": {"N": "3"}}
+        scan = dynamodb_client.scan
+
+        def scan_and_delete(**kwargs):
+            response = scan(**kwargs)
+            if any(item["id"]["S"] == "widget-3" for item in response["Items"]):
+                dynamodb_client.tables["widgets"].pop("widget-3")
+            return response
+
+        dynamodb_client.scan = scan_and_delete
+        del s3_widgets["widgets/mary-matthews/widget-3"]
+        migration.update(SOURCE="dynamodb", WIDGET_BUCKET="copies", DYNAMODB_TABLE="widgets", WIDGET_CODEC="gzip")
+        checkpoint = consumer.load_migration_checkpoint(None, "dynamodb://widgets", "s3://copies")
+        with self.assertLogs(logger, level="WARNING") as logs:
+            self.assertEqual(consumer.migrate_widgets(logger, migration, checkpoint, region, client_pool), 28)
+        self.assertEqual([record.getMessage() for record in logs.records],
+                         ["Skipped item with key {'S': 'counter'} of 'widgets' table, it isn't a widget."])
+        self.assertEqual(dynamodb_client.calls["Scan"], 3)
+        self.assertEqual({key.removeprefix("widgets/"): widget for key, widget in s3_widgets.items()},
+                         {key.removeprefix("widgets/"): consumer.fetch_widget_s3("copies", key, region, client_pool)
+                          for bucket, key in list(s3_client.objects) if bucket == "copies"})
+        migration["EXECUTOR"].shutdown()
+
+
 if __name__ == "__main__":
     unittest.main()